@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# Annotation queue of the body posterior tip labels, run before the batch. Identifying a missing label in the middle of
+# the batch blocks its session on the viewer of SCT (or fails it if the label is incomplete, so that the batch has to be
+# run again). This script collects all the navigated images of the dataset whose label is missing under
+# derivatives/labels, presents them back-to-back in a single annotation session with `sct_get_centerline -method
+# viewer`, and validates each label (one label per axial slice, see create_ghosting_mask.py). An invalid label is
+# presented again, up to `-attempts` times. The batch can then be run unattended, and in parallel.
+#
+# With `-method auto`, the missing labels are detected automatically instead of using the viewer, and saved under
+# derivatives/labels (the batch saves the labels it detects in the processed data folder instead, see
+# create_ghosting_mask.py). With `-refine`, the labels of derivatives/labels which were detected automatically are also
+# queued, and replaced by manual ones. With `-max-gap N`, a label with up to N consecutive axial slices missing is completed by interpolation instead
+# of being presented again (see create_ghosting_mask.py). With `-list`, the queue is only printed.
+#
+# The images and their labels are taken from the dataset index (see dataset_index.py), which is built again by the
+# batch as the labels are added to derivatives/labels.
+#
+# How to use:
+#   ./annotate_posterior_tips.py -path-data <PATH_TO_DATA> -path-output <PATH_TO_OUTPUT> [-include-list sub-01/ses-01 ...]
+#                                [-method viewer|auto] [-refine] [-attempts N] [-max-gap N] [-list]
+#
+# Example:
+#   ./annotate_posterior_tips.py -path-data ~/data/ds006347/ -path-output ~/temp/ds006347_20250612_144520
+#   sct_run_batch -script process_data.sh -path-data ~/data/ds006347/ -path-output ~/temp/ds006347_20250612_144520
+
+import os
+import sys
+import argparse
+import subprocess
+
+import dataset_index
+import create_ghosting_mask
+from nifti_cache import load_data
+
+# Define variables
+label = "label-bodyPosteriorTip_label"
+default_attempts = 3
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Identify all the missing body posterior tip labels of the dataset in a single annotation session,\
+        before running the batch."
+    )
+    parser.add_argument("-path-data", required=True, help="Path to the BIDS dataset.")
+    parser.add_argument("-path-output", required=True, help="Path to the output folder of the batch.")
+    parser.add_argument("-include-list", nargs="+",
+                        help="Only process these subjects/sessions (e.g., sub-01/ses-01 sub-02/ses-01).")
+    parser.add_argument("-method", choices=create_ghosting_mask.tip_methods, default="viewer",
+                        help="Method used to identify the missing labels (default: %(default)s).")
+    parser.add_argument("-refine", action="store_true",
+                        help="Also queue the labels of derivatives/labels detected automatically (with `-method auto`),\
+                        to replace them with the viewer.")
+    parser.add_argument("-attempts", type=int, default=default_attempts,
+                        help="Maximum number of times an invalid label is presented again (default: %(default)s).")
+    parser.add_argument("-max-gap", type=int, default=None,
+                        help="Maximum number of consecutive axial slices without label which are filled by\
+                        interpolation (default: the environment variable GRE1DNAV_POSTERIOR_TIP_MAX_GAP, or 0).")
+    parser.add_argument("-list", action="store_true", help="Only print the queue.")
+    return parser
+
+
+# Define functions
+def collect_queue(index, sessions, refine=False):
+    """
+    Return the acquisitions whose body posterior tip label is missing (or was detected automatically, if `refine`), as
+    (subject, session, acq) tuples. The navigated images and their labels are taken from the dataset index.
+    """
+    queue = []
+    for subject_session in sessions:
+        subject, session = subject_session.split("/")
+        for acq, images_acq in dataset_index.get_images(index, subject_session).items():
+            if "rec-navigated" not in images_acq:
+                continue
+            if label not in images_acq["rec-navigated"]['labels']:
+                queue.append((subject, session, acq))
+            elif refine:
+                paths = create_ghosting_mask.get_paths(index['path_data'], index['path_data'], subject, session, acq)
+                if create_ghosting_mask.is_automatic_label(paths['body_post_tip_json']):
+                    queue.append((subject, session, acq))
+    return queue
+
+
+def validate_label(path_body_post_tip):
+    """Return the list of problems of a body posterior tip label (empty if it is valid)."""
+    if not os.path.exists(path_body_post_tip):
+        return ["missing label"]
+    empty_slices = create_ghosting_mask.get_empty_slices(load_data(path_body_post_tip))
+    if len(empty_slices):
+        return [f"no label in slice(s) {', '.join(map(str, empty_slices))}"]
+    return []
+
+
+def annotate(path_data, path_output, queue, method="viewer", attempts=default_attempts, max_gap=None):
+    """
+    Identify the body posterior tip of the acquisitions of the queue back-to-back (see
+    create_ghosting_mask.identify_body_posterior_tip), and validate the labels. An invalid label is presented again, up
+    to `attempts` times (a label with short gaps is completed instead if `max_gap` allows it, see
+    create_ghosting_mask.identify_body_posterior_tip). The annotation session can be interrupted with Ctrl+C: the
+    labels already saved are kept.
+
+    :return: Dict of the acquisitions which could not be annotated ("sub-01/ses-01/acq-LSE": problems)
+    """
+    failed = {}
+    i = 0
+    try:
+        for i, (subject, session, acq) in enumerate(queue):
+            name = f"{subject}/{session}/{acq}"
+            paths = create_ghosting_mask.get_paths(path_data, path_data, subject, session, acq)
+            for attempt in range(1, attempts + 1):
+                print(f"[{i + 1}/{len(queue)}] {name}" + (f" (attempt {attempt}/{attempts})" if attempt > 1 else ""))
+                try:
+                    create_ghosting_mask.identify_body_posterior_tip(
+                        paths['anat'], paths['body_post_tip'], paths['body_post_tip_csv'],
+                        paths['body_post_tip_json'], path_output=path_output, method=method,
+                        max_gap=max_gap)
+                except (RuntimeError, subprocess.CalledProcessError) as e:
+                    failed[name] = [str(e)]
+                    continue
+                except OSError as e:
+                    # E.g., the viewer is not installed: presenting the image again would not help
+                    failed[name] = [str(e)]
+                    break
+                failed[name] = validate_label(paths['body_post_tip'])
+                if not failed[name]:
+                    del failed[name]
+                    break
+    except KeyboardInterrupt:
+        print("\nAnnotation session interrupted")
+        failed.update({f"{subject}/{session}/{acq}": ["not annotated"] for subject, session, acq in queue[i:]
+                       if f"{subject}/{session}/{acq}" not in failed})
+    return failed
+
+
+def annotate_sessions(index, path_output, sessions, method="viewer", refine=False, attempts=default_attempts,
+                      max_gap=None):
+    """Identify all the missing body posterior tip labels of the subjects/sessions of the dataset index (see annotate)."""
+    queue = collect_queue(index, sessions, refine)
+    print(f"{len(queue)} body posterior tip labels to identify")
+    if not queue:
+        return {}
+    failed = annotate(index['path_data'], path_output, queue, method, attempts, max_gap)
+    print(f"{len(queue) - len(failed)} labels identified, {len(failed)} failed")
+    for name, problems in failed.items():
+        print(f"  {name}: {'; '.join(problems)}")
+    return failed
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isdir(args.path_data):
+        print(f"Error: Provided path does not exist.\nProvided path: {args.path_data}")
+        sys.exit(1)
+    index = dataset_index.get_index(args.path_data, args.path_output)
+    sessions = dataset_index.get_sessions(index, args.include_list)
+    if args.list:
+        for subject, session, acq in collect_queue(index, sessions, args.refine):
+            print(f"{subject}/{session} {acq}")
+        return
+    failed = annotate_sessions(index, args.path_output, sessions, args.method, args.refine, args.attempts,
+                               args.max_gap)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Batched automatic segmentation of a whole cohort. Calling `sct_deepseg spinalcord` or `sct_deepseg_gm` once per image
+# pays for the start of the interpreter and the import of PyTorch and SCT every time. This script collects all the
+# navigated images of the dataset which need an automatic SC or GM segmentation (i.e., without manual segmentation under
+# derivatives/labels), and segments them in a few long-lived SCT processes (see segment_worker.py), each processing up to
+# `-batch-size` images. SCT still loads the model for every image (see segment_worker.py).
+#
+# The segmentations are added to the derivative cache (see derivative_cache.py), under the same keys as the ones
+# computed by process_data.sh and run_batch.py: when the batch is run afterwards, the segmentations are linked from the
+# cache instead of running the tools (the QC report is still generated with sct_qc). The images already in the cache
+# are not segmented again.
+#
+# The cache must be enabled (GRE1DNAV_DERIVATIVE_CACHE). The Python interpreter of SCT is found from SCT_DIR or from the
+# location of sct_deepseg, and can be set with the environment variable GRE1DNAV_SCT_PYTHON.
+#
+# How to use:
+#   ./batch_segment.py -path-data <PATH_TO_DATA> -path-output <PATH_TO_OUTPUT> [-include-list sub-01/ses-01 ...]
+#                      [-batch-size N] [-fake-tools]
+#
+# Example:
+#   export GRE1DNAV_DERIVATIVE_CACHE=~/temp/derivative_cache
+#   ./batch_segment.py -path-data ~/data/ds006347/ -path-output ~/temp/ds006347_20250612_144520
+#   sct_run_batch -script process_data.sh -path-data ~/data/ds006347/ -path-output ~/temp/ds006347_20250612_144520
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+
+import dataset_index
+import derivative_cache
+import step_manifest
+from provenance import get_provenance
+
+# Define variables
+ext = ".nii.gz"
+contrast = "T2starw"
+env_sct_python = "GRE1DNAV_SCT_PYTHON"
+default_batch_size = 50
+path_worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "segment_worker.py")
+# Tool run by the worker for each label
+tools = {
+    "SC": "sct_deepseg",
+    "GM": "sct_deepseg_gm",
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Segment all the navigated images of the dataset which need an automatic segmentation in a few SCT\
+        processes, and add the segmentations to the derivative cache."
+    )
+    parser.add_argument("-path-data", required=True, help="Path to the BIDS dataset.")
+    parser.add_argument("-path-output", required=True, help="Path to the output folder of the batch.")
+    parser.add_argument("-include-list", nargs="+",
+                        help="Only process these subjects/sessions (e.g., sub-01/ses-01 sub-02/ses-01).")
+    parser.add_argument("-batch-size", type=int, default=default_batch_size,
+                        help=f"Maximum number of images segmented by each SCT process (default: {default_batch_size}).")
+    parser.add_argument("-fake-tools", action="store_true",
+                        help="Use the stand-in segmenter of fake_tools.py (offline testing only).")
+    return parser
+
+
+# Define functions
+def get_sct_python():
+    """Return the Python interpreter of SCT."""
+    if os.environ.get(env_sct_python):
+        return os.environ[env_sct_python]
+    sct_dir = os.environ.get("SCT_DIR")
+    if not sct_dir and shutil.which("sct_deepseg"):
+        sct_dir = os.path.dirname(os.path.dirname(os.path.realpath(shutil.which("sct_deepseg"))))
+    path_python = os.path.join(sct_dir or "", "python", "envs", "venv_sct", "bin", "python")
+    if not os.path.isfile(path_python):
+        raise RuntimeError(f"The Python interpreter of SCT was not found. Set {env_sct_python} to its path.")
+    return path_python
+
+
+def collect_jobs(index, sessions, sct_version):
+    """
+    Return the navigated images which need an automatic segmentation, and are not in the derivative cache. The images
+    and their manual segmentations are taken from the dataset index (see dataset_index.py).
+    """
+    jobs = []
+    for subject_session in sessions:
+        for images_acq in dataset_index.get_images(index, subject_session).values():
+            if "rec-navigated" not in images_acq:
+                continue
+            entry = images_acq["rec-navigated"]
+            path_image = os.path.join(index['path_data'], entry['file'])
+            file = os.path.basename(path_image)[:-len(ext)]
+            for label, tool in tools.items():
+                file_seg = f"{file}_label-{label}_seg"
+                if f"label-{label}_seg" in entry['labels']:
+                    continue
+                # Same parameters as the segmentation step (see step_manifest.py)
+                key = derivative_cache.get_key([path_image], {'tool': step_manifest.segmentation_tools[label],
+                                                              'sct_version': sct_version})
+                if not derivative_cache.contains(key):
+                    jobs.append({'tool': tool, 'input': path_image, 'output': file_seg + ext, 'key': key})
+    return jobs
+
+
+def run_jobs(jobs, path_work, path_log, batch_size=default_batch_size, fake=False):
+    """
+    Segment the images in SCT processes of up to `batch_size` images, and add the segmentations to the derivative cache.
+    The images whose segmentation failed are left to the batch, which segments them one by one.
+
+    :return: Number of segmentations added to the cache
+    """
+    path_python = sys.executable if fake else get_sct_python()
+    os.makedirs(path_work, exist_ok=True)
+    n_stored = 0
+    try:
+        for start in range(0, len(jobs), batch_size):
+            chunk = jobs[start:start + batch_size]
+            worker_jobs = [{'tool': job['tool'], 'input': job['input'],
+                            'output': os.path.join(path_work, f"{start + i}_{job['output']}")}
+                           for i, job in enumerate(chunk)]
+            path_jobs = os.path.join(path_work, f"jobs_{start}.json")
+            with open(path_jobs, 'w') as f:
+                json.dump(worker_jobs, f, indent=4)
+            cmd = [path_python, path_worker, path_jobs] + (["-fake-tools"] if fake else [])
+            print(f"Segmenting images {start + 1}-{start + len(chunk)} of {len(jobs)}")
+            process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            with open(path_log, 'a') as log:
+                log.write(f"\n$ {' '.join(cmd)}\n{process.stdout}")
+            try:
+                done = set(json.loads(process.stdout.strip().splitlines()[-1]))
+            except (IndexError, json.JSONDecodeError):
+                done = set()
+            if process.returncode != 0 or len(done) < len(chunk):
+                print(f"Warning: {len(chunk) - len(done)} images could not be segmented, see {path_log}")
+            for job, worker_job in zip(chunk, worker_jobs):
+                if worker_job['output'] in done and os.path.isfile(worker_job['output']):
+                    derivative_cache.store(job['key'], worker_job['output'])
+                    n_stored += 1
+    finally:
+        shutil.rmtree(path_work, ignore_errors=True)
+    return n_stored
+
+
+def segment_sessions(index, path_output, sessions, sct_version, batch_size=default_batch_size, fake=False):
+    """
+    Segment all the images of the subjects/sessions of the dataset index which need an automatic segmentation (see
+    run_jobs).
+    """
+    if derivative_cache.get_cache_dir() is None:
+        raise RuntimeError(f"The derivative cache is disabled. Set {derivative_cache.env_cache_dir} to its path.")
+    jobs = collect_jobs(index, sessions, sct_version)
+    print(f"{len(jobs)} images to segment")
+    if not jobs:
+        return 0
+    path_log = os.path.join(path_output, "log", "batch_segmentation.log")
+    os.makedirs(os.path.dirname(path_log), exist_ok=True)
+    return run_jobs(jobs, os.path.join(path_output, "tmp_batch_segmentation"), path_log, batch_size, fake)
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isdir(args.path_data):
+        print(f"Error: Provided path does not exist.\nProvided path: {args.path_data}")
+        sys.exit(1)
+    index = dataset_index.get_index(args.path_data, args.path_output)
+    sessions = dataset_index.get_sessions(index, args.include_list)
+    sct_version = get_provenance(args.path_output)['sct_version']
+    n_stored = segment_sessions(index, args.path_output, sessions, sct_version, args.batch_size,
+                                args.fake_tools)
+    print(f"{n_stored} segmentations added to the derivative cache")
+
+
+if __name__ == "__main__":
+    main()
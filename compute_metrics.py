@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# Computes all the metrics of one image in a single pass: slice-wise SNR/CNR, ghosting and WM STD. The anatomical image,
+# the SC and GM segmentations and the ghosting mask are loaded once, instead of being read and decompressed again by
+# compute_snr_cnr.py, compute_ghosting.py and compute_wm_std.py. The WM mask is derived in memory from the SC and GM
+# segmentations (SC - GM, clipped at 0 so that GM voxels outside the cord are not part of it). The results are written
+# to the same outputs as those scripts:
+#   /PATH/TO/PROCESSED/DATA/results/CNR/SUB-ID/SES-ID/<file>_results.csv
+#   /PATH/TO/PROCESSED/DATA/results/SNR/SUB-ID/SES-ID/<file>_wm_results.csv
+#   /PATH/TO/PROCESSED/DATA/results/SNR/SUB-ID/SES-ID/<file>_gm_results.csv
+#   /PATH/TO/PROCESSED/DATA/results/shards/SUB-ID/SES-ID/SUB-ID_SES-ID_ACQ-REGION_REC_<metric>.json
+# The shards are merged into the results database, ghosting_metrics.csv and wm_std.csv at the end of the batch (see
+# results_store.py).
+#
+# The segmentations and the ghosting mask are always the ones of the navigated image (see process_data.sh).
+#
+# The WM mask is only written to disk (<file_navigated>_label-WM_seg.nii.gz, e.g., for a visual check) with
+# -save-wm-mask, or if the environment variable GRE1DNAV_SAVE_WM_MASK is set to 1.
+#
+# In paired mode (rec = "paired"), the reconstructions of the acquisition (both by default, see -recs) are processed
+# together: the masks are loaded once, and the ghosting and WM STD of both images are computed in one pass over the
+# stacked images. With -diff (or GRE1DNAV_PAIRED_DIFF=1), the slice-wise differences rec-navigated - rec-standard of
+# each metric are also written, as the shards of the pseudo-reconstruction "rec-diff".
+#
+# It requires five arguments:
+# 1. path_processed_data : The path to the processed data directory (output path).
+# 2. subject_id: The ID of the subject. (e.g., sub-01)
+# 3. session_id: The ID of the session. (e.g., ses-01)
+# 4. acquisition_region: The region of acquisition, which can be one of the following:
+#    - acq-upperT: Upper thoracic region
+#    - acq-lowerT: Lower thoracic region
+#    - acq-LSE: Lumbar-sacral region
+# 5. rec: The reconstruction type, which can be one of the following:
+#    - rec-standard: Standard reconstruction
+#    - rec-navigated: Navigated reconstruction
+#    - paired: Both reconstructions
+#
+# How to use:
+#   ./compute_metrics.py <path_processed_data> <subject_id> <session_id> <acquisition_region> <rec> [-save-wm-mask]
+#   ./compute_metrics.py <path_processed_data> <subject_id> <session_id> <acquisition_region> paired
+#                        [-recs rec-navigated rec-standard] [-diff] [-save-wm-mask]
+
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+
+import compute_ghosting
+import compute_snr_cnr
+import compute_wm_std
+from nifti_cache import load_data
+from results_store import get_shard_path, write_shard
+
+# Define variables
+ext = ".nii.gz"
+contrast = "T2starw"
+recs = ["rec-navigated", "rec-standard"]
+env_save_wm_mask = "GRE1DNAV_SAVE_WM_MASK"
+env_paired_diff = "GRE1DNAV_PAIRED_DIFF"
+# Pseudo-reconstruction of the paired differences (rec-navigated - rec-standard), and metrics compared
+rec_diff = "rec-diff"
+diff_metrics = ["cnr", "snr_wm", "snr_gm", "ghosting", "wm_std"]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Computes the slice-wise SNR/CNR, the ghosting metrics and the WM STD metrics of an image in a\
+        single pass."
+    )
+    parser.add_argument("path_processed_data", help="The path to the processed data directory (output path).")
+    parser.add_argument("subject_id", help="ID of the subject (e.g., sub-01).")
+    parser.add_argument("session_id", help="ID of the session (e.g., ses-01).")
+    parser.add_argument("acquisition_region", choices=["acq-upperT", "acq-lowerT", "acq-LSE"],
+                        help="Region of acquisition: acq-upperT, acq-lowerT, or acq-LSE.")
+    parser.add_argument("rec", choices=["rec-standard", "rec-navigated", "paired"],
+                        help="Reconstruction type: rec-standard or rec-navigated, or paired to process the\
+                        reconstructions of the acquisition together.")
+    parser.add_argument("-recs", nargs="+", choices=recs, default=recs,
+                        help="Reconstructions processed in paired mode (default: both).")
+    parser.add_argument("-diff", action="store_true",
+                        help="In paired mode, also write the slice-wise differences rec-navigated - rec-standard.")
+    parser.add_argument("-save-wm-mask", action="store_true",
+                        help="Write the WM mask derived from the SC and GM segmentations to disk.")
+    return parser
+
+
+# Define functions
+def get_input_paths(path_processed_data, subject, session, acq, rec):
+    """Return the paths of the image and of the masks used to compute its metrics."""
+    file_anat = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+    file_navigated = f"{subject}_{session}_{acq}_rec-navigated_{contrast}"
+    path_sub_session = os.path.join(path_processed_data, subject, session, "anat")
+    return {
+        'anat': os.path.join(path_sub_session, file_anat + ext),
+        'sc_mask': os.path.join(path_sub_session, f"{file_navigated}_label-SC_seg{ext}"),
+        'gm_mask': os.path.join(path_sub_session, f"{file_navigated}_label-GM_seg{ext}"),
+        'ghosting_mask': os.path.join(path_sub_session, f"{file_navigated}_ghostingMask{ext}"),
+    }
+
+
+def get_wm_mask_path(path_processed_data, subject, session, acq):
+    """Return the path of the WM mask of an acquisition, written when it is saved (see save_wm_mask)."""
+    file_navigated = f"{subject}_{session}_{acq}_rec-navigated_{contrast}"
+    return os.path.join(path_processed_data, subject, session, "anat", f"{file_navigated}_label-WM_seg{ext}")
+
+
+def is_wm_mask_saved():
+    """Return True if the WM mask is written to disk (environment variable GRE1DNAV_SAVE_WM_MASK)."""
+    return os.environ.get(env_save_wm_mask) == "1"
+
+
+def is_paired_diff_written():
+    """Return True if the paired differences are written (environment variable GRE1DNAV_PAIRED_DIFF)."""
+    return os.environ.get(env_paired_diff) == "1"
+
+
+def get_output_paths(path_processed_data, subject, session, acq, rec, save_wm=False):
+    """
+    Return the paths of the result files written by write_results, and of the WM mask if `save_wm` (navigated image
+    only, see process).
+    """
+    file_anat = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+    path_results = os.path.join(path_processed_data, "..", "results")
+    return [
+        os.path.join(path_results, "CNR", subject, session, f"{file_anat}_results.csv"),
+        os.path.join(path_results, "SNR", subject, session, f"{file_anat}_wm_results.csv"),
+        os.path.join(path_results, "SNR", subject, session, f"{file_anat}_gm_results.csv"),
+    ] + [get_shard_path(path_results, subject, session, acq, rec, metric)
+         for metric in ["cnr", "snr_wm", "snr_gm", "ghosting", "wm_std"]] + (
+        [get_wm_mask_path(path_processed_data, subject, session, acq)] if save_wm and rec == "rec-navigated" else [])
+
+
+def get_paired_input_paths(path_processed_data, subject, session, acq, recs_paired):
+    """Return the paths of the images of the reconstructions of an acquisition, followed by the shared masks."""
+    paths = [get_input_paths(path_processed_data, subject, session, acq, rec) for rec in recs_paired]
+    return [paths_rec['anat'] for paths_rec in paths] + [paths[0][mask]
+                                                         for mask in ['sc_mask', 'gm_mask', 'ghosting_mask']]
+
+
+def get_paired_output_paths(path_processed_data, subject, session, acq, recs_paired, save_wm=False, diff=False):
+    """Return the paths of the result files written by write_paired_results (see get_output_paths)."""
+    path_results = os.path.join(path_processed_data, "..", "results")
+    outputs = [path for rec in recs_paired
+               for path in get_output_paths(path_processed_data, subject, session, acq, rec, save_wm)]
+    if diff and set(recs) <= set(recs_paired):
+        outputs += [get_shard_path(path_results, subject, session, acq, rec_diff, metric) for metric in diff_metrics]
+    return outputs
+
+
+def derive_wm_mask(sc_data, gm_data):
+    """
+    Return the WM mask (SC - GM), as `sct_maths -sub` computes it, but clipped at 0: the GM voxels outside the SC
+    segmentation would otherwise be -1, and counted as WM by the binarized masks of the metrics.
+    """
+    wm_data = np.subtract(sc_data, gm_data, dtype=np.float32)
+    return np.clip(wm_data, 0, None, out=wm_data)
+
+
+def save_wm_mask(wm_data, path_sc_mask, path_wm_mask):
+    """Write the WM mask with the header of the SC segmentation."""
+    nii_sc = nib.load(path_sc_mask)
+    header = nii_sc.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(wm_data, nii_sc.affine, header), path_wm_mask)
+
+
+def compute_metrics(anat_data, wm_data, gm_data, ghosting_mask_data):
+    """Compute all the metrics of an image. Returns a dict with the slice-wise and summary values of each metric."""
+    cnr, snr_wm, snr_gm = compute_snr_cnr.compute_snr_cnr(anat_data, wm_data, gm_data)
+    slice_wise_ghosting, max_ghosting, mean_ghosting = compute_ghosting.compute_ghosting(anat_data, ghosting_mask_data)
+    slice_wise_std, max_std, mean_std = compute_wm_std.compute_wm_std(anat_data, wm_data)
+    return {
+        'cnr': cnr,
+        'snr_wm': snr_wm,
+        'snr_gm': snr_gm,
+        'ghosting': slice_wise_ghosting,
+        'max_ghosting': max_ghosting,
+        'mean_ghosting': mean_ghosting,
+        'wm_std': slice_wise_std,
+        'max_wm_std': max_std,
+        'mean_wm_std': mean_std,
+    }
+
+
+def compute_paired_metrics(anat_stack, wm_data, gm_data, ghosting_mask_data, recs_paired):
+    """
+    Compute all the metrics of the reconstructions of an acquisition, stacked along the last axis of `anat_stack`. The
+    ghosting and WM STD are computed in one pass over the stack, as their masks are shared.
+
+    :return: dict with the metrics of each reconstruction (see compute_metrics)
+    """
+    slice_wise_ghosting, max_ghosting, mean_ghosting = compute_ghosting.compute_ghosting(anat_stack, ghosting_mask_data)
+    slice_wise_std, max_std, mean_std = compute_wm_std.compute_wm_std(anat_stack, wm_data)
+    metrics = {}
+    for i, rec in enumerate(recs_paired):
+        # The SNR/CNR masks exclude the zero voxels of each image, so they are not shared
+        cnr, snr_wm, snr_gm = compute_snr_cnr.compute_snr_cnr(anat_stack[..., i], wm_data, gm_data)
+        metrics[rec] = {
+            'cnr': cnr,
+            'snr_wm': snr_wm,
+            'snr_gm': snr_gm,
+            'ghosting': slice_wise_ghosting[:, i],
+            'max_ghosting': max_ghosting[i],
+            'mean_ghosting': mean_ghosting[i],
+            'wm_std': slice_wise_std[:, i],
+            'max_wm_std': max_std[i],
+            'mean_wm_std': mean_std[i],
+        }
+    return metrics
+
+
+def compute_paired_differences(metrics):
+    """Return the slice-wise differences rec-navigated - rec-standard of each metric."""
+    return {metric: metrics["rec-navigated"][metric] - metrics["rec-standard"][metric] for metric in diff_metrics}
+
+
+def write_results(path_processed_data, subject, session, acq, rec, file_anat, metrics):
+    """Write the metrics to the result files of compute_snr_cnr.py, compute_ghosting.py and compute_wm_std.py."""
+    compute_snr_cnr.write_results(path_processed_data, subject, session, acq, rec, file_anat,
+                                  metrics['cnr'], metrics['snr_wm'], metrics['snr_gm'])
+    compute_ghosting.write_results(path_processed_data, subject, session, acq, rec,
+                                   metrics['ghosting'], metrics['max_ghosting'], metrics['mean_ghosting'])
+    compute_wm_std.write_results(path_processed_data, subject, session, acq, rec,
+                                 metrics['wm_std'], metrics['max_wm_std'], metrics['mean_wm_std'])
+
+
+def write_paired_results(path_processed_data, subject, session, acq, metrics):
+    """Write the metrics of each reconstruction (see write_results), and the paired differences if they exist."""
+    path_results = os.path.join(path_processed_data, "..", "results")
+    for rec, metrics_rec in metrics.items():
+        if rec == rec_diff:
+            for metric, values in metrics_rec.items():
+                write_shard(path_results, subject, session, acq, rec_diff, metric, slice_wise=values)
+        else:
+            file_anat = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+            write_results(path_processed_data, subject, session, acq, rec, file_anat, metrics_rec)
+
+
+def load_masks(path_processed_data, subject, session, acq, save_wm=None):
+    """
+    Load the masks of an acquisition (navigated image) once: the WM mask derived from the SC and GM segmentations, the
+    GM segmentation and the ghosting mask. The WM mask is written to disk if `save_wm` is True (default: see
+    is_wm_mask_saved).
+    """
+    paths = get_input_paths(path_processed_data, subject, session, acq, "rec-navigated")
+    gm_data = load_data(paths['gm_mask'])
+    wm_data = derive_wm_mask(load_data(paths['sc_mask']), gm_data)
+    ghosting_mask_data = load_data(paths['ghosting_mask'])
+    if save_wm is None:
+        save_wm = is_wm_mask_saved()
+    if save_wm:
+        save_wm_mask(wm_data, paths['sc_mask'], get_wm_mask_path(path_processed_data, subject, session, acq))
+    return wm_data, gm_data, ghosting_mask_data
+
+
+def process(path_processed_data, subject, session, acq, rec, write=True, save_wm=None):
+    """
+    Load the files of an image once and compute all its metrics. The metrics are written to the result files, unless
+    `write` is False (e.g., when the caller aggregates the results of several processes). The WM mask is written to disk
+    if `save_wm` is True (default: see is_wm_mask_saved).
+    """
+    file_anat = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+    paths = get_input_paths(path_processed_data, subject, session, acq, rec)
+
+    # Load each nifti file once
+    anat_data = load_data(paths['anat'])
+    # The WM mask is the one of the navigated image: it is only written by the metrics pass of that image
+    wm_data, gm_data, ghosting_mask_data = load_masks(path_processed_data, subject, session, acq,
+                                                      save_wm=save_wm if rec == "rec-navigated" else False)
+
+    # Compute all the metrics and write them to the result files
+    metrics = compute_metrics(anat_data, wm_data, gm_data, ghosting_mask_data)
+    if write:
+        write_results(path_processed_data, subject, session, acq, rec, file_anat, metrics)
+    return metrics
+
+
+def process_paired(path_processed_data, subject, session, acq, recs_paired=recs, write=True, save_wm=None, diff=None):
+    """
+    Load the masks of an acquisition once and compute the metrics of its reconstructions in one pass over the stacked
+    images. The metrics are written to the result files unless `write` is False (see process). The paired differences
+    are computed if `diff` is True (default: see is_paired_diff_written) and both reconstructions are processed.
+
+    :return: dict with the metrics of each reconstruction, and the differences under "rec-diff"
+    """
+    # Load each nifti file once, and stack the images of the reconstructions
+    anat_stack = np.stack([load_data(get_input_paths(path_processed_data, subject, session, acq, rec)['anat'])
+                           for rec in recs_paired], axis=-1)
+    wm_data, gm_data, ghosting_mask_data = load_masks(path_processed_data, subject, session, acq,
+                                                      save_wm=save_wm if "rec-navigated" in recs_paired else False)
+
+    # Compute all the metrics and write them to the result files
+    metrics = compute_paired_metrics(anat_stack, wm_data, gm_data, ghosting_mask_data, recs_paired)
+    if diff is None:
+        diff = is_paired_diff_written()
+    if diff and set(recs) <= set(recs_paired):
+        metrics[rec_diff] = compute_paired_differences(metrics)
+    if write:
+        write_paired_results(path_processed_data, subject, session, acq, metrics)
+    return metrics
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isdir(args.path_processed_data):
+        raise RuntimeError(f"The provided path does not exist.\nProvided path: {args.path_processed_data}")
+    if args.rec == "paired":
+        process_paired(args.path_processed_data, args.subject_id, args.session_id, args.acquisition_region,
+                       args.recs, save_wm=args.save_wm_mask or None, diff=args.diff or None)
+    else:
+        process(args.path_processed_data, args.subject_id, args.session_id, args.acquisition_region, args.rec,
+                save_wm=args.save_wm_mask or None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Computes the slice-wise signal-to-noise ratio (SNR) in the white matter (WM) and gray matter (GM), and the slice-wise
+# contrast-to-noise ratio (CNR) between GM and WM. Each volume is loaded once and the statistics of every axial slice are
+# computed with vectorized reductions, which replaces splitting the volumes with `sct_image -split z` and calling
+# `fslstats`/`bc` once per slice.
+#
+# Metrics follow the definitions previously computed with fslstats (mean and STD of the nonzero voxels inside the mask):
+#   CNR    = (mean_GM - mean_WM) / STD_WM
+#   SNR_WM = mean_WM / STD_WM
+#   SNR_GM = mean_GM / STD_GM
+#
+# It requires six arguments:
+# 1. path_processed_data : The path to the processed data directory (output path).
+# 2. subject_id: The ID of the subject. (e.g., sub-01)
+# 3. session_id: The ID of the session. (e.g., ses-01)
+# 4. file: The anatomical image (without extension) in which the metrics are computed
+# 5. wm_mask: The white matter mask (without extension)
+# 6. gm_mask: The gray matter mask (without extension)
+# It will create the following files:
+#   /PATH/TO/PROCESSED/DATA/results/CNR/SUB-ID/SES-ID/<file>_results.csv
+#   /PATH/TO/PROCESSED/DATA/results/SNR/SUB-ID/SES-ID/<file>_wm_results.csv
+#   /PATH/TO/PROCESSED/DATA/results/SNR/SUB-ID/SES-ID/<file>_gm_results.csv
+# and the corresponding result shards (see results_store.py).
+#
+# How to use:
+#   ./compute_snr_cnr.py <path_processed_data> <subject_id> <session_id> <file> <wm_mask> <gm_mask>
+
+import os
+import numpy as np
+import argparse
+
+from nifti_cache import load_data
+from results_store import write_shard
+from slice_stats import compute_slice_stats
+
+# Define variables
+ext = ".nii.gz"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Computes the slice-wise SNR in the WM and GM, and the slice-wise CNR between GM and WM. The results\
+        are written in CSV files with the following columns: | slice | ID | SNR | or | slice | ID | CNR |"
+    )
+    parser.add_argument("path_processed_data", help="The path to the processed data directory (output path).")
+    parser.add_argument("subject_id", help="ID of the subject (e.g., sub-01).")
+    parser.add_argument("session_id", help="ID of the session (e.g., ses-01).")
+    parser.add_argument("file", help="The anatomical image (without extension) in which the metrics are computed.")
+    parser.add_argument("wm_mask", help="The white matter mask (without extension).")
+    parser.add_argument("gm_mask", help="The gray matter mask (without extension).")
+    return parser
+
+
+# Define functions
+def format_value(val):
+    if val is None or np.isnan(val):
+        return 'nan'
+    return f"{float(val):.5f}"
+
+
+def slice_wise_mean_std(data, mask):
+    """Compute the slice-wise mean and STD of the nonzero voxels of `data` inside `mask` (same as fslstats -M/-S)."""
+    # fslstats uses the unbiased estimator of the variance
+    stats = compute_slice_stats(data, (mask > 0) & (data != 0), ddof=1)
+    return stats['mean'], stats['std']
+
+
+def compute_snr_cnr(anat_data, wm_data, gm_data):
+    """Return the slice-wise CNR, WM SNR and GM SNR."""
+    wm_mean, wm_std = slice_wise_mean_std(anat_data, wm_data)
+    gm_mean, gm_std = slice_wise_mean_std(anat_data, gm_data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cnr = (gm_mean - wm_mean) / wm_std
+        snr_wm = wm_mean / wm_std
+        snr_gm = gm_mean / gm_std
+    return cnr, snr_wm, snr_gm
+
+
+def write_csv(csv_path, file, metric, values):
+    """Write the slice-wise values of a metric in a CSV file."""
+    # Pad the slice number as `seq -w` does
+    width = len(str(len(values) - 1))
+    with open(csv_path, 'w') as f:
+        f.write(f"slice,ID,{metric}\n")
+        for z, val in enumerate(values):
+            f.write(f"{z:0{width}d},{file},{format_value(val)}\n")
+
+
+def write_results(path_processed_data, subject, session, acq, rec, file, cnr, snr_wm, snr_gm):
+    """Write the slice-wise SNR/CNR in the CSV files of the image, and in the shards of the results database."""
+    path_results = os.path.join(path_processed_data, "..", "results")
+    path_cnr = os.path.join(path_results, "CNR", subject, session)
+    path_snr = os.path.join(path_results, "SNR", subject, session)
+    os.makedirs(path_cnr, exist_ok=True)
+    os.makedirs(path_snr, exist_ok=True)
+    write_csv(os.path.join(path_cnr, f"{file}_results.csv"), file, "CNR", cnr)
+    write_csv(os.path.join(path_snr, f"{file}_wm_results.csv"), file, "SNR", snr_wm)
+    write_csv(os.path.join(path_snr, f"{file}_gm_results.csv"), file, "SNR", snr_gm)
+    for metric, values in [("cnr", cnr), ("snr_wm", snr_wm), ("snr_gm", snr_gm)]:
+        write_shard(path_results, subject, session, acq, rec, metric, slice_wise=values)
+
+
+def main():
+    args = get_parser().parse_args()
+    path_processed_data = args.path_processed_data
+    subject = args.subject_id
+    session = args.session_id
+
+    if not os.path.isdir(path_processed_data):
+        raise RuntimeError(f"The provided path does not exist.\nProvided path: {path_processed_data}")
+
+    # Get the acquisition region and the reconstruction from the BIDS entities of the file name
+    entities = dict(entity.split("-", 1) for entity in args.file.split("_") if "-" in entity)
+    acq = f"acq-{entities.get('acq')}"
+    rec = f"rec-{entities.get('rec')}"
+
+    # Define paths
+    path_sub_session = os.path.join(path_processed_data, subject, session, "anat")
+    path_anat = os.path.join(path_sub_session, args.file + ext)
+    path_wm_mask = os.path.join(path_sub_session, args.wm_mask + ext)
+    path_gm_mask = os.path.join(path_sub_session, args.gm_mask + ext)
+
+    # Load the nifti files
+    # The number of slices is given by the shape of the data (i.e., dim3 of the header)
+    anat_data = load_data(path_anat)
+    wm_data = load_data(path_wm_mask)
+    gm_data = load_data(path_gm_mask)
+
+    # Compute slice-wise SNR and CNR
+    cnr, snr_wm, snr_gm = compute_snr_cnr(anat_data, wm_data, gm_data)
+
+    # Write the results to the CSV files
+    write_results(path_processed_data, subject, session, acq, rec, args.file, cnr, snr_wm, snr_gm)
+
+
+if __name__ == "__main__":
+    main()
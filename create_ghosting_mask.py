@@ -3,9 +3,22 @@
 # Create a mask for ghosting analysis. The mask is a 1cm-wide rectangle centered on the spinal cord,
 # extending from the posterior tip of the tissue to the posterior edge of the axial slice FOV (Field of View).
 #
+# If the label of the posterior tip of the body does not exist under derivatives/labels, it is detected automatically
+# on every axial slice from the intensity profiles of the image (see detect_body_posterior_tip), and saved with a JSON
+# sidecar recording the method in the processed data folder: the dataset itself is not modified, and only holds the
+# manual labels. With `-method viewer` (or GRE1DNAV_POSTERIOR_TIP_METHOD=viewer), the tip is instead identified manually
+# with `sct_get_centerline -method viewer` and saved under derivatives/labels, replacing a label of derivatives/labels
+# detected automatically (e.g., by `annotate_posterior_tips.py -method auto`).
+#
+# With `-max-gap N` (or GRE1DNAV_POSTERIOR_TIP_MAX_GAP=N), the axial slices missing from a label are filled by
+# interpolating the tip of the labeled slices along z (or by extending the tip of the nearest labeled slice, at the
+# ends), as long as no gap is longer than N slices. The filled slices are recorded in the JSON sidecar. Otherwise (and
+# by default), a label with a missing slice is removed and has to be identified again.
+#
 # It requires five arguments:
 # 1. path_data: The path to the data directory.
-# 2. path_processed_data : The path to the processed data directory (output path). Defaults to path_data if not provided.
+# 2. path_processed_data : The path to the processed data directory (output path). Defaults to path_data if not provided,
+#    in which case the provenance file (see provenance.py) is saved under path_data/derivatives.
 # 3. subject_id: The ID of the subject. (e.g., sub-01)
 # 4. session_id: The ID of the session. (e.g., ses-01)
 # 5. acquisition_region: The region of acquisition, which can be one of the following:
@@ -14,9 +27,12 @@
 #    - acq-LSE: Lumbar-sacral region
 # It will create the following file:
 #   /PATH/TO/PROCESSED/DATA/SUB-ID/SES-ID/anat/SUB-ID_SES-ID_ACQ-REGION_rec-navigated_T2starw_ghosting_mask.nii.gz
+# and, if the body posterior tip is detected automatically:
+#   /PATH/TO/PROCESSED/DATA/SUB-ID/SES-ID/anat/SUB-ID_SES-ID_ACQ-REGION_rec-navigated_T2starw_label-bodyPosteriorTip_label.nii.gz
 #
 # How to use:
 #   ./create_ghosting_mask.py <path_data> <path_processed_data> <subject_id> <session_id> <acquisition_region>
+#                             [-method auto|viewer] [-max-gap N]
 #
 # Example:
 #   ./create_ghosting_mask.py /path/to/data /path/to/processed/data sub-01 ses-01 acq-lowerT
@@ -32,36 +48,46 @@ import subprocess
 import json
 from datetime import datetime
 
+from nifti_cache import load_data
+from provenance import get_provenance
+
 # Define variables
-username = subprocess.run(['whoami'], capture_output=True, text=True).stdout.strip()
-sct_version = subprocess.run(['sct_version'], capture_output=True, text=True).stdout.strip()
 width_mm = 10  # Width of the mask in millimeters
 ext = ".nii.gz"
 contrast = "T2starw"
+# Automatic detection of the body posterior tip
+env_tip_method = "GRE1DNAV_POSTERIOR_TIP_METHOD"
+tip_methods = ["auto", "viewer"]
+tip_method_auto = "create_ghosting_mask.py automatic detection"
+threshold_fraction = 0.1  # Fraction of the 99th percentile of the image above which a voxel is tissue
+min_tissue_mm = 5  # Minimum thickness of tissue along y, so that the noise and the ghosts in the air are ignored
+# Interpolation of the missing slices of a label
+env_max_gap = "GRE1DNAV_POSTERIOR_TIP_MAX_GAP"
+tip_interpolation = "create_ghosting_mask.py interpolation"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=f"Create a mask for ghosting analysis. The mask is a {int(width_mm/10)}cm-wide rectangle centered\
+        on the spinal cord, extending from the posterior tip of the tissue to the posterior edge of the axial slice FOV (Field of View)."
+    )
+    parser.add_argument("path_data", help="Path to the data directory.")
+    parser.add_argument("path_processed_data", nargs='?', default=None,
+                        help="Path to the processed data directory (output path). Defaults to path_data if not provided.")
+    parser.add_argument("subject_id", help="ID of the subject (e.g., sub-01).")
+    parser.add_argument("session_id", help="ID of the session (e.g., ses-01).")
+    parser.add_argument("acquisition_region", choices=["acq-upperT", "acq-lowerT", "acq-LSE"],
+                        help="Region of acquisition: acq-upperT, acq-lowerT, or acq-LSE.")
+    parser.add_argument("-method", choices=tip_methods, default=None,
+                        help="Method used to identify the posterior tip of the body if its label does not exist: auto\
+                        (automatic detection) or viewer (manual, also replaces an automatic label). Default: the\
+                        environment variable GRE1DNAV_POSTERIOR_TIP_METHOD, or auto.")
+    parser.add_argument("-max-gap", type=int, default=None,
+                        help="Maximum number of consecutive axial slices without label which are filled by\
+                        interpolation of the posterior tip along z. Default: the environment variable\
+                        GRE1DNAV_POSTERIOR_TIP_MAX_GAP, or 0 (a label with a missing slice is removed).")
+    return parser
 
-parser = argparse.ArgumentParser(
-    description=f"Create a mask for ghosting analysis. The mask is a {int(width_mm/10)}cm-wide rectangle centered\
-    on the spinal cord, extending from the posterior tip of the tissue to the posterior edge of the axial slice FOV (Field of View)."
-)
-parser.add_argument("path_data", help="Path to the data directory.")
-parser.add_argument("path_processed_data", nargs='?', default=None,
-                    help="Path to the processed data directory (output path). Defaults to path_data if not provided.")
-parser.add_argument("subject_id", help="ID of the subject (e.g., sub-01).")
-parser.add_argument("session_id", help="ID of the session (e.g., ses-01).")
-parser.add_argument("acquisition_region", choices=["acq-upperT", "acq-lowerT", "acq-LSE"],
-                    help="Region of acquisition: acq-upperT, acq-lowerT, or acq-LSE.")
-args = parser.parse_args()
-
-# Define arguments
-path_data = args.path_data
-path_processed_data = args.path_processed_data if args.path_processed_data else path_data
-subject = args.subject_id
-session = args.session_id
-acq = args.acquisition_region
-
-if not os.path.isdir(path_data):
-    print(f"Error: Provided path does not exist.\nProvided path: {path_data}")
-    sys.exit(1)
 
 # Define functions
 def convert_mm_to_pix(mm_value, nii_img, axis=0):
@@ -69,77 +95,263 @@ def convert_mm_to_pix(mm_value, nii_img, axis=0):
     pixdim = nii_img.header.get_zooms()[axis]
     return int(round((mm_value) / pixdim))
 
-def identify_body_posterior_tip(path_anat, path_body_post_tip, path_body_post_tip_csv=None, path_body_post_tip_json=None):
-    """Identify the posterior tip of the body using SCT."""
-    # Identify the posterior tip of the body if it does not exist
-    if not os.path.exists(path_body_post_tip):
+def get_tip_method():
+    """Return the method used to identify the missing body posterior tips (environment variable, default: auto)."""
+    return os.environ.get(env_tip_method) or "auto"
+
+
+def get_max_gap():
+    """Return the maximum number of consecutive slices filled by interpolation (environment variable, default: 0)."""
+    return int(os.environ.get(env_max_gap) or 0)
+
+
+def is_automatic_label(path_body_post_tip_json):
+    """Return True if the body posterior tip label was detected automatically (see its JSON sidecar)."""
+    if not os.path.exists(path_body_post_tip_json):
+        return False
+    with open(path_body_post_tip_json, 'r') as f:
+        generated_by = json.load(f).get("GeneratedBy") or [{}]
+    return generated_by[0].get("Name") == tip_method_auto
+
+
+def detect_body_posterior_tip(anat_data, half_width_pix, min_tissue_pix):
+    """
+    Detect the posterior tip of the body on every axial slice. The tissue is separated from the air with a threshold
+    relative to the intensity of the image, and the posterior boundary of the body is the first tissue voxel of each
+    column along y (from the posterior edge of the FOV, as in compute_ghosting_mask). The tip is the most posterior
+    point of that boundary within `half_width_pix` of the center of the body along x, and the closest one to the center
+    if the boundary is flat there. Slices without tissue get the tip of the nearest slice.
+
+    :param anat_data: 3D array
+    :param half_width_pix: Half of the width of the search window around the center of the body, in pixels along x
+    :param min_tissue_pix: Minimum number of consecutive tissue voxels along y of the boundary
+    :return: 3D uint8 array with one label per axial slice, and the indices of the slices where the tip was not detected
+             (labeled with the tip of the nearest slice)
+    """
+    nx, ny, nslices = anat_data.shape[:3]
+    data = np.asarray(anat_data, dtype=np.float32)
+
+    # Tissue: voxels above a fraction of the (robust) maximum intensity of the image
+    tissue = data > threshold_fraction * np.percentile(data, 99)
+    # Only keep the voxels followed by `min_tissue_pix` tissue voxels along y, so that the isolated voxels of noise or
+    # ghosting in the air are not taken as the boundary
+    k = max(1, min(min_tissue_pix, ny))
+    cumsum = np.concatenate([np.zeros((nx, 1, nslices), dtype=int), np.cumsum(tissue, axis=1)], axis=1)
+    solid = np.zeros_like(tissue)
+    solid[:, :ny - k + 1] = (cumsum[:, k:] - cumsum[:, :ny - k + 1]) == k
+
+    # Posterior boundary of each (x, z) column (ny if the column has no tissue)
+    columns = solid.any(axis=1)
+    boundary = np.where(columns, np.argmax(solid, axis=1), ny)
+    # Center of the body along x, and most posterior point of the boundary around it
+    x = np.arange(nx)[:, np.newaxis]
+    x_center = np.round((x * columns).sum(axis=0) / np.maximum(columns.sum(axis=0), 1))
+    distance = np.abs(x - x_center)
+    boundary = np.where(distance <= half_width_pix, boundary, ny)
+    # Ties along the boundary are broken toward the center
+    x_tip = np.lexsort((distance, boundary), axis=0)[0]
+    y_tip = boundary[x_tip, np.arange(nslices)]
+
+    detected = y_tip < ny
+    if not detected.any():
+        raise RuntimeError("The posterior tip of the body could not be detected: no tissue was found in the image.")
+    z = np.arange(nslices)
+    z_detected = z[detected]
+    nearest = z_detected[np.abs(z[:, np.newaxis] - z_detected).argmin(axis=1)]
+    labels = np.zeros((nx, ny, nslices), dtype=np.uint8)
+    labels[x_tip[nearest], y_tip[nearest], z] = 1
+    return labels, z[~detected]
+
+
+def write_label_json(path_body_post_tip_json, method, path_output=None, undetected_slices=None):
+    """
+    Write the JSON sidecar of the body posterior tip label, recording the method used to identify it. For the automatic
+    detection, the slices where the tip was not detected (`undetected_slices`) are recorded as "UndetectedSlices".
+    """
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    sidecar = {"SpatialReference": "orig"}
+    if method == "auto":
+        sidecar["GeneratedBy"] = [{
+            "Name": tip_method_auto,
+            "Description": f"Posterior boundary of the tissue (threshold: {threshold_fraction} x 99th percentile of the"
+                           f" image, minimum thickness: {min_tissue_mm} mm), within {width_mm / 2} mm of the center"
+                           f" of the body. The slices where it was not detected take the tip of the nearest slice.",
+            "Date": date,
+        }]
+        sidecar["UndetectedSlices"] = [int(z) for z in (undetected_slices if undetected_slices is not None else [])]
+    else:
+        provenance = get_provenance(path_output)
+        sidecar["GeneratedBy"] = [
+            {"Name": "sct_get_centerline -method viewer", "Version": f"SCT {provenance['sct_version']}"},
+            {"Name": "Manual", "Author": provenance['username'], "Date": date},
+        ]
+    with open(path_body_post_tip_json, 'w') as f:
+        json.dump(sidecar, f, indent=4)
+
+
+def save_detected_body_posterior_tip(path_anat, path_body_post_tip, path_body_post_tip_json):
+    """Detect the posterior tip of the body (see detect_body_posterior_tip), and save the label and its JSON sidecar."""
+    nii_anat = nib.load(path_anat)
+    half_width_pix = convert_mm_to_pix(width_mm / 2, nii_anat, axis=0)
+    min_tissue_pix = convert_mm_to_pix(min_tissue_mm, nii_anat, axis=1)
+    labels, undetected_slices = detect_body_posterior_tip(load_data(path_anat), half_width_pix, min_tissue_pix)
+    if len(undetected_slices):
+        print(f"Warning: The posterior tip of the body was not detected in slice(s)"
+              f" {', '.join(map(str, undetected_slices))}. The tip of the nearest slice is used.")
+    os.makedirs(os.path.dirname(path_body_post_tip), exist_ok=True)
+    nib.save(nib.Nifti1Image(labels, nii_anat.affine, nii_anat.header), path_body_post_tip)
+    write_label_json(path_body_post_tip_json, "auto", undetected_slices=undetected_slices)
+
+
+def get_empty_slices(data_body_post_tip):
+    """Return the indices of the axial slices without body posterior tip label."""
+    return np.flatnonzero(~np.any(np.asarray(data_body_post_tip) > 0, axis=(0, 1)))
+
+
+def get_longest_gap(empty_slices):
+    """Return the length of the longest run of consecutive slices in `empty_slices` (sorted indices)."""
+    if not len(empty_slices):
+        return 0
+    breaks = np.flatnonzero(np.diff(empty_slices) != 1) + 1
+    return int(np.diff(np.concatenate([[0], breaks, [len(empty_slices)]])).max())
+
+
+def interpolate_body_posterior_tip(data_body_post_tip, empty_slices):
+    """
+    Fill the empty axial slices of a body posterior tip label: the coordinates of the tip are interpolated linearly
+    along z between the labeled slices, and the tip of the nearest labeled slice is used before the first one and after
+    the last one.
+
+    :param data_body_post_tip: 3D array with the body posterior tip labels (one nonzero voxel per labeled slice)
+    :param empty_slices: Indices of the slices without label (see get_empty_slices)
+    :return: 3D uint8 array with one label per axial slice
+    """
+    labels = (np.asarray(data_body_post_tip) > 0).astype(np.uint8)
+    # Tip of every labeled slice, as in compute_ghosting_mask
+    z_tip, x_tip, y_tip = np.nonzero(np.moveaxis(labels, 2, 0))
+    z_tip, first = np.unique(z_tip, return_index=True)
+    x_fill = np.rint(np.interp(empty_slices, z_tip, x_tip[first])).astype(int)
+    y_fill = np.rint(np.interp(empty_slices, z_tip, y_tip[first])).astype(int)
+    labels[x_fill, y_fill, empty_slices] = 1
+    return labels
+
+
+def fill_body_posterior_tip(path_body_post_tip, path_body_post_tip_json, empty_slices):
+    """
+    Fill the empty slices of a body posterior tip label (see interpolate_body_posterior_tip), and record them in its
+    JSON sidecar.
+    """
+    nii_label = nib.load(path_body_post_tip)
+    labels = interpolate_body_posterior_tip(load_data(path_body_post_tip), empty_slices)
+    nib.save(nib.Nifti1Image(labels, nii_label.affine, nii_label.header), path_body_post_tip)
+    with open(path_body_post_tip_json, 'r') as f:
+        sidecar = json.load(f)
+    sidecar["InterpolatedSlices"] = sorted(set(sidecar.get("InterpolatedSlices", [])) | set(empty_slices.tolist()))
+    sidecar.setdefault("GeneratedBy", []).append({
+        "Name": tip_interpolation,
+        "Description": f"Tip of the axial slices {', '.join(map(str, empty_slices))} interpolated along z",
+        "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    with open(path_body_post_tip_json, 'w') as f:
+        json.dump(sidecar, f, indent=4)
+
+
+def identify_body_posterior_tip(path_anat, path_body_post_tip, path_body_post_tip_csv=None, path_body_post_tip_json=None,
+                                path_output=None, method=None, max_gap=None, path_body_post_tip_auto=None,
+                                path_body_post_tip_auto_json=None):
+    """
+    Identify the posterior tip of the body if its label does not exist: automatically (see detect_body_posterior_tip),
+    or with the viewer of SCT if `method` is "viewer" (default: see get_tip_method). The viewer also replaces a label
+    detected automatically. The user name and SCT version written in the JSON file are read from the provenance file of
+    `path_output` (see provenance.py).
+
+    The label detected automatically is saved to `path_body_post_tip_auto` (e.g., in the processed data folder) if it is
+    given, so that `path_body_post_tip` (the manual label of the dataset) is only written by the viewer. Otherwise, it
+    is saved to `path_body_post_tip`.
+
+    The empty axial slices of the label are filled if no gap is longer than `max_gap` slices (default: see get_max_gap,
+    and fill_body_posterior_tip). Otherwise, the label is removed.
+
+    :return: Path of the label of the body posterior tip
+    """
+    if method is None:
+        method = get_tip_method()
+    if max_gap is None:
+        max_gap = get_max_gap()
+    refine = method == "viewer" and is_automatic_label(path_body_post_tip_json)
+    if method == "viewer" and (not os.path.exists(path_body_post_tip) or refine):
+        os.makedirs(os.path.dirname(path_body_post_tip), exist_ok=True)
+        if os.path.exists(path_body_post_tip):
+            os.remove(path_body_post_tip)
         subprocess.run(['sct_get_centerline', '-i', path_anat, '-method', 'viewer', '-gap', '20.0', '-o', path_body_post_tip], text=True, check=True)
+        write_label_json(path_body_post_tip_json, method, path_output)
+    elif not os.path.exists(path_body_post_tip):
+        if path_body_post_tip_auto is not None:
+            path_body_post_tip, path_body_post_tip_json = path_body_post_tip_auto, path_body_post_tip_auto_json
+        save_detected_body_posterior_tip(path_anat, path_body_post_tip, path_body_post_tip_json)
     # Remove the CSV file if it exists
     if os.path.exists(path_body_post_tip_csv):
         os.remove(path_body_post_tip_csv)
     # Create the JSON file if it does not exist
     if not os.path.exists(path_body_post_tip_json):
-        with open(path_body_post_tip_json, 'w') as f:
-            json_content = {
-            "SpatialReference": "orig",
-            "GeneratedBy": [
-                {
-                "Name": "sct_get_centerline -method viewer",
-                "Version": f"SCT {sct_version}"
-                },
-                { 
-                "Name": "Manual",
-                "Author": username,
-                "Date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-            ]
-        }
-        json.dump(json_content, f, indent=4)
+        write_label_json(path_body_post_tip_json, "viewer", path_output)
     # Check if any axial slice is empty
-    mask_nii = nib.load(path_body_post_tip)
-    mask_data = mask_nii.get_fdata()
-    nslices = mask_data.shape[2]
-    for slice in range(nslices):
-        if np.sum(mask_data[:, :, slice]) == 0:
-            print(f"Error: Empty mask detected in slice {slice}. Removing label files and exiting.")
-            # Remove the label files
-            for path in [path_body_post_tip, path_body_post_tip_json]:
-                if os.path.exists(path):
-                    os.remove(path)
-            raise RuntimeError("To ensure that the ghosting mask covers all axial slices, please press the up arrow key (↑) before selecting the first label. " \
-                               "Please try again.")
+    mask_data = load_data(path_body_post_tip)
+    empty_slices = get_empty_slices(mask_data)
+    longest_gap = get_longest_gap(empty_slices)
+    if len(empty_slices) and longest_gap <= max_gap and len(empty_slices) < mask_data.shape[2]:
+        print(f"Warning: Empty mask detected in slice(s) {', '.join(map(str, empty_slices))}. Filling them by"
+              f" interpolation.")
+        fill_body_posterior_tip(path_body_post_tip, path_body_post_tip_json, empty_slices)
+    elif len(empty_slices):
+        if max_gap:
+            print(f"Error: {longest_gap} consecutive empty slices, more than the maximum of {max_gap} filled by"
+                  f" interpolation.")
+        print(f"Error: Empty mask detected in slice {empty_slices[0]}. Removing label files and exiting.")
+        # Remove the label files
+        for path in [path_body_post_tip, path_body_post_tip_json]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise RuntimeError("To ensure that the ghosting mask covers all axial slices, please press the up arrow key (↑) before selecting the first label. " \
+                           "Please try again.")
+    return path_body_post_tip
         
-def create_ghosting_mask(path_anat, path_body_post_tip, path_ghosting_mask):
+def compute_ghosting_mask(data_body_post_tip, shape, half_width_pix):
+    """
+    Compute the ghosting mask from the body posterior tip labels.
+
+    :param data_body_post_tip: 3D array with the body posterior tip labels (one nonzero voxel per axial slice)
+    :param shape: Shape of the ghosting mask (i.e., of the anatomical image)
+    :param half_width_pix: Half of the width of the mask, in pixels along x
+    :return: 3D uint8 array
+    """
+    nx, ny, nslices = shape[:3]
+
+    # Find the coordinates of the body posterior tip of every slice in one pass
+    # The voxels are sorted by slice, so the first voxel of each slice is the same as np.argwhere(data[:, :, z] > 0)[0]
+    z_tip, x_tip, y_tip = np.nonzero(np.moveaxis(data_body_post_tip > 0, 2, 0))
+    z_tip, first = np.unique(z_tip, return_index=True)
+
+    # Define the size of the mask of each slice: centered on the tip along x, and from the posterior edge of the FOV to
+    # the tip along y. Slices without tip get an empty mask.
+    x_start = np.zeros(nslices, dtype=int)
+    x_end = np.zeros(nslices, dtype=int)
+    y_end = np.zeros(nslices, dtype=int)
+    x_start[z_tip] = np.maximum(x_tip[first] - half_width_pix, 0)
+    x_end[z_tip] = x_tip[first] + half_width_pix
+    y_end[z_tip] = y_tip[first]
+
+    # Fill the rectangles of all slices at once
+    x = np.arange(nx)[:, np.newaxis, np.newaxis]
+    y = np.arange(ny)[np.newaxis, :, np.newaxis]
+    return ((x >= x_start) & (x < x_end) & (y < y_end)).astype(np.uint8)
+
+def create_ghosting_mask(path_anat, path_body_post_tip, path_ghosting_mask, width_mm=width_mm):
     """Create the ghosting mask."""
-    # Create the ghosting mask
-    # Loop through each slice along the z-axis
+    # Only the header of the anatomical image is needed (the data is not read)
     nii_anat = nib.load(path_anat)
-    data_anat = nii_anat.get_fdata()
-    nslices = data_anat.shape[2]
-    for z in range(nslices):
-        # Find the coordinates of the body posterior tip for this slice
-        nii_body_post_tip = nib.load(path_body_post_tip)
-        data_centreline = nii_body_post_tip.get_fdata()
-        body_post_tip_coords = np.argwhere(data_centreline[:, :, z] > 0)
-        if body_post_tip_coords.size == 0:
-            continue  # No tip found for this slice
-
-        # Define the center of the mask with the tip coordinates
-        x_center = int(body_post_tip_coords[0][0])
-        # Define the y-axis limit based on the tip coordinates
-        y_limit = int(body_post_tip_coords[0][1])
-
-        # Define the size of the mask
-        half_width_pix = convert_mm_to_pix(width_mm, nii_anat, axis=0)
-        x_start = x_center - half_width_pix
-        x_end = x_center + half_width_pix
-        y_start = 0
-        y_end = y_limit
-
-        # Create the ghosting mask for this slice
-        if z == 0:
-            ghosting_mask = np.zeros_like(data_anat, dtype=np.uint8)
-        ghosting_mask[x_start:x_end, y_start:y_end, z] = 1
+    half_width_pix = convert_mm_to_pix(width_mm, nii_anat, axis=0)
+    ghosting_mask = compute_ghosting_mask(load_data(path_body_post_tip), nii_anat.shape, half_width_pix)
 
     # Save the ghosting mask
     nii_ghosting_mask = nib.Nifti1Image(ghosting_mask, nii_anat.affine, nii_anat.header)
@@ -148,25 +360,68 @@ def create_ghosting_mask(path_anat, path_body_post_tip, path_ghosting_mask):
     # Print output path and instructions to view the results
     print(f"\nDone! The ghosting mask has been created and saved at:\n{path_ghosting_mask}\n\nTo view results, type:\nfsleyes {path_anat} -cm greyscale {path_ghosting_mask} -cm blue -a 50\n")
   
-def main():
+def get_paths(path_data, path_processed_data, subject, session, acq):
+    """Return the paths of the input and output files of an acquisition."""
     # Define file names
     file_anat = f"{subject}_{session}_{acq}_rec-navigated_{contrast}"
-    file_seg = f"{file_anat}_seg"
     file_body_post_tip = f"{file_anat}_label-bodyPosteriorTip_label"
     file_ghosting_mask = f"{file_anat}_ghostingMask"
 
     # Define paths
-    path_anat = os.path.join(path_data, subject, session, "anat", file_anat + ext)
-    path_body_post_tip = os.path.join(path_data, "derivatives", "labels", subject, session, "anat", file_body_post_tip + ext)
-    path_body_post_tip_csv = os.path.join(path_data, "derivatives", "labels", subject, session, "anat", file_body_post_tip + ".csv")
-    path_body_post_tip_json = os.path.join(path_data, "derivatives", "labels", subject, session, "anat", file_body_post_tip + ".json")
-    path_ghosting_mask = os.path.join(path_processed_data, subject, session, "anat", file_ghosting_mask + ext)
+    path_labels = os.path.join(path_data, "derivatives", "labels", subject, session, "anat")
+    path_processed_anat = os.path.join(path_processed_data, subject, session, "anat")
+    return {
+        'anat': os.path.join(path_data, subject, session, "anat", file_anat + ext),
+        'body_post_tip': os.path.join(path_labels, file_body_post_tip + ext),
+        'body_post_tip_csv': os.path.join(path_labels, file_body_post_tip + ".csv"),
+        'body_post_tip_json': os.path.join(path_labels, file_body_post_tip + ".json"),
+        'body_post_tip_auto': os.path.join(path_processed_anat, file_body_post_tip + ext),
+        'body_post_tip_auto_json': os.path.join(path_processed_anat, file_body_post_tip + ".json"),
+        'ghosting_mask': os.path.join(path_processed_anat, file_ghosting_mask + ext),
+    }
+
+
+def get_output_path(path_data, path_processed_data):
+    """
+    Return the output folder holding the provenance file (see provenance.py): the output folder of the batch, i.e., the
+    parent of the processed data folder, or the derivatives of the dataset if the processed data folder is the dataset
+    itself (so that nothing is written next to the dataset).
+    """
+    if os.path.realpath(path_processed_data) == os.path.realpath(path_data):
+        return os.path.join(path_data, "derivatives")
+    return os.path.join(path_processed_data, "..")
+
 
-    # Identify the posterior tip of the body
-    identify_body_posterior_tip(path_anat, path_body_post_tip, path_body_post_tip_csv, path_body_post_tip_json)
+def process(path_data, path_processed_data, subject, session, acq, method=None, max_gap=None):
+    """
+    Identify the posterior tip of the body (see identify_body_posterior_tip for `method` and `max_gap`) and create the
+    ghosting mask of an acquisition.
+    """
+    paths = get_paths(path_data, path_processed_data, subject, session, acq)
+
+    # Identify the posterior tip of the body (the labels detected automatically are saved in the processed data folder)
+    path_body_post_tip = identify_body_posterior_tip(
+        paths['anat'], paths['body_post_tip'], paths['body_post_tip_csv'], paths['body_post_tip_json'],
+        path_output=get_output_path(path_data, path_processed_data), method=method, max_gap=max_gap,
+        path_body_post_tip_auto=paths['body_post_tip_auto'], path_body_post_tip_auto_json=paths['body_post_tip_auto_json'])
 
     # Create the ghosting mask
-    create_ghosting_mask(path_anat, path_body_post_tip, path_ghosting_mask)
+    create_ghosting_mask(paths['anat'], path_body_post_tip, paths['ghosting_mask'])
+    return paths['ghosting_mask']
+
+def main():
+    args = get_parser().parse_args()
+
+    # Define arguments
+    path_data = args.path_data
+    path_processed_data = args.path_processed_data if args.path_processed_data else path_data
+
+    if not os.path.isdir(path_data):
+        print(f"Error: Provided path does not exist.\nProvided path: {path_data}")
+        sys.exit(1)
+
+    process(path_data, path_processed_data, args.subject_id, args.session_id, args.acquisition_region,
+            method=args.method, max_gap=args.max_gap)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+#
+# Index of the dataset, built once per batch. The BIDS tree is scanned once (the sessions are scanned in parallel, and
+# only the headers of the images are read), and the index lists, for each subject/session, the T2starw images of each
+# acquisition region and reconstruction with their shape, voxel size and affine, and their manual labels available under
+# derivatives/labels. The index is saved to:
+#   /PATH/TO/OUTPUT/dataset_index.json
+# and the later stages query it instead of probing the file names again.
+#
+# The index also stores the modification time of the scanned folders: if a file was added to or removed from one of
+# them (e.g., a new manual label) since the index was built, only the subjects/sessions whose folders changed are scanned
+# again, and merged into the saved index. The headers of the images which did not change are not read again. The whole
+# dataset is only checked when the index is loaded for the batch (e.g., by run_batch.py): a job querying its own
+# subject/session (-session) only checks the folders of that subject/session, and writes them to a small JSON extract
+# (-extract) which the later stages of the job read instead of the index.
+#
+# It requires two arguments:
+# 1. path_data: The path to the BIDS dataset.
+# 2. path_output: The path to the output directory of the batch (i.e., the parent of the processed data directory).
+#
+# How to use:
+#   ./dataset_index.py <path_data> <path_output> [-session SUB-ID/SES-ID [-extract <path_extract>]] [-refresh]
+# With -session, the acquisition regions of the subject/session are printed one per line, followed by their
+# reconstructions (e.g., "acq acq-LSE rec-navigated rec-standard"), and so are its manual labels: name of the label
+# (without extension) and absolute path (e.g., "label <file>_label-SC_seg /PATH/TO/LABEL").
+#
+# Example:
+#   ./dataset_index.py ~/data/ds006347 ~/temp/ds006347_20250612_144520 -session sub-01/ses-01
+
+import os
+import re
+import json
+import fcntl
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from file_utils import write_atomic
+
+# Define variables
+file_index = "dataset_index.json"
+ext = ".nii.gz"
+contrast = "T2starw"
+acqs = ["acq-upperT", "acq-lowerT", "acq-LSE"]
+recs = ["rec-navigated", "rec-standard"]
+max_workers = 16
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Build the index of the images and manual labels of the dataset (once per batch), or query it."
+    )
+    parser.add_argument("path_data", help="The path to the BIDS dataset.")
+    parser.add_argument("path_output", help="The path to the output directory of the batch.")
+    parser.add_argument("-session", metavar="SUB-ID/SES-ID",
+                        help="Only check this subject/session, and print its acquisition regions (followed by their\
+                        reconstructions) and its manual labels (name without extension and path).")
+    parser.add_argument("-extract", help="Write the entry of the subject/session (-session) to this JSON file.")
+    parser.add_argument("-refresh", action="store_true", help="Build the index again, even if it is up to date.")
+    return parser
+
+
+# Define functions
+def get_session_dirs(path_data, subject_session):
+    """Return the folders scanned for a subject/session: the images and the manual labels."""
+    return [os.path.join(path_data, subject_session, "anat"),
+            os.path.join(path_data, "derivatives", "labels", subject_session, "anat")]
+
+
+def get_dir_mtime(path):
+    """Return the modification time of a folder, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def list_files(path):
+    """Return the names of the files of a folder (empty if it does not exist)."""
+    try:
+        return sorted(entry.name for entry in os.scandir(path) if entry.is_file())
+    except FileNotFoundError:
+        return []
+
+
+def read_image_info(path):
+    """Return the size and modification time of an image, and its shape, voxel size and affine (header only)."""
+    # Only imported when a header is read, so that the queries of an up-to-date index do not pay for it
+    import nibabel as nib
+    stat = os.stat(path)
+    nii = nib.load(path)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'shape': [int(dim) for dim in nii.shape],
+        'zooms': [float(zoom) for zoom in nii.header.get_zooms()],
+        'affine': nii.affine.tolist(),
+    }
+
+
+def scan_session(path_data, subject_session, previous=None):
+    """
+    Return the images of a subject/session, with their header information and their manual labels. The header
+    information of the images which did not change (same size and modification time) since the `previous` scan of the
+    session is reused.
+    """
+    subject, session = subject_session.split("/")
+    # The modification times are read before the folders, so that a file added during the scan is found next time
+    dirs = {path: get_dir_mtime(path) for path in get_session_dirs(path_data, subject_session)}
+    path_anat, path_labels = get_session_dirs(path_data, subject_session)
+    previous_entries = {entry['file']: entry for images_acq in (previous or {}).get('images', {}).values()
+                        for entry in images_acq.values()}
+    files_labels = list_files(path_labels)
+    pattern = re.compile(rf"^{subject}_{session}_(acq-[^_]+)_(rec-[^_]+)_{contrast}{re.escape(ext)}$")
+    images = {}
+    for file in list_files(path_anat):
+        match = pattern.match(file)
+        if match is None or match.group(1) not in acqs or match.group(2) not in recs:
+            continue
+        acq, rec = match.groups()
+        file_anat = file[:-len(ext)]
+        path_file = os.path.join(subject_session, "anat", file)
+        entry = previous_entries.get(path_file)
+        stat = os.stat(os.path.join(path_anat, file))
+        if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            entry = {key: entry[key] for key in ['size', 'mtime_ns', 'shape', 'zooms', 'affine']}
+        else:
+            entry = read_image_info(os.path.join(path_anat, file))
+        entry['file'] = path_file
+        # Manual labels, keyed by their suffix (e.g., "label-SC_seg", "label-bodyPosteriorTip_label")
+        entry['labels'] = {
+            file_label[len(file_anat) + 1:-len(ext)]: os.path.join("derivatives", "labels", subject_session, "anat",
+                                                                    file_label)
+            for file_label in files_labels if file_label.startswith(file_anat + "_") and file_label.endswith(ext)
+        }
+        images.setdefault(acq, {})[rec] = entry
+    # Sort the acquisition regions and reconstructions in the processing order
+    return {
+        'dirs': dirs,
+        'images': {acq: {rec: images[acq][rec] for rec in recs if rec in images[acq]}
+                   for acq in acqs if acq in images},
+    }
+
+
+def build_index(path_data, index=None):
+    """
+    Scan the dataset, reading the sessions in parallel. If the previous `index` of the dataset is given, only the
+    subjects/sessions which are new or whose folders changed are scanned again (see scan_session), and the other ones
+    are taken from it.
+    """
+    path_data = os.path.abspath(path_data)
+    if index is not None and index.get('path_data') != path_data:
+        index = None
+    previous = index['sessions'] if index is not None else {}
+    subjects = sorted(entry.name for entry in os.scandir(path_data) if entry.is_dir() and entry.name.startswith("sub-"))
+    dirs = {path: get_dir_mtime(path) for path in [path_data] + [os.path.join(path_data, subject)
+                                                                for subject in subjects]}
+    sessions = sorted(f"{subject}/{entry.name}" for subject in subjects
+                      for entry in os.scandir(os.path.join(path_data, subject))
+                      if entry.is_dir() and entry.name.startswith("ses-"))
+    sessions_scanned = [subject_session for subject_session in sessions
+                        if subject_session not in previous or not is_session_up_to_date(previous[subject_session])]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scanned = dict(zip(sessions_scanned, executor.map(
+            lambda subject_session: scan_session(path_data, subject_session, previous.get(subject_session)),
+            sessions_scanned)))
+    return {
+        'path_data': path_data,
+        'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'dirs': dirs,
+        'sessions': {subject_session: scanned.get(subject_session) or previous[subject_session]
+                     for subject_session in sessions},
+    }
+
+
+def is_session_up_to_date(session_index):
+    """Return True if no file was added to or removed from the folders of a subject/session since it was scanned."""
+    return all(get_dir_mtime(path) == mtime for path, mtime in session_index['dirs'].items())
+
+
+def is_up_to_date(index, path_data):
+    """Return True if no file was added to or removed from the folders scanned by the index."""
+    if index.get('path_data') != os.path.abspath(path_data):
+        return False
+    return (all(get_dir_mtime(path) == mtime for path, mtime in index['dirs'].items())
+            and all(is_session_up_to_date(session_index) for session_index in index['sessions'].values()))
+
+
+def update_sessions(path_data, index, sessions):
+    """Scan the given subjects/sessions again (see scan_session), and merge them into the index."""
+    sessions = [subject_session for subject_session in sessions
+                if os.path.isdir(os.path.join(path_data, subject_session))]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scanned = dict(zip(sessions, executor.map(
+            lambda subject_session: scan_session(path_data, subject_session, index['sessions'].get(subject_session)),
+            sessions)))
+    index['sessions'] = dict(sorted({**index['sessions'], **scanned}.items()))
+    return index
+
+
+def get_index(path_data, path_output=None, refresh=False, sessions=None):
+    """
+    Return the index of the dataset. It is only built if the index file of `path_output` does not exist, or if `refresh`
+    is True. If it is out of date, only the subjects/sessions which changed are scanned again (see build_index). If
+    `path_output` is None, the index is built without being saved.
+
+    If `sessions` is given (e.g., ['sub-01/ses-01'] for a job of the batch), only the folders of these subjects/sessions
+    are checked, and scanned again if they changed: the rest of the dataset is assumed to be up to date, as it was
+    checked when the index was loaded for the batch.
+    """
+    if path_output is None:
+        return build_index(path_data)
+    path_index = os.path.join(path_output, file_index)
+    os.makedirs(path_output, exist_ok=True)
+    # Only one job of the batch builds the index, the other ones wait and read it
+    with open(path_index + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = None
+        if not refresh and os.path.exists(path_index):
+            with open(path_index, 'r') as f:
+                index = json.load(f)
+            if index.get('path_data') != os.path.abspath(path_data):
+                index = None
+            elif sessions is not None:
+                sessions_changed = [subject_session for subject_session in sessions
+                                    if subject_session not in index['sessions']
+                                    or not is_session_up_to_date(index['sessions'][subject_session])]
+                if not sessions_changed:
+                    return index
+                index = update_sessions(index['path_data'], index, sessions_changed)
+                write_atomic(path_index, json.dumps(index, indent=4))
+                return index
+            elif is_up_to_date(index, path_data):
+                return index
+        index = build_index(path_data, index)
+        write_atomic(path_index, json.dumps(index, indent=4))
+    return index
+
+
+def write_extract(index, subject_session, path_extract):
+    """Write the entry of a subject/session of the index to a JSON file (see read_extract)."""
+    extract = {'path_data': index['path_data'], 'sessions': {subject_session: index['sessions'][subject_session]}}
+    os.makedirs(os.path.dirname(path_extract) or ".", exist_ok=True)
+    write_atomic(path_extract, json.dumps(extract, indent=4))
+
+
+def read_extract(path_extract):
+    """Read the extract of a subject/session (see write_extract), which can be queried as the index."""
+    with open(path_extract, 'r') as f:
+        return json.load(f)
+
+
+def get_sessions(index, include_list=None):
+    """Return the subjects/sessions of the index (e.g., ['sub-01/ses-01', ...])."""
+    sessions = sorted(index['sessions'])
+    if include_list:
+        sessions = [subject_session for subject_session in sessions if subject_session in include_list]
+    return sessions
+
+
+def get_images(index, subject_session):
+    """Return the images of a subject/session: {acq: {rec: entry}}, in the processing order."""
+    return index['sessions'][subject_session]['images']
+
+
+def get_label_path(path_data, entry, suffix):
+    """Return the absolute path of a manual label of an image (e.g., suffix="label-SC_seg"), or None."""
+    path_label = entry['labels'].get(suffix)
+    return os.path.join(path_data, path_label) if path_label else None
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isdir(args.path_data):
+        raise RuntimeError(f"The provided path does not exist.\nProvided path: {args.path_data}")
+    index = get_index(args.path_data, args.path_output, refresh=args.refresh,
+                      sessions=[args.session] if args.session else None)
+    if args.session:
+        if args.session not in index['sessions']:
+            raise RuntimeError(f"The subject/session does not exist in the dataset: {args.session}")
+        if args.extract:
+            write_extract(index, args.session, args.extract)
+        images = get_images(index, args.session)
+        for acq, images_acq in images.items():
+            print(" ".join(["acq", acq] + list(images_acq)))
+        for images_acq in images.values():
+            for entry in images_acq.values():
+                file_anat = os.path.basename(entry['file'])[:-len(ext)]
+                for suffix in entry['labels']:
+                    print(f"label {file_anat}_{suffix} {get_label_path(index['path_data'], entry, suffix)}")
+    else:
+        n_images = sum(len(images) for session_index in index['sessions'].values()
+                       for images in session_index['images'].values())
+        print(f"{len(index['sessions'])} subjects/sessions, {n_images} images: "
+              f"{os.path.join(args.path_output, file_index)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# Opt-in, cross-run, content-addressed cache of the expensive derivatives (automatic SC/GM segmentations).
+#
+# The output folders of the batches are usually timestamped, so the derivatives of a new batch are computed again from
+# scratch. With the cache enabled, each derivative is stored under a key computed from the content of its input images
+# and from the tool, its version and its arguments. When the same derivative is requested again (e.g., by a new batch),
+# it is hard linked from the cache (or copied if the cache is on another filesystem) instead of running the tool. When
+# the cache exceeds its maximum size, the least recently used entries are removed.
+#
+# The cache is enabled by setting the following environment variables (e.g., before running sct_run_batch):
+#   GRE1DNAV_DERIVATIVE_CACHE: Path to the cache folder.
+#   GRE1DNAV_DERIVATIVE_CACHE_SIZE_GB: Maximum size of the cache in GB (default: 20).
+#
+# How to use:
+#   ./derivative_cache.py fetch <output> -inputs IN [IN ...] -params KEY=VALUE [KEY=VALUE ...]
+#   ./derivative_cache.py store <output> -inputs IN [IN ...] -params KEY=VALUE [KEY=VALUE ...]
+# `fetch` exits with status 0 if the output was found in the cache (and linked to <output>), and 1 otherwise (including
+# when the cache is disabled). `store` does nothing if the cache is disabled. `fetch` always removes an existing <output>
+# first, even when the cache is disabled, as it may be hard linked to a cache entry by a previous run: the tool then
+# writes a new file instead of overwriting the cache entry in place.
+#
+# As the derivatives are hard linked, they should not be edited in place in the output folder: save a corrected
+# segmentation under derivatives/labels instead, as for the other manual segmentations.
+#
+# Example:
+#   ./derivative_cache.py fetch sub-01_ses-01_acq-LSE_rec-navigated_T2starw_label-SC_seg.nii.gz \
+#       -inputs sub-01_ses-01_acq-LSE_rec-navigated_T2starw.nii.gz -params tool=sct_deepseg_spinalcord sct_version=7.0
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+from file_utils import hash_file
+
+# Define variables
+file_entry = "derivative"
+env_cache_dir = "GRE1DNAV_DERIVATIVE_CACHE"
+env_cache_size = "GRE1DNAV_DERIVATIVE_CACHE_SIZE_GB"
+default_cache_size_gb = 20
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Fetch a derivative from the content-addressed cache, or store it after it was computed."
+    )
+    parser.add_argument("action", choices=["fetch", "store"],
+                        help="fetch: link the cached derivative to the output, exit with status 1 if it is not cached.\
+                        store: add the output to the cache.")
+    parser.add_argument("path_output", help="Path to the derivative.")
+    parser.add_argument("-inputs", nargs="+", required=True, help="Input images of the derivative.")
+    parser.add_argument("-params", nargs="+", default=[], metavar="KEY=VALUE",
+                        help="Tool, version and arguments used to compute the derivative.")
+    return parser
+
+
+# Define functions
+def get_cache_dir():
+    """Return the cache folder, or None if the cache is disabled."""
+    return os.environ.get(env_cache_dir) or None
+
+
+def get_key(inputs, params):
+    """Return the key of a derivative, computed from the content of its inputs and from the tool parameters."""
+    content = {
+        'inputs': [hash_file(path) for path in inputs],
+        'params': {key: str(value) for key, value in params.items()},
+    }
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def get_entry_path(cache_dir, key):
+    """Return the folder of a cache entry. The folder contains the derivative, and its mtime is the time of last use."""
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def link_or_copy(path_src, path_dst):
+    """Hard link a file, or copy it if the source and the destination are on different filesystems."""
+    path_tmp = f"{path_dst}.tmp{os.getpid()}"
+    try:
+        os.link(path_src, path_tmp)
+    except OSError:
+        shutil.copy2(path_src, path_tmp)
+    os.replace(path_tmp, path_dst)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache is smaller than `max_size` bytes."""
+    entries = []
+    for path_entry in [entry.path for prefix in os.scandir(cache_dir) if prefix.is_dir()
+                       for entry in os.scandir(prefix.path)]:
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(path_entry))
+            entries.append((os.stat(path_entry).st_mtime, size, path_entry))
+        except FileNotFoundError:
+            continue  # Removed by another process
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path_entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(path_entry, ignore_errors=True)
+        total_size -= size
+
+
+def contains(key):
+    """Return True if the cache is enabled and contains the key."""
+    cache_dir = get_cache_dir()
+    return cache_dir is not None and os.path.isfile(os.path.join(get_entry_path(cache_dir, key), file_entry))
+
+
+def fetch(key, path_output):
+    """Link the cached derivative to `path_output`. Returns False if the cache is disabled or the key is not cached."""
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return False
+    path_entry = get_entry_path(cache_dir, key)
+    path_cached = os.path.join(path_entry, file_entry)
+    if not os.path.isfile(path_cached):
+        return False
+    # Mark the entry as recently used (the mtime of the derivative itself is left untouched)
+    os.utime(path_entry)
+    link_or_copy(path_cached, path_output)
+    return True
+
+
+def store(key, path_output):
+    """Add a derivative to the cache. Does nothing if the cache is disabled."""
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+    path_entry = get_entry_path(cache_dir, key)
+    os.makedirs(path_entry, exist_ok=True)
+    link_or_copy(path_output, os.path.join(path_entry, file_entry))
+    max_size = float(os.environ.get(env_cache_size, default_cache_size_gb)) * 1024 ** 3
+    evict(cache_dir, max_size)
+
+
+def remove_output(path_output):
+    """
+    Remove a derivative before fetching or computing it again, whether the cache is enabled or not. The tools would
+    otherwise overwrite the file in place, which would also modify the cache entry it may be hard linked to.
+    """
+    if os.path.lexists(path_output):
+        os.remove(path_output)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.action == "fetch":
+        remove_output(args.path_output)
+    if get_cache_dir() is None:
+        sys.exit(1 if args.action == "fetch" else 0)
+    params = {}
+    for param in args.params:
+        key, sep, value = param.partition("=")
+        if not sep:
+            parser.error(f"Invalid parameter: {param}. Expected KEY=VALUE.")
+        params[key] = value
+    key = get_key(args.inputs, params)
+    if args.action == "fetch":
+        if not fetch(key, args.path_output):
+            sys.exit(1)
+        print(f"Found in the derivative cache: {args.path_output}")
+    else:
+        store(key, args.path_output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Stand-ins for the external SCT/FSL tools used by the pipeline, so that the pipeline can be run offline (e.g., to test
+# the scheduling of the tools) without SCT/FSL installed. The outputs have the expected names, shapes and affines, but
+# the segmentations are boxes around the center of the image: the metrics computed from them are meaningless.
+#
+# Supported tools:
+#   sct_deepseg spinalcord -i <image> [-o <seg>]
+#   sct_deepseg_gm -i <image> [-o <seg>]
+#   sct_maths -i <image> -sub|-add <image> -o <output>
+#   sct_qc, sct_version, sct_check_dependencies
+#   fslstats <image> [-k <mask>] [-M] [-S]
+#
+# Without -o, the segmentations are written next to the image with the default suffix of SCT (<image>_seg.nii.gz for
+# `sct_deepseg spinalcord` and <image>_gmseg.nii.gz for `sct_deepseg_gm`), so that a driver relying on another name
+# fails as it would with SCT. The pipeline always passes -o.
+#
+# The duration of the tools can be simulated with the environment variable GRE1DNAV_FAKE_TOOLS_DELAY (in seconds).
+#
+# How to use:
+#   ./fake_tools.py <tool> [arguments of the tool]
+#
+# Example:
+#   ./fake_tools.py sct_deepseg_gm -i sub-01_ses-01_acq-LSE_rec-navigated_T2starw.nii.gz -o seg.nii.gz
+
+import os
+import sys
+import time
+import numpy as np
+import nibabel as nib
+
+# Define variables
+env_delay = "GRE1DNAV_FAKE_TOOLS_DELAY"
+# Half-width of the segmentation boxes, as a fraction of the in-plane size of the image
+half_width = {"sct_deepseg": 1 / 16, "sct_deepseg_gm": 1 / 32}
+# Suffix of the segmentations written without -o
+default_suffix = {"sct_deepseg": "_seg", "sct_deepseg_gm": "_gmseg"}
+ext = ".nii.gz"
+
+
+# Define functions
+def get_arg(args, flag, default=None):
+    """Return the value following `flag` in the arguments (or `default` if it is given and the flag is missing)."""
+    if flag not in args:
+        if default is not None:
+            return default
+        raise SystemExit(f"Error: Missing argument {flag}")
+    return args[args.index(flag) + 1]
+
+
+def segment(tool, args):
+    """Write a box around the center of each slice of the image."""
+    path_image = get_arg(args, "-i")
+    path_seg = get_arg(args, "-o", default=path_image[:-len(ext)] + default_suffix[tool] + ext)
+    nii = nib.load(path_image)
+    seg = np.zeros(nii.shape[:3], dtype=np.uint8)
+    box = []
+    for axis in [0, 1]:
+        center, width = nii.shape[axis] // 2, max(1, int(nii.shape[axis] * half_width[tool]))
+        box.append(slice(max(0, center - width), center + width))
+    seg[box[0], box[1], :] = 1
+    nib.save(nib.Nifti1Image(seg, nii.affine, nii.header), path_seg)
+    print(f"{tool}: segmentation saved to {path_seg}")
+
+
+def maths(args):
+    """Add or subtract two images."""
+    nii = nib.load(get_arg(args, "-i"))
+    data = nii.get_fdata()
+    if "-sub" in args:
+        data = data - nib.load(get_arg(args, "-sub")).get_fdata()
+    elif "-add" in args:
+        data = data + nib.load(get_arg(args, "-add")).get_fdata()
+    nib.save(nib.Nifti1Image(data, nii.affine, nii.header), get_arg(args, "-o"))
+
+
+def stats(args):
+    """Print the mean (-M) and standard deviation (-S) of the non-zero voxels of the image, within the mask (-k)."""
+    data = nib.load(args[0]).get_fdata()
+    values = data[data != 0]
+    if "-k" in args:
+        mask = nib.load(get_arg(args, "-k")).get_fdata() > 0
+        values = data[mask & (data != 0)]
+    output = []
+    for flag in args[1:]:
+        if flag == "-M":
+            output.append(f"{values.mean() if values.size else 0:.6f}")
+        elif flag == "-S":
+            output.append(f"{values.std(ddof=1) if values.size > 1 else 0:.6f}")
+    print(" ".join(output))
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise SystemExit(f"Usage: {sys.argv[0]} <tool> [arguments of the tool]")
+    tool, args = os.path.basename(sys.argv[1]), sys.argv[2:]
+    time.sleep(float(os.environ.get(env_delay, 0)))
+    if tool in half_width:
+        segment(tool, args)
+    elif tool == "sct_maths":
+        maths(args)
+    elif tool == "fslstats":
+        stats(args)
+    elif tool == "sct_version":
+        print("fake")
+    elif tool == "sct_check_dependencies":
+        print("Fake SCT/FSL tools (fake_tools.py)")
+    elif tool != "sct_qc":
+        raise SystemExit(f"Error: Unknown tool {tool}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+# File helpers shared by the scripts writing state or results next to the processed data (manifests, dataset index,
+# result shards, provenance, derivative cache). Only the standard library is imported, so that the small command-line
+# scripts importing them start quickly.
+#
+# How to use:
+#   from file_utils import hash_file, write_atomic
+#   write_atomic(path, content)
+#   sha1 = hash_file(path)
+
+import os
+import hashlib
+
+
+def write_atomic(path, content):
+    """Write a file atomically, so that readers never see a partially written file."""
+    path_tmp = f"{path}.tmp{os.getpid()}"
+    with open(path_tmp, 'w') as f:
+        f.write(content)
+    os.replace(path_tmp, path)
+
+
+def hash_file(path):
+    """Return the SHA-1 of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
@@ -0,0 +1,99 @@
+# Opt-in cache of decompressed NIfTI files.
+#
+# Loading a `.nii.gz` file decompresses the whole volume every time. When the cache is enabled, the first read of a file
+# stores an uncompressed copy (`.nii`) of its data in the cache folder, and the following reads memory-map that copy
+# (zero-copy, nothing is decompressed). Entries are keyed by the absolute path, modification time and size of the source
+# file, so a modified source is read again. When the cache exceeds its maximum size, the least recently used entries are
+# removed.
+#
+# The cache is enabled by setting the following environment variables (e.g., before running sct_run_batch):
+#   GRE1DNAV_NIFTI_CACHE: Path to the cache folder.
+#   GRE1DNAV_NIFTI_CACHE_SIZE_GB: Maximum size of the cache in GB (default: 10).
+#
+# How to use:
+#   from nifti_cache import load_data
+#   data = load_data(path_anat)
+
+import os
+import hashlib
+import numpy as np
+import nibabel as nib
+
+# Define variables
+env_cache_dir = "GRE1DNAV_NIFTI_CACHE"
+env_cache_size = "GRE1DNAV_NIFTI_CACHE_SIZE_GB"
+default_cache_size_gb = 10
+
+
+# Define functions
+def get_cache_dir():
+    """Return the cache folder, or None if the cache is disabled."""
+    return os.environ.get(env_cache_dir) or None
+
+
+def get_cache_path(path, cache_dir):
+    """Return the path of the cache entry of a file, keyed by its absolute path, modification time and size."""
+    stat = os.stat(path)
+    key = hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".nii")
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache is smaller than `max_size` bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".nii"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def load(path):
+    """
+    Load a NIfTI file. If the cache is enabled, the returned image is a memory-mapped uncompressed copy of the file, with
+    the same data (after scaling), affine and header.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return nib.load(path)
+
+    path_cache = get_cache_path(path, cache_dir)
+    if os.path.exists(path_cache):
+        # Mark the entry as recently used
+        os.utime(path_cache)
+        return nib.load(path_cache, mmap=True)
+
+    # Store the uncompressed data with the scaling applied, so that it can be memory-mapped as is
+    os.makedirs(cache_dir, exist_ok=True)
+    nii = nib.load(path)
+    data = np.asanyarray(nii.dataobj)
+    header = nii.header.copy()
+    header.set_data_dtype(data.dtype)
+    path_tmp = f"{path_cache[:-len('.nii')]}.tmp{os.getpid()}.nii"
+    nib.save(nib.Nifti1Image(data, nii.affine, header), path_tmp)
+    os.replace(path_tmp, path_cache)
+    max_size = float(os.environ.get(env_cache_size, default_cache_size_gb)) * 1024 ** 3
+    evict(cache_dir, max_size)
+    return nib.load(path_cache, mmap=True) if os.path.exists(path_cache) else nii
+
+
+def load_data(path):
+    """
+    Load the data of a NIfTI file. Without cache, this is `nib.load(path).get_fdata()`. With cache, the data is a
+    copy-on-write memory map of the cached copy in its stored dtype (float64 conversion is left to the reductions).
+    """
+    nii = load(path)
+    if get_cache_dir() is None or not isinstance(nii.dataobj, nib.arrayproxy.ArrayProxy):
+        return nii.get_fdata()
+    return np.asanyarray(nii.dataobj)
@@ -41,113 +41,143 @@ start=`date +%s`
 # FUNCTIONS
 # ==============================================================================
 
-# Copy all selected scripts in a folder to an output folder
-copy_scripts() {
-    local path_scripts="$1"
-    local path_output="$2"
-    local exception_file="$3"
-    find "${path_scripts}" -maxdepth 1 \( -name "*.py" -o -name "*.sh" \) ! -name "${exception_file}" -exec rsync -avzh {} "${path_output}" \;
+# Return 0 if a step is up to date, i.e., it is not in the steps to run given by `step_manifest.py plan` (see
+# step_manifest.py, which defines the steps). Usage: step_is_up_to_date <name>
+step_is_up_to_date(){
+    local name="$1"
+    if [[ -z "${STEPS_TO_RUN[${name}]}" ]]; then
+        echo "${name}: up to date, skipping"
+        return 0
+    fi
+    return 1
+}
+
+
+# Mark a step as run. The inputs, parameters and scripts of the steps which were run are recorded at once when the
+# script exits (see record_steps). Usage: record_step <name>
+record_step(){
+    STEPS_RUN+=("$1")
+}
+
+
+# Record the steps which were run (see record_step)
+record_steps(){
+    if [[ ${#STEPS_RUN[@]} -gt 0 ]]; then
+        "${PATH_SCRIPTS}/step_manifest.py" record "${PATH_DATA_PROCESSED}" "${SUBJECT_SLASH_SESSION}" "${STEPS_RUN[@]}"
+    fi
+}
+
+
+# Link a derivative from the cross-run derivative cache if it was already computed from the same inputs with the same
+# tool (see derivative_cache.py). The existing output is always removed first, even when the cache is disabled, so that
+# the tool does not overwrite a file hard linked to the cache. Usage: fetch_derivative <output> -inputs ... -params ...
+fetch_derivative(){
+    "${PATH_SCRIPTS}/derivative_cache.py" fetch "$@"
+}
+
+
+# Add a derivative to the cache after it was computed (same arguments as fetch_derivative)
+store_derivative(){
+    "${PATH_SCRIPTS}/derivative_cache.py" store "$@"
 }
 
 
 segment_if_does_not_exist(){
     local file="$1"
     FILESEG="${file}_label-SC_seg"
-    PATHSEG="${PATH_DATA}/derivatives/labels/${SUBJECT_SLASH_SESSION}/anat/${FILESEG}${EXT}"
+    # Manual segmentation, from the dataset index (empty if it does not exist)
+    PATHSEG="${MANUAL_LABELS[${FILESEG}]}"
     echo "Looking for segmentation"
-    if [[ -e "${PATHSEG}" ]]; then
+    if step_is_up_to_date "${FILESEG}"; then
+        return
+    fi
+    if [[ -n "${PATHSEG}" ]]; then
         echo "Found! Using segmentation ${PATHSEG}"
-        rsync -avzh "${PATHSEG}" "${FILESEG}${EXT}"
+        "${PATH_SCRIPTS}/staging.py" file "${PATHSEG}" "${FILESEG}${EXT}"
         sct_qc -i "${file}${EXT}" -s "${FILESEG}${EXT}" -p sct_deepseg_sc -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
     else
         echo "Not found. Proceeding with automatic segmentation."
-        # Segment spinal cord
-        sct_deepseg spinalcord -i "${file}${EXT}" -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+        # Same parameters as the step (see step_manifest.segmentation_tools)
+        CACHE_ARGS=(-inputs "${file}${EXT}" -params tool=sct_deepseg_spinalcord sct_version="${SCT_VERSION}")
+        if fetch_derivative "${FILESEG}${EXT}" "${CACHE_ARGS[@]}"; then
+            sct_qc -i "${file}${EXT}" -s "${FILESEG}${EXT}" -p sct_deepseg_sc -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+        else
+            # Segment spinal cord
+            sct_deepseg spinalcord -i "${file}${EXT}" -o "${FILESEG}${EXT}" -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+            store_derivative "${FILESEG}${EXT}" "${CACHE_ARGS[@]}"
+        fi
     fi
+    record_step "${FILESEG}"
 }
 
 
 segment_gm_if_does_not_exist(){
     local file="$1"
     FILESEG="${file}_label-GM_seg"
-    PATHSEG="${PATH_DATA}/derivatives/labels/${SUBJECT_SLASH_SESSION}/anat/${FILESEG}${EXT}"
+    # Manual segmentation, from the dataset index (empty if it does not exist)
+    PATHSEG="${MANUAL_LABELS[${FILESEG}]}"
     echo "Looking for segmentation"
-    if [[ -e "${PATHSEG}" ]]; then
+    if step_is_up_to_date "${FILESEG}"; then
+        return
+    fi
+    if [[ -n "${PATHSEG}" ]]; then
         echo "Found! Using segmentation ${PATHSEG}"
-        rsync -avzh "${PATHSEG}" "${FILESEG}${EXT}"
+        "${PATH_SCRIPTS}/staging.py" file "${PATHSEG}" "${FILESEG}${EXT}"
         sct_qc -i "${file}${EXT}" -s "${FILESEG}${EXT}" -p sct_deepseg_gm -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
     else
         echo "Not found. Proceeding with automatic segmentation."
-        # Segment gray matter
-        sct_deepseg_gm -i "${file}${EXT}" -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+        # Same parameters as the step (see step_manifest.segmentation_tools)
+        CACHE_ARGS=(-inputs "${file}${EXT}" -params tool=sct_deepseg_gm sct_version="${SCT_VERSION}")
+        if fetch_derivative "${FILESEG}${EXT}" "${CACHE_ARGS[@]}"; then
+            sct_qc -i "${file}${EXT}" -s "${FILESEG}${EXT}" -p sct_deepseg_gm -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+        else
+            # Segment gray matter
+            sct_deepseg_gm -i "${file}${EXT}" -o "${FILESEG}${EXT}" -qc "${PATH_QC}" -qc-subject "${SUBJECT_UNDERSCORE_SESSION}"
+            store_derivative "${FILESEG}${EXT}" "${CACHE_ARGS[@]}"
+        fi
     fi
+    record_step "${FILESEG}"
 }
 
 
-compute_wm(){
-    local file="$1"
-    local file_seg="$2"
-    local file_gmseg="$3"
-    FILESEG="${file}_label-WM_seg"
-    sct_maths -i "${file_seg}${EXT}" -sub "${file_gmseg}${EXT}" -o "${FILESEG}${EXT}"
-}
-
-
-compute_snr_cnr(){
-    local file="$1"
-    local file_wmseg="$2"
-    local file_gmseg="$3"
-    # Split images, gm, and wm segs into individual slices to calculate SNR/CNR for each slice
-    PATH_TMP="${PATH_DATA_PROCESSED}/tmp"
-    PATH_TMP_SUBJECT="${PATH_TMP}/${SUBJECT_SLASH_SESSION}"
-    mkdir -p "${PATH_TMP_SUBJECT}"
-    sct_image -i "${file_gmseg}${EXT}" -split z -o "${PATH_TMP_SUBJECT}/${file_gmseg}${EXT}"
-    sct_image -i "${file_wmseg}${EXT}" -split z -o "${PATH_TMP_SUBJECT}/${file_wmseg}${EXT}"
-    sct_image -i "${file}${EXT}" -split z -o "${PATH_TMP_SUBJECT}/${file}${EXT}"
-    file_gmseg_ind="${PATH_TMP_SUBJECT}/${file_gmseg}"
-    file_wmseg_ind="${PATH_TMP_SUBJECT}/${file_wmseg}"
-    file_ind="${PATH_TMP_SUBJECT}/${file}"
-    # Find the number of slices in image
-    num_slices=$(sct_image -i "${file}${EXT}" -header fslhd | grep ^dim3 | awk '{print $2}')
-    num_slices=$((num_slices-1))
-    # Calculate SNR/CNR for each slice
-    mkdir -p "${PATH_RESULTS}/SNR/${SUBJECT_SLASH_SESSION}"
-    mkdir -p "${PATH_RESULTS}/CNR/${SUBJECT_SLASH_SESSION}"
-    echo "slice,ID,CNR" > "${PATH_RESULTS}/CNR/${SUBJECT_SLASH_SESSION}/${file}_results.csv"
-    echo "slice,ID,SNR" > "${PATH_RESULTS}/SNR/${SUBJECT_SLASH_SESSION}/${file}_wm_results.csv"
-    echo "slice,ID,SNR" > "${PATH_RESULTS}/SNR/${SUBJECT_SLASH_SESSION}/${file}_gm_results.csv"
-    for g in $(seq -w 0 ${num_slices}); do
-        gmM=$(fslstats "${file_ind}_Z00${g}${EXT}" -k "${file_gmseg_ind}_Z00${g}${EXT}" -M)
-        gmS=$(fslstats "${file_ind}_Z00${g}${EXT}" -k "${file_gmseg_ind}_Z00${g}${EXT}" -S)
-        wmM=$(fslstats "${file_ind}_Z00${g}${EXT}" -k "${file_wmseg_ind}_Z00${g}${EXT}" -M)
-        wmS=$(fslstats "${file_ind}_Z00${g}${EXT}" -k "${file_wmseg_ind}_Z00${g}${EXT}" -S)
-        CNR=$(echo "scale=5; (${gmM} - ${wmM})/ ${wmS}" | bc)
-        SNR_wm=$(echo "scale=5; ${wmM}/${wmS}" | bc)
-        SNR_gm=$(echo "scale=5; ${gmM}/${gmS}" | bc)
-        echo ${g}","${file}","$CNR >> "${PATH_RESULTS}/CNR/${SUBJECT_SLASH_SESSION}/${file}_results.csv"
-        echo ${g}","${file}","$SNR_wm >> "${PATH_RESULTS}/SNR/${SUBJECT_SLASH_SESSION}/${file}_wm_results.csv"
-        echo ${g}","${file}","$SNR_gm >> "${PATH_RESULTS}/SNR/${SUBJECT_SLASH_SESSION}/${file}_gm_results.csv"
-    done
-    rm -r ${PATH_TMP}
-}
-
-
-compute_ghosting()
+create_ghosting_mask()
 {
     local path_data="$1"
     local path_processed_data="$2"
     local subject="$3"
     local session="$4"
     local acq="$5"
-    local rec="$6"
-    # Create ghosting mask only on navigatd data
-    if [[ $rec == "rec-navigated" ]]; then
-        echo "Creating ghosting mask for ${subject} ${session} ${acq}"
-        "${PATH_SCRIPTS}/create_ghosting_mask.py" "${path_data}" "${path_processed_data}" "${subject}" "${session}" "${acq}" || exit
+    # The ghosting mask is only created on the navigated data. A missing body posterior tip is detected automatically
+    # (and saved in the processed data folder), unless GRE1DNAV_POSTERIOR_TIP_METHOD=viewer, and the gaps of a label of
+    # up to GRE1DNAV_POSTERIOR_TIP_MAX_GAP slices are filled by interpolation (see create_ghosting_mask.py)
+    local file="${subject}_${session}_${acq}_rec-navigated_${CONTRAST}"
+    if step_is_up_to_date "${file}_ghostingMask"; then
+        return
     fi
-    # Compute ghosting
-    echo "Computing ghosting for ${subject} ${session} ${acq} ${rec}"
-    "${PATH_SCRIPTS}/compute_ghosting.py" "${path_processed_data}" "${subject}" "${session}" "${acq}" "${rec}"
+    echo "Creating ghosting mask for ${subject} ${session} ${acq}"
+    "${PATH_SCRIPTS}/create_ghosting_mask.py" "${path_data}" "${path_processed_data}" "${subject}" "${session}" "${acq}" || exit
+    record_step "${file}_ghostingMask"
+}
+
+
+# Compute the metrics of the reconstructions of an acquisition in one paired pass (see compute_metrics.py).
+# Usage: compute_metrics <path_processed_data> <subject> <session> <acq> <rec> [<rec>]
+compute_metrics()
+{
+    local path_processed_data="$1"
+    local subject="$2"
+    local session="$3"
+    local acq="$4"
+    local recs=("${@:5}")
+    # The inputs and outputs of the step (e.g., the WM mask if GRE1DNAV_SAVE_WM_MASK=1, the paired differences if
+    # GRE1DNAV_PAIRED_DIFF=1) are defined in step_manifest.py
+    if step_is_up_to_date "${subject}_${session}_${acq}_${CONTRAST}_metrics"; then
+        return
+    fi
+    # Compute slicewise SNR/CNR, ghosting and WM STD of all the reconstructions in a single pass
+    echo "Computing metrics for ${subject} ${session} ${acq} ${recs[*]}"
+    "${PATH_SCRIPTS}/compute_metrics.py" "${path_processed_data}" "${subject}" "${session}" "${acq}" paired -recs "${recs[@]}"
+    record_step "${subject}_${session}_${acq}_${CONTRAST}_metrics"
 }
 
 
@@ -160,9 +190,11 @@ check_if_exists()
         FILES_TO_CHECK=(
         "anat/${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}_label-SC_seg${EXT}"
         "anat/${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}_label-GM_seg${EXT}"
-        "anat/${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}_label-WM_seg${EXT}"
         "anat/${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}_ghostingMask${EXT}"
     )
+        if [[ "${GRE1DNAV_SAVE_WM_MASK}" == "1" ]]; then
+            FILES_TO_CHECK+=("anat/${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}_label-WM_seg${EXT}")
+        fi
     fi
     for file in "${FILES_TO_CHECK[@]}"; do
         if [[ ! -e "${PATH_DATA_PROCESSED}/${SUBJECT_SLASH_SESSION}/$file" ]]; then
@@ -175,61 +207,87 @@ check_if_exists()
 # SCRIPT STARTS HERE
 # ==============================================================================
 # Display useful info for the log, such as SCT version, RAM and CPU cores available
-sct_check_dependencies -short
-
-# Copy files to the processed data folder
-copy_scripts "${PATH_SCRIPTS}" "${PATH_DATA_PROCESSED}/../" "process_data.sh"
+# The probes are run once per batch and cached in the output folder (see provenance.py). The output of
+# `sct_check_dependencies -short` is followed by the SCT version, on the last line.
+PROVENANCE=`"${PATH_SCRIPTS}/provenance.py" "${PATH_DATA_PROCESSED}/.." -print-dependencies -key sct_version`
+echo "${PROVENANCE%$'\n'*}"
+SCT_VERSION="${PROVENANCE##*$'\n'}"
+
+PATH_MANIFESTS="${PATH_DATA_PROCESSED}/../manifests/${SUBJECT_SLASH_SESSION}"
+
+# Copy the scripts to the output folder (only the first job of the batch copies them, see staging.py)
+"${PATH_SCRIPTS}/staging.py" scripts "${PATH_SCRIPTS}" "${PATH_DATA_PROCESSED}/../"
+
+# Find the acquisition regions and reconstructions of this subject/session and its manual labels in the dataset index
+# (built by the first job of the batch, only this subject/session is checked again, see dataset_index.py). Its entry is
+# written to an extract, which the later stages read instead of the index.
+PATH_INDEX_EXTRACT="${PATH_MANIFESTS}/dataset_index.json"
+INDEX_SESSION=`"${PATH_SCRIPTS}/dataset_index.py" "${PATH_DATA}" "${PATH_DATA_PROCESSED}/.." -session "${SUBJECT_SLASH_SESSION}" -extract "${PATH_INDEX_EXTRACT}"`
+# Each acquisition line lists an acquisition region followed by its reconstructions, and the manual labels are keyed by
+# their name (e.g., <file>_label-SC_seg)
+ACQ_RECS=()
+declare -A MANUAL_LABELS
+while read -r kind name value; do
+    if [[ "${kind}" == "acq" ]]; then
+        ACQ_RECS+=("${name} ${value}")
+    elif [[ "${kind}" == "label" ]]; then
+        MANUAL_LABELS["${name}"]="${value}"
+    fi
+done <<< "${INDEX_SESSION}"
+
+# Stage the list of participants and the source images needed by the pipeline in the processed data folder, using
+# reflinks or hard links instead of copies when possible (see staging.py)
+"${PATH_SCRIPTS}/staging.py" session "${PATH_DATA}" "${PATH_DATA_PROCESSED}" "${SUBJECT_SLASH_SESSION}" -index "${PATH_INDEX_EXTRACT}"
+
+# The steps are skipped if they were already run with the same inputs, parameters and scripts, as defined in
+# step_manifest.py for both process_data.sh and run_batch.py. The steps to run are listed once, and the ones which were
+# run are recorded when the script exits. Set GRE1DNAV_FORCE=1 to run all the steps again.
+STEPS_PLAN=`"${PATH_SCRIPTS}/step_manifest.py" plan "${PATH_DATA}" "${PATH_DATA_PROCESSED}" "${SUBJECT_SLASH_SESSION}" -index "${PATH_INDEX_EXTRACT}"`
+declare -A STEPS_TO_RUN
+while read -r name; do
+    if [[ -n "${name}" ]]; then
+        STEPS_TO_RUN["${name}"]=1
+    fi
+done <<< "${STEPS_PLAN}"
+STEPS_RUN=()
+trap record_steps EXIT
 
 # Go to folder where data will be copied and processed
 cd "${PATH_DATA_PROCESSED}"
 
-# Copy list of participants in processed data folder
-if [[ ! -f "participants.tsv" ]]; then
-    rsync -avzh "${PATH_DATA}/participants.tsv" .
-fi
-
-# Copy source images
-mkdir -p "${SUBJECT}"
-rsync -avzh "${PATH_DATA}/${SUBJECT_SLASH_SESSION}" "${SUBJECT}/"
-
 # Go to anat folder where all structural data are located
 cd "${SUBJECT_SLASH_SESSION}/anat/"
 
 # Create new variable that will be used to fetch data according to BIDS standard
 SUBJECT_UNDERSCORE_SESSION="${SUBJECT}_${SESSION}"
 
-# Loop through the different acquisition and reconstruction options
+# Loop through the acquisition regions and reconstructions found in the dataset index
 CONTRAST="T2starw"
 EXT=".nii.gz"
-ACQ=("acq-upperT" "acq-lowerT" "acq-LSE")
-REC=("rec-navigated" "rec-standard")
 OVERWRITE_SEG=true
-for acq in "${ACQ[@]}";do
-    for rec in "${REC[@]}";do
-        file="${SUBJECT_UNDERSCORE_SESSION}_${acq}_${rec}_${CONTRAST}"
-        file_navigated="${SUBJECT_UNDERSCORE_SESSION}_${acq}_rec-navigated_${CONTRAST}"
-        echo "File: ${file}${EXT}"
-        if [ -e "${file}${EXT}" ]; then
-            echo "File found! Processing..."
-            # Always use the navigated segmentation (manually corrected) to calculate SNR/CNR for both standard and navigated images
-            segment_if_does_not_exist "${file_navigated}"
-            file_seg="${file_navigated}_label-SC_seg"
-            segment_gm_if_does_not_exist "${file_navigated}"
-            file_gmseg="${file_navigated}_label-GM_seg"
-            # Calculate WM mask with the navigated segmentation
-            compute_wm "${file_navigated}" "${file_seg}" "${file_gmseg}"
-            file_wmseg="${file_navigated}_label-WM_seg"
-            # Compute slicewise snr and cnr values
-            compute_snr_cnr "${file}" "${file_wmseg}" "${file_gmseg}"
-            # Quantify ghosting
-            compute_ghosting "${PATH_DATA}" "${PATH_DATA_PROCESSED}" "${SUBJECT}" "${SESSION}" "${acq}" "${rec}"
-            # Compute STD
-            "${PATH_SCRIPTS}/compute_wm_std.py" "${PATH_DATA_PROCESSED}" "${SUBJECT}" "${SESSION}" "${acq}" "${rec}" "${file_wmseg}"
-            # Check if output files exist
-            check_if_exists "${acq}" "${rec}"
-        else
-            echo "File not found. Skipping"
-        fi
+for acq_recs in "${ACQ_RECS[@]}";do
+    read -r -a fields <<< "${acq_recs}"
+    if [[ ${#fields[@]} -lt 2 ]]; then
+        continue
+    fi
+    acq="${fields[0]}"
+    recs_found=("${fields[@]:1}")
+    echo "Processing ${acq}: ${recs_found[*]}"
+    # The derivatives of the navigated image are computed once per acquisition region, and shared by both reconstructions
+    file_navigated="${SUBJECT_UNDERSCORE_SESSION}_${acq}_rec-navigated_${CONTRAST}"
+    # Always use the navigated segmentation (manually corrected) to calculate SNR/CNR for both standard and navigated images
+    segment_if_does_not_exist "${file_navigated}"
+    file_seg="${file_navigated}_label-SC_seg"
+    segment_gm_if_does_not_exist "${file_navigated}"
+    file_gmseg="${file_navigated}_label-GM_seg"
+    # The WM mask (SC - GM) is derived from the navigated segmentations in the metrics pass (see compute_metrics.py)
+    # Create the ghosting mask (navigated data only)
+    create_ghosting_mask "${PATH_DATA}" "${PATH_DATA_PROCESSED}" "${SUBJECT}" "${SESSION}" "${acq}"
+    # Compute slicewise snr and cnr values, quantify ghosting and compute STD of both reconstructions at once
+    compute_metrics "${PATH_DATA_PROCESSED}" "${SUBJECT}" "${SESSION}" "${acq}" "${recs_found[@]}"
+    for rec in "${recs_found[@]}";do
+        # Check if output files exist
+        check_if_exists "${acq}" "${rec}"
     done
 done
 
@@ -240,7 +298,7 @@ end=`date +%s`
 runtime=$(({end}-{start}))
 echo
 echo "~~~"
-echo "SCT version: `sct_version`"
+echo "SCT version: ${SCT_VERSION}"
 echo "Ran on:      `uname -nsr`"
 echo "Duration:    $((${runtime} / 3600))hrs $(((${runtime} / 60) % 60))min $((${runtime} % 60))sec"
 echo "~~~"
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# Batch-level cache of the environment and provenance information (user name, SCT version, output of
+# `sct_check_dependencies -short`, machine). The probes are run once per batch and saved to:
+#   /PATH/TO/OUTPUT/provenance.json
+# All the scripts of the batch read this file instead of running the probes again. The file also stores a fingerprint of
+# the environment (user, machine, location and modification time of the SCT executables, SCT_DIR) which is cheap to
+# compute; the probes are only run again when this fingerprint changes.
+#
+# It requires one argument:
+# 1. path_output: The path to the output directory of the batch (i.e., the parent of the processed data directory).
+#
+# How to use:
+#   ./provenance.py <path_output> [-print-dependencies] [-key KEY]
+# With both -print-dependencies and -key, the value of the key is printed on the last line.
+#
+# Example:
+#   ./provenance.py ~/temp/ds006347_20250612_144520 -key sct_version
+
+import os
+import sys
+import json
+import fcntl
+import getpass
+import hashlib
+import argparse
+import platform
+import shutil
+import subprocess
+from datetime import datetime
+
+from file_utils import write_atomic
+
+# Define variables
+file_provenance = "provenance.json"
+# Executables whose location and modification time are part of the fingerprint
+executables = ["sct_version", "sct_check_dependencies", "sct_deepseg", "fslstats"]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Print the environment and provenance information of the batch, probing it only if the environment\
+        changed since the last probe."
+    )
+    parser.add_argument("path_output", help="The path to the output directory of the batch.")
+    parser.add_argument("-print-dependencies", action="store_true",
+                        help="Print the output of `sct_check_dependencies -short`.")
+    parser.add_argument("-key", help="Only print this value (e.g., sct_version, username).")
+    parser.add_argument("-refresh", action="store_true", help="Run the probes even if the environment did not change.")
+    return parser
+
+
+# Define functions
+def get_fingerprint():
+    """Return a cheap fingerprint of the environment, which changes when the probes need to be run again."""
+    environment = {
+        "username": getpass.getuser(),
+        "node": platform.node(),
+        "SCT_DIR": os.environ.get("SCT_DIR"),
+    }
+    for executable in executables:
+        path = shutil.which(executable)
+        environment[executable] = [path, os.stat(path).st_mtime_ns] if path else None
+    return hashlib.sha1(json.dumps(environment, sort_keys=True).encode()).hexdigest()
+
+
+def run_probe(command):
+    """Run a probe and return its output, or an empty string if the command is not available."""
+    try:
+        return subprocess.run(command, capture_output=True, text=True).stdout.strip()
+    except FileNotFoundError:
+        return ""
+
+
+def probe(fingerprint):
+    """Run all the probes."""
+    return {
+        "fingerprint": fingerprint,
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "username": getpass.getuser(),
+        "sct_version": run_probe(["sct_version"]),
+        "sct_check_dependencies": run_probe(["sct_check_dependencies", "-short"]),
+        "uname": " ".join(platform.uname()[:3]),
+    }
+
+
+def get_provenance(path_output=None, refresh=False):
+    """
+    Return the provenance information of the batch. The probes are only run if the provenance file of `path_output` does
+    not exist, if the environment changed, or if `refresh` is True. If `path_output` is None, the probes are run without
+    being saved.
+    """
+    fingerprint = get_fingerprint()
+    if path_output is None:
+        return probe(fingerprint)
+
+    path_provenance = os.path.join(path_output, file_provenance)
+    os.makedirs(path_output, exist_ok=True)
+    # Only one job of the batch runs the probes, the other ones wait and read its results
+    with open(path_provenance + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not refresh and os.path.exists(path_provenance):
+            with open(path_provenance, 'r') as f:
+                provenance = json.load(f)
+            if provenance.get("fingerprint") == fingerprint:
+                return provenance
+        provenance = probe(fingerprint)
+        write_atomic(path_provenance, json.dumps(provenance, indent=4))
+    return provenance
+
+
+def main():
+    args = get_parser().parse_args()
+    provenance = get_provenance(args.path_output, refresh=args.refresh)
+    if args.print_dependencies:
+        print(provenance["sct_check_dependencies"])
+    if args.key:
+        if args.key not in provenance:
+            print(f"Error: Unknown key '{args.key}'. Available keys: {', '.join(provenance)}")
+            sys.exit(1)
+        print(provenance[args.key])
+    elif not args.print_dependencies:
+        print(json.dumps(provenance, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# SQLite results database. All the metrics are stored in a single table in long format, keyed by
+# (subject, session, acq, rec, metric, slice):
+#
+# | subject | session |    acq     |      rec      |    metric    | slice |  value   |
+# |  sub-01 |  ses-01 | acq-upperT | rec-navigated |   ghosting   |   0   | 0.000000 |
+# |  sub-01 |  ses-01 | acq-upperT | rec-navigated | max_ghosting |  -1   | 0.000000 |
+#
+# Slice-wise metrics (ghosting, wm_std, cnr, snr_wm, snr_gm) have one row per axial slice, and summary metrics
+# (max_ghosting, mean_ghosting, max_wm_std, mean_wm_std) have a single row with slice = -1. NaN values are stored as NULL.
+#
+# The database is filled from the result shards at the end of the batch (see results_store.py), and is located at:
+#   /PATH/TO/RESULTS/results.sqlite
+#
+# How to use:
+#   # Print the rows matching a query as CSV
+#   ./results_db.py query <path_db> [-subject SUB-ID] [-session SES-ID] [-acq ACQ-REGION] [-rec REC] [-metric METRIC]
+#   # Regenerate the CSV files (ghosting_metrics.csv, wm_std.csv, SNR/ and CNR/) in an output folder
+#   ./results_db.py export <path_db> <path_output> [-acq ACQ-REGION]
+#   # Export all the metrics to a Parquet dataset partitioned by acq and rec (requires pyarrow)
+#   ./results_db.py parquet <path_db> <path_output>
+#
+# Example:
+#   ./results_db.py query ~/temp/ds006347_20250612_144520/results/results.sqlite -acq acq-LSE -metric max_ghosting
+
+import os
+import sys
+import math
+import sqlite3
+import argparse
+
+from file_utils import write_atomic
+
+# Define variables
+file_db = "results.sqlite"
+# Slice number of the summary metrics
+volume_slice = -1
+# Wide table written for each metric, and the summary metrics that fill its columns
+wide_tables = {
+    "ghosting": ("ghosting_metrics.csv", "max_ghosting", "mean_ghosting"),
+    "wm_std": ("wm_std.csv", "max_wm_std", "mean_wm_std"),
+}
+# CSV files written for each slice-wise SNR/CNR metric: (folder, suffix of the file name, column name)
+slice_wise_tables = {
+    "cnr": ("CNR", "_results.csv", "CNR"),
+    "snr_wm": ("SNR", "_wm_results.csv", "SNR"),
+    "snr_gm": ("SNR", "_gm_results.csv", "SNR"),
+}
+# Order in which process_data.sh processes the acquisitions. The wide tables are keyed by subject/session only, so when
+# several acquisitions exist and no acquisition is selected, the last one in this order is kept.
+acq_order = ["acq-upperT", "acq-lowerT", "acq-LSE"]
+contrast = "T2starw"
+
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    subject TEXT NOT NULL,
+    session TEXT NOT NULL,
+    acq TEXT NOT NULL,
+    rec TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    slice INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (subject, session, acq, rec, metric, slice)
+);
+CREATE INDEX IF NOT EXISTS results_metric ON results (metric, acq, rec);
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Query the results database or regenerate the CSV files from it.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_query = subparsers.add_parser("query", help="Print the rows matching the query as CSV.")
+    parser_query.add_argument("path_db", help="The path to the results database.")
+    for key in ["subject", "session", "acq", "rec", "metric"]:
+        parser_query.add_argument(f"-{key}", help=f"Only keep the rows with this {key}.")
+
+    parser_export = subparsers.add_parser("export", help="Regenerate the CSV files from the database.")
+    parser_export.add_argument("path_db", help="The path to the results database.")
+    parser_export.add_argument("path_output", help="The folder in which the CSV files are written.")
+    parser_export.add_argument("-acq", choices=acq_order,
+                               help="Only export this acquisition region in the ghosting and WM STD tables.")
+
+    parser_parquet = subparsers.add_parser(
+        "parquet", help="Export all the metrics to a Parquet dataset partitioned by acq and rec (requires pyarrow).")
+    parser_parquet.add_argument("path_db", help="The path to the results database.")
+    parser_parquet.add_argument("path_output", help="The folder of the Parquet dataset.")
+    return parser
+
+
+# Define functions
+def format_value(val):
+    if val == 'nan' or val is None:
+        return 'nan'
+    try:
+        return f"{float(val):.6f}"
+    except (ValueError, TypeError):
+        return 'nan'
+
+
+def connect(path_db):
+    """Open the results database, creating it if needed."""
+    conn = sqlite3.connect(path_db, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(schema)
+    return conn
+
+
+def insert_records(path_db, records):
+    """
+    Insert (or replace) records in a single transaction. The existing rows of each (subject, session, acq, rec, metric)
+    of the records are deleted first, so that no stale slice is left when a metric has fewer slices than before.
+
+    :param records: iterable of (subject, session, acq, rec, metric, slice, value) tuples
+    """
+    records = [(*record[:6], None if record[6] is None or math.isnan(record[6]) else float(record[6]))
+               for record in records]
+    groups = sorted({record[:5] for record in records})
+    conn = connect(path_db)
+    try:
+        with conn:
+            conn.executemany("DELETE FROM results WHERE subject = ? AND session = ? AND acq = ? AND rec = ? "
+                             "AND metric = ?", groups)
+            conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", records)
+    finally:
+        conn.close()
+    return len(records)
+
+
+def query(conn, **filters):
+    """Return the rows matching the filters (e.g., subject='sub-01', metric='max_ghosting'), sorted by key."""
+    filters = {key: val for key, val in filters.items() if val is not None}
+    where = " AND ".join(f"{key} = ?" for key in filters)
+    sql = "SELECT * FROM results" + (f" WHERE {where}" if where else "") + \
+          " ORDER BY subject, session, acq, rec, metric, slice"
+    return conn.execute(sql, list(filters.values())).fetchall()
+
+
+def export_wide_tables(conn, path_output, acq=None):
+    """Write ghosting_metrics.csv and wm_std.csv (one row per subject/session, one column per rec and summary)."""
+    paths_csv = []
+    acq_rank = {name: rank for rank, name in enumerate(acq_order)}
+    for metric, (file_csv, metric_max, metric_mean) in wide_tables.items():
+        rows = conn.execute(
+            "SELECT subject, session, acq, rec, metric, value FROM results WHERE metric IN (?, ?)"
+            + (" AND acq = ?" if acq else ""),
+            [metric_max, metric_mean] + ([acq] if acq else [])
+        ).fetchall()
+        rows.sort(key=lambda row: acq_rank.get(row[2], len(acq_order)))
+        table = {}
+        for subject, session, _, rec, row_metric, value in rows:
+            table.setdefault(f"{subject}/{session}", {})[(row_metric, rec)] = value
+        lines = ["Subject-ID/Session-ID,max rec-standard,max rec-navigated,mean rec-standard,mean rec-navigated\n"]
+        for sub_ses, data in sorted(table.items()):
+            max_std = format_value(data.get((metric_max, "rec-standard")))
+            max_nav = format_value(data.get((metric_max, "rec-navigated")))
+            mean_std = format_value(data.get((metric_mean, "rec-standard")))
+            mean_nav = format_value(data.get((metric_mean, "rec-navigated")))
+            lines.append(f"{sub_ses},{max_std},{max_nav},{mean_std},{mean_nav}\n")
+        path_csv = os.path.join(path_output, file_csv)
+        write_atomic(path_csv, ''.join(lines))
+        paths_csv.append(path_csv)
+    return paths_csv
+
+
+def export_slice_wise_tables(conn, path_output):
+    """Write the slice-wise SNR/CNR CSV files (one file per image, one row per slice)."""
+    paths_csv = []
+    for metric, (folder, suffix, column) in slice_wise_tables.items():
+        rows = conn.execute(
+            "SELECT subject, session, acq, rec, slice, value FROM results WHERE metric = ? "
+            "ORDER BY subject, session, acq, rec, slice", [metric]
+        ).fetchall()
+        files = {}
+        for subject, session, acq, rec, z, value in rows:
+            files.setdefault((subject, session, acq, rec), []).append((z, value))
+        for (subject, session, acq, rec), values in files.items():
+            file = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+            # Pad the slice number as `seq -w` does
+            width = len(str(len(values) - 1))
+            lines = [f"slice,ID,{column}\n"]
+            lines += [f"{z:0{width}d},{file},{'nan' if value is None else f'{value:.5f}'}\n" for z, value in values]
+            path_dir = os.path.join(path_output, folder, subject, session)
+            os.makedirs(path_dir, exist_ok=True)
+            path_csv = os.path.join(path_dir, file + suffix)
+            write_atomic(path_csv, ''.join(lines))
+            paths_csv.append(path_csv)
+    return paths_csv
+
+
+def export_parquet(conn, path_output):
+    """
+    Write all the metrics to a Parquet dataset with hive partitioning by acq and rec, e.g.:
+      path_output/acq=acq-upperT/rec=rec-navigated/part-0.parquet
+    Existing files of the exported partitions are replaced.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise RuntimeError("The Parquet export requires pyarrow. Install it with: pip install pyarrow")
+
+    schema_parquet = pa.schema([
+        ("subject", pa.string()),
+        ("session", pa.string()),
+        ("acq", pa.string()),
+        ("rec", pa.string()),
+        ("metric", pa.string()),
+        ("slice", pa.int32()),
+        ("value", pa.float64()),
+    ])
+    rows = conn.execute("SELECT * FROM results ORDER BY acq, rec, metric, subject, session, slice").fetchall()
+    columns = list(zip(*rows)) if rows else [[] for _ in schema_parquet]
+    table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema_parquet)],
+                                 schema=schema_parquet)
+    ds.write_dataset(table, path_output, format="parquet",
+                     partitioning=ds.partitioning(pa.schema([schema_parquet.field("acq"), schema_parquet.field("rec")]),
+                                                  flavor="hive"),
+                     existing_data_behavior="delete_matching")
+    return table.num_rows
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isfile(args.path_db):
+        raise RuntimeError(f"The provided database does not exist.\nProvided path: {args.path_db}")
+    conn = connect(args.path_db)
+    try:
+        if args.command == "query":
+            print("subject,session,acq,rec,metric,slice,value")
+            for row in query(conn, subject=args.subject, session=args.session, acq=args.acq, rec=args.rec,
+                             metric=args.metric):
+                sys.stdout.write(",".join(str(val) if val is not None else 'nan' for val in row) + "\n")
+        elif args.command == "export":
+            os.makedirs(args.path_output, exist_ok=True)
+            paths_csv = export_wide_tables(conn, args.path_output, acq=args.acq)
+            paths_csv += export_slice_wise_tables(conn, args.path_output)
+            print(f"Written {len(paths_csv)} files in {args.path_output}")
+        else:  # command == "parquet"
+            num_rows = export_parquet(conn, args.path_output)
+            print(f"Written {num_rows} rows in {args.path_output}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
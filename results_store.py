@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Sharded results store. Each metric script writes its results for one (subject, session, acq, rec) in its own small
+# JSON file (a "shard"), so that jobs running in parallel (e.g., `sct_run_batch -jobs N`) never read or rewrite a shared
+# file. The shards are stored under:
+#   /PATH/TO/RESULTS/shards/SUB-ID/SES-ID/SUB-ID_SES-ID_ACQ-REGION_REC_<metric>.json
+#
+# At the end of the batch, the shards are inserted in a single transaction into the results database (see results_db.py),
+# from which the wide tables are regenerated. The wide tables have the following structure:
+#
+# | Subject-ID/Session-ID | max rec-standard | max rec-navigated | mean rec-standard | mean rec-navigated |
+# |     sub-01/ses-01     |     0.000000     |      0.000000     |      0.000000     |      0.000000      |
+#
+#   /PATH/TO/RESULTS/results.sqlite
+#   /PATH/TO/RESULTS/ghosting_metrics.csv
+#   /PATH/TO/RESULTS/wm_std.csv
+#
+# How to use (merge the shards into the results database and the wide tables):
+#   ./results_store.py <path_results>
+#
+# Example:
+#   ./results_store.py ~/temp/ds006347_20250612_144520/results
+
+import os
+import glob
+import json
+import math
+import argparse
+
+import results_db
+from file_utils import write_atomic
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Merge the result shards into the results database and the wide tables (ghosting_metrics.csv,\
+        wm_std.csv) with the following columns:\
+        | Subject-ID/Session-ID | max rec-standard | max rec-navigated | mean rec-standard | mean rec-navigated |"
+    )
+    parser.add_argument("path_results", help="The path to the results directory.")
+    return parser
+
+
+# Define functions
+def to_json_value(val):
+    """Convert a value to a JSON-compatible float (NaN is stored as null)."""
+    if val is None:
+        return None
+    val = float(val)
+    return None if math.isnan(val) else val
+
+
+def get_shard_path(path_results, subject, session, acq, rec, metric):
+    """Return the path of the shard of one metric for one (subject, session, acq, rec)."""
+    return os.path.join(path_results, "shards", subject, session, f"{subject}_{session}_{acq}_{rec}_{metric}.json")
+
+
+def write_shard(path_results, subject, session, acq, rec, metric, max_value=None, mean_value=None, slice_wise=None):
+    """
+    Write the results of one metric for one (subject, session, acq, rec) in its own shard.
+
+    The summary values (maximum and mean over the slices) are stored as the `max_<metric>` and `mean_<metric>` metrics
+    of the results database, and the slice-wise values as the `<metric>` metric.
+    """
+    path_shard = get_shard_path(path_results, subject, session, acq, rec, metric)
+    os.makedirs(os.path.dirname(path_shard), exist_ok=True)
+    shard = {
+        "subject": subject,
+        "session": session,
+        "acq": acq,
+        "rec": rec,
+        "metric": metric,
+        "max": to_json_value(max_value),
+        "mean": to_json_value(mean_value),
+        "slice_wise": [to_json_value(val) for val in slice_wise] if slice_wise is not None else None,
+    }
+    write_atomic(path_shard, json.dumps(shard, indent=4))
+    return path_shard
+
+
+def read_shards(path_results):
+    """Read all the shards of the results directory."""
+    shards = []
+    for path_shard in glob.glob(os.path.join(path_results, "shards", "*", "*", "*.json")):
+        with open(path_shard, 'r') as f:
+            shards.append(json.load(f))
+    return shards
+
+
+def shard_to_records(shard):
+    """Convert a shard to (subject, session, acq, rec, metric, slice, value) records of the results database."""
+    key = (shard['subject'], shard['session'], shard['acq'], shard['rec'])
+    metric = shard['metric']
+    records = []
+    for stat in ['max', 'mean']:
+        if shard.get(stat) is not None:
+            records.append((*key, f"{stat}_{metric}", results_db.volume_slice, shard[stat]))
+    for z, val in enumerate(shard.get('slice_wise') or []):
+        records.append((*key, metric, z, val))
+    return records
+
+
+def compact_results(path_results):
+    """Merge all the shards into the results database in a single transaction, and regenerate the wide tables."""
+    records = [record for shard in read_shards(path_results) for record in shard_to_records(shard)]
+    path_db = os.path.join(path_results, results_db.file_db)
+    results_db.insert_records(path_db, records)
+    conn = results_db.connect(path_db)
+    try:
+        paths_csv = results_db.export_wide_tables(conn, path_results)
+    finally:
+        conn.close()
+    return [path_db] + paths_csv
+
+
+def main():
+    args = get_parser().parse_args()
+    if not os.path.isdir(args.path_results):
+        raise RuntimeError(f"The provided path does not exist.\nProvided path: {args.path_results}")
+    for path_csv in compact_results(args.path_results):
+        print(f"Written: {path_csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+#
+# Python batch orchestrator. Runs the same steps as process_data.sh for all the subjects/sessions of the dataset from a
+# single Python process: the metrics are computed by calling the library functions of the scripts, and subprocesses are
+# only started for the external SCT tools.
+#
+# The dataset is scanned once per batch (see dataset_index.py). For each subject/session, and for each acquisition
+# region and reconstruction found in the dataset index:
+#   1. Stage the images of the session in the processed data directory (see staging.py)
+#   2. Use the manual SC/GM segmentations of derivatives/labels if they exist, otherwise segment the navigated image
+#   3. Create the ghosting mask (navigated image only), detecting the body posterior tip automatically (in the processed
+#      data directory) if its label is missing from derivatives/labels
+#   4. Compute the slice-wise SNR/CNR, ghosting and WM STD metrics of both reconstructions in one paired pass, with the
+#      WM mask (SC - GM) derived in memory
+#   5. Verify the presence of the output files
+# Finally, the result shards are merged into the results database and the wide tables (see results_store.py).
+#
+# Within a session, the acquisition regions are processed concurrently, and the metrics of both reconstructions are
+# computed together as soon as the navigated derivatives they share exist (see process_acquisition). The external tools are run as asyncio
+# subprocesses with a maximum number of concurrent processes per tool (see tool_runner.py and `-tool-limits`), while the
+# metrics are computed in threads.
+#
+# The steps are incremental: when the batch is run again on the same output folder, a step is skipped if it was already
+# run with the same inputs, parameters and scripts (see step_manifest.py), unless `-force` is used. The steps are
+# defined in step_manifest.py, as for process_data.sh, so that an output folder of one driver is up to date for the other.
+#
+# With `-annotate`, the missing body posterior tip labels of all the subjects/sessions are first identified with the
+# viewer in a single annotation session (see annotate_posterior_tips.py), so that the sessions then run unattended.
+#
+# With `-batch-segmentation`, all the images which need an automatic segmentation are first segmented in a few SCT
+# processes (see batch_segment.py), and the sessions link the segmentations from the derivative cache.
+#
+# With `-jobs N`, the subjects/sessions are processed by a pool of N worker processes. Each worker imports numpy/nibabel
+# and the scripts once and processes several sessions. The metrics are sent back to the main process, which is the only
+# one writing the results.
+#
+# The output folder has the same structure as the one of `sct_run_batch -script process_data.sh`:
+#   /PATH/TO/OUTPUT/data_processed, results, log, qc
+#
+# How to use:
+#   ./run_batch.py -path-data <PATH_TO_DATA> -path-output <PATH_TO_OUTPUT> [-include-list sub-01/ses-01 ...] [-jobs N]
+#                  [-tool-limits sct_deepseg=2 ...] [-batch-segmentation [-batch-size N]] [-force] [-paired-diff]
+#                  [-save-wm-mask] [-tip-method auto|viewer] [-tip-max-gap N] [-annotate]
+#                  [-fake-tools]
+#
+# Example:
+#   ./run_batch.py -path-data ~/data/ds006347/ -path-output ~/temp/ds006347_20250612_144520
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import annotate_posterior_tips
+import batch_segment
+import compute_metrics
+import create_ghosting_mask
+import dataset_index
+import derivative_cache
+import results_store
+import staging
+import step_manifest
+from provenance import get_provenance
+from tool_runner import ToolRunner, create_shared_semaphores, parse_limits
+
+# Define variables
+ext = ".nii.gz"
+contrast = "T2starw"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Run the analysis pipeline (segmentation, SNR/CNR, ghosting and WM STD) on all the subjects/sessions\
+        of a dataset from a single Python process."
+    )
+    parser.add_argument("-path-data", required=True, help="Path to the BIDS dataset.")
+    parser.add_argument("-path-output", required=True, help="Path to the output folder.")
+    parser.add_argument("-include-list", nargs="+",
+                        help="Only process these subjects/sessions (e.g., sub-01/ses-01 sub-02/ses-01).")
+    parser.add_argument("-jobs", type=int, default=1,
+                        help="Number of subjects/sessions processed in parallel (default: 1). Use 0 for all the CPU cores.")
+    parser.add_argument("-tool-limits", nargs="+", metavar="TOOL=N",
+                        help="Maximum number of concurrent processes of a tool within a subject/session (e.g.,\
+                        sct_deepseg=2). See tool_runner.py for the default limits.")
+    parser.add_argument("-batch-segmentation", action="store_true",
+                        help="Segment all the images which need an automatic segmentation before processing the\
+                        subjects/sessions, in a few SCT processes (see batch_segment.py).")
+    parser.add_argument("-batch-size", type=int, default=batch_segment.default_batch_size,
+                        help="Maximum number of images segmented by each SCT process with -batch-segmentation\
+                        (default: %(default)s).")
+    parser.add_argument("-force", action="store_true",
+                        help="Run all the steps, even the ones which are up to date (see step_manifest.py).")
+    parser.add_argument("-paired-diff", action="store_true",
+                        help="Also write the slice-wise differences rec-navigated - rec-standard of each metric (see\
+                        compute_metrics.py).")
+    parser.add_argument("-save-wm-mask", action="store_true",
+                        help="Write the WM masks derived in the metrics pass to disk (see compute_metrics.py).")
+    parser.add_argument("-tip-method", choices=create_ghosting_mask.tip_methods,
+                        help="Method used to identify the body posterior tip when its label is missing (default:\
+                        auto, see create_ghosting_mask.py).")
+    parser.add_argument("-tip-max-gap", type=int,
+                        help="Maximum number of consecutive axial slices without body posterior tip label which are\
+                        filled by interpolation (default: 0, see create_ghosting_mask.py).")
+    parser.add_argument("-annotate", action="store_true",
+                        help="Identify all the missing body posterior tip labels with the viewer before running the\
+                        subjects/sessions (see annotate_posterior_tips.py).")
+    parser.add_argument("-fake-tools", action="store_true",
+                        help="Replace the SCT/FSL tools by the stand-ins of fake_tools.py (offline testing only, the\
+                        metrics are meaningless).")
+    return parser
+
+
+# Define functions
+def get_batch_paths(path_data, path_output):
+    """Return the folders used by the batch (same structure as sct_run_batch)."""
+    return {
+        'data': os.path.abspath(path_data),
+        'output': os.path.abspath(path_output),
+        'data_processed': os.path.join(os.path.abspath(path_output), "data_processed"),
+        'results': os.path.join(os.path.abspath(path_output), "results"),
+        'log': os.path.join(os.path.abspath(path_output), "log"),
+        'qc': os.path.join(os.path.abspath(path_output), "qc"),
+    }
+
+
+async def run_step(paths, subject, session, step, run):
+    """
+    Run a step of the pipeline (the coroutine function `run`), unless it is up to date: its outputs exist and it was
+    already run with the same inputs, parameters and scripts (see step_manifest.py).
+
+    :param step: Definition of the step (see step_manifest.get_session_steps)
+    :return: True if the step was run, False if it was skipped
+    """
+    if await asyncio.to_thread(step_manifest.is_step_up_to_date, paths['output'], subject, session, step):
+        print(f"{step['name']}: up to date, skipping")
+        return False
+    await run()
+    await asyncio.to_thread(step_manifest.record_step, paths['output'], subject, session, step)
+    return True
+
+
+async def compute_cached(path_output, inputs, params, compute):
+    """
+    Link a derivative from the cross-run derivative cache if it was already computed from the same inputs with the same
+    tool (see derivative_cache.py). Otherwise, compute it with the coroutine function `compute` and add it to the cache.
+
+    :return: True if the derivative was found in the cache
+    """
+    # The existing derivative may be hard linked to a cache entry (e.g., by a previous run with the cache enabled)
+    derivative_cache.remove_output(path_output)
+    if derivative_cache.get_cache_dir() is None:
+        await compute()
+        return False
+    key = await asyncio.to_thread(derivative_cache.get_key, inputs, params)
+    if await asyncio.to_thread(derivative_cache.fetch, key, path_output):
+        print(f"Found in the derivative cache: {path_output}")
+        return True
+    await compute()
+    await asyncio.to_thread(derivative_cache.store, key, path_output)
+    return False
+
+
+async def segment_if_does_not_exist(paths, subject, session, file, entry, label, runner, path_log):
+    """
+    Use the manual segmentation of derivatives/labels if it exists, otherwise segment the image.
+
+    :param entry: Entry of the image in the dataset index (see dataset_index.py)
+    :param label: "SC" (spinal cord) or "GM" (gray matter)
+    :return: File name (without extension) of the segmentation
+    """
+    path_anat = os.path.join(paths['data_processed'], subject, session, "anat")
+    file_seg = f"{file}_label-{label}_seg"
+    path_seg_manual = dataset_index.get_label_path(paths['data'], entry, f"label-{label}_seg")
+    qc_process = "sct_deepseg_sc" if label == "SC" else "sct_deepseg_gm"
+    qc_args = ["-qc", paths['qc'], "-qc-subject", f"{subject}_{session}"]
+    cmd_qc = ["sct_qc", "-i", file + ext, "-s", file_seg + ext, "-p", qc_process] + qc_args
+    step = step_manifest.get_segmentation_step(paths['data_processed'], subject, session, file, label, path_seg_manual,
+                                               get_provenance(paths['output'])['sct_version'])
+    path_seg = step['outputs'][0]
+    if path_seg_manual:
+        async def run():
+            print(f"Found! Using segmentation {path_seg_manual}")
+            staging.stage_file(path_seg_manual, path_seg)
+            await runner.run(cmd_qc, path_log, cwd=path_anat)
+    else:
+        if label == "SC":
+            cmd = ["sct_deepseg", "spinalcord", "-i", file + ext, "-o", file_seg + ext]
+        else:
+            cmd = ["sct_deepseg_gm", "-i", file + ext, "-o", file_seg + ext]
+
+        async def segment():
+            await runner.run(cmd + qc_args, path_log, cwd=path_anat)
+
+        async def run():
+            print(f"Segmentation {file_seg}{ext} not found. Proceeding with automatic segmentation.")
+            # The automatic segmentations are cached with the parameters of their step (tool and SCT version)
+            if await compute_cached(path_seg, step['inputs'], step['params'], segment):
+                await runner.run(cmd_qc, path_log, cwd=path_anat)
+    await run_step(paths, subject, session, step, run)
+    return file_seg
+
+
+def check_if_exists(paths, subject, session, acq, rec):
+    """Return the output files of an acquisition which do not exist."""
+    if rec != "rec-navigated":
+        return []
+    file = f"{subject}_{session}_{acq}_{rec}_{contrast}"
+    files_to_check = [f"{file}_label-SC_seg{ext}", f"{file}_label-GM_seg{ext}", f"{file}_ghostingMask{ext}"]
+    if compute_metrics.is_wm_mask_saved():
+        files_to_check.append(f"{file}_label-WM_seg{ext}")
+    path_anat = os.path.join(paths['data_processed'], subject, session, "anat")
+    return [os.path.join(path_anat, file) for file in files_to_check
+            if not os.path.exists(os.path.join(path_anat, file))]
+
+
+async def process_acquisition(paths, subject, session, acq, images_acq, runner, path_log, viewer_lock):
+    """
+    Process the images of an acquisition region as a task graph. The navigated derivatives (SC/GM segmentations,
+    ghosting mask) are computed once, and the metrics of each reconstruction start as soon as they exist:
+
+        SC seg --------+
+        GM seg --------+--> metrics rec-navigated + rec-standard (paired pass, WM mask derived in memory)
+        ghosting mask -+
+
+    :param images_acq: Entries of the images of the acquisition region in the dataset index, keyed by reconstruction
+    :return: dict with the metrics of each reconstruction (see compute_metrics.process_paired), or None if they are up
+             to date
+    """
+    file_navigated = f"{subject}_{session}_{acq}_rec-navigated_{contrast}"
+    entry_navigated = images_acq.get("rec-navigated", {'labels': {}})
+    recs_found = list(images_acq)
+    print(f"Processing {acq}: {', '.join(recs_found)}")
+
+    async def compute_segmentations():
+        # Always use the navigated segmentation (manually corrected) for both standard and navigated images
+        await asyncio.gather(
+            segment_if_does_not_exist(paths, subject, session, file_navigated, entry_navigated, "SC", runner, path_log),
+            segment_if_does_not_exist(paths, subject, session, file_navigated, entry_navigated, "GM", runner, path_log),
+        )
+
+    async def compute_ghosting_mask():
+        step = step_manifest.get_ghosting_mask_step(paths['data'], paths['data_processed'], subject, session, acq)
+
+        async def run():
+            # The body posterior tip is detected automatically if it does not exist, unless the interactive viewer is
+            # used (see create_ghosting_mask.py): only one viewer is opened at a time
+            if create_ghosting_mask.get_tip_method() != "viewer":
+                return await asyncio.to_thread(create_ghosting_mask.process, paths['data'], paths['data_processed'],
+                                               subject, session, acq)
+            async with viewer_lock:
+                return await asyncio.to_thread(create_ghosting_mask.process, paths['data'], paths['data_processed'],
+                                               subject, session, acq)
+        await run_step(paths, subject, session, step, run)
+
+    await asyncio.gather(compute_segmentations(), compute_ghosting_mask())
+    # The metrics are written by the main process, which records the manifest of the step once they are written
+    step = step_manifest.get_metrics_step(paths['data_processed'], subject, session, acq, recs_found)
+    if await asyncio.to_thread(step_manifest.is_step_up_to_date, paths['output'], subject, session, step):
+        print(f"Metrics of {acq}: up to date, skipping")
+        return None
+    # Compute slicewise SNR/CNR, ghosting and WM STD of the reconstructions in one pass (the masks are loaded once, and
+    # the WM mask is derived from the navigated segmentations)
+    return await asyncio.to_thread(compute_metrics.process_paired, paths['data_processed'], subject, session, acq,
+                                   recs_found, write=False)
+
+
+async def process_session_async(paths, subject, session, images, path_log, tool_options=None):
+    """Process the acquisition regions of a subject/session concurrently."""
+    runner = ToolRunner(**(tool_options or {}))
+    viewer_lock = asyncio.Lock()
+    results = await asyncio.gather(*[process_acquisition(paths, subject, session, acq, images_acq, runner, path_log,
+                                                         viewer_lock)
+                                     for acq, images_acq in images.items()])
+    metrics = {acq: result for acq, result in zip(images, results) if result is not None}
+    # Check if output files exist
+    missing_files = [path for acq, images_acq in images.items() for rec in images_acq
+                     for path in check_if_exists(paths, subject, session, acq, rec)]
+    return metrics, missing_files
+
+
+def process_session(paths, subject_session, images, tool_options=None):
+    """
+    Run all the steps of process_data.sh on a subject/session. The acquisition regions are processed concurrently, so
+    that the duration of the session is the one of its slowest region. The metrics are not written to the result files.
+
+    :param images: Images of the subject/session in the dataset index (see dataset_index.get_images)
+    :return: dict with the metrics of each acquisition (see process_acquisition), and the missing output files
+    """
+    subject, session = subject_session.split("/")
+    path_log = os.path.join(paths['log'], f"{subject}_{session}.log")
+    staging.stage_session(paths['data'], paths['data_processed'], subject, session, images)
+    metrics, missing_files = asyncio.run(process_session_async(paths, subject, session, images, path_log,
+                                                               tool_options))
+    return {'metrics': metrics, 'missing_files': missing_files}
+
+
+def run_session(paths, subject_session, images, tool_options=None):
+    """
+    Process a subject/session, writing its output to the log file of the session. This function is run by the workers,
+    so it never raises: errors are returned to the main process.
+    """
+    subject, session = subject_session.split("/")
+    path_log = os.path.join(paths['log'], f"{subject}_{session}.log")
+    with open(path_log, 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            result = process_session(paths, subject_session, images, tool_options)
+        except Exception:
+            traceback.print_exc()
+            return {'error': traceback.format_exc()}
+    return result
+
+
+def write_session_results(paths, subject_session, result):
+    """Write the results of a subject/session (main process only)."""
+    subject, session = subject_session.split("/")
+    for acq, metrics in result['metrics'].items():
+        compute_metrics.write_paired_results(paths['data_processed'], subject, session, acq, metrics)
+        recs_found = [rec for rec in metrics if rec != compute_metrics.rec_diff]
+        step_manifest.record_step(paths['output'], subject, session,
+                                  step_manifest.get_metrics_step(paths['data_processed'], subject, session, acq,
+                                                                 recs_found))
+    if result['missing_files']:
+        with open(os.path.join(paths['log'], "_error_check_output_files.log"), 'a') as f:
+            f.writelines(f"{path} does not exist\n" for path in result['missing_files'])
+
+
+def run_sessions(paths, index, sessions, jobs=1, tool_options=None):
+    """
+    Process the subjects/sessions and yield (subject_session, result) as soon as each session is done. With several
+    workers, the tool limits are shared by all the sessions (see tool_runner.create_shared_semaphores).
+    """
+    if jobs == 1:
+        for subject_session in sessions:
+            yield subject_session, run_session(paths, subject_session, dataset_index.get_images(index, subject_session),
+                                               tool_options)
+        return
+    tool_options = dict(tool_options or {})
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        tool_options['shared'] = create_shared_semaphores(manager, tool_options.get('limits'))
+        # Only the images of its session are sent to each worker, not the whole index
+        futures = {executor.submit(run_session, paths, subject_session,
+                                   dataset_index.get_images(index, subject_session), tool_options): subject_session
+                   for subject_session in sessions}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    try:
+        tool_limits = parse_limits(args.tool_limits)
+    except ValueError as e:
+        parser.error(str(e))
+    if not os.path.isdir(args.path_data):
+        print(f"Error: Provided path does not exist.\nProvided path: {args.path_data}")
+        sys.exit(1)
+
+    if args.force:
+        # Inherited by the worker processes
+        os.environ[step_manifest.env_force] = "1"
+    if args.save_wm_mask:
+        os.environ[compute_metrics.env_save_wm_mask] = "1"
+    if args.paired_diff:
+        os.environ[compute_metrics.env_paired_diff] = "1"
+    if args.tip_method:
+        os.environ[create_ghosting_mask.env_tip_method] = args.tip_method
+    if args.tip_max_gap is not None:
+        os.environ[create_ghosting_mask.env_max_gap] = str(args.tip_max_gap)
+
+    paths = get_batch_paths(args.path_data, args.path_output)
+    for folder in ['data_processed', 'results', 'log', 'qc']:
+        os.makedirs(paths[folder], exist_ok=True)
+
+    # Display useful info for the log, such as SCT version, RAM and CPU cores available
+    provenance = get_provenance(paths['output'])
+    print(provenance['sct_check_dependencies'])
+
+    start = time.time()
+    failed = []
+    # Scan the dataset once, the sessions query the index instead of probing the files
+    index = dataset_index.get_index(paths['data'], paths['output'])
+    sessions = dataset_index.get_sessions(index, args.include_list)
+    tool_options = {'limits': tool_limits, 'fake': args.fake_tools}
+    if args.annotate:
+        # The labels which could not be identified are left to the sessions (see -tip-method)
+        annotate_posterior_tips.annotate_sessions(index, paths['output'], sessions)
+        index = dataset_index.get_index(paths['data'], paths['output'])
+    if args.batch_segmentation:
+        # The segmentations are passed to the sessions through the derivative cache (inherited by the worker processes)
+        if derivative_cache.get_cache_dir() is None:
+            os.environ[derivative_cache.env_cache_dir] = os.path.join(paths['output'], "derivative_cache")
+        batch_segment.segment_sessions(index, paths['output'], sessions, provenance['sct_version'],
+                                       args.batch_size, args.fake_tools)
+    for subject_session, result in run_sessions(paths, index, sessions, jobs=args.jobs, tool_options=tool_options):
+        # Keep processing the other sessions if one fails, as sct_run_batch does
+        if 'error' in result:
+            print(f"{subject_session}: failed, see {os.path.join(paths['log'], subject_session.replace('/', '_'))}.log")
+            failed.append(subject_session)
+            continue
+        print(f"{subject_session}: done")
+        write_session_results(paths, subject_session, result)
+
+    # Merge the results of all the sessions
+    results_store.compact_results(paths['results'])
+
+    # Display useful info for the log
+    runtime = int(time.time() - start)
+    print("\n~~~")
+    print(f"SCT version: {provenance['sct_version']}")
+    print(f"Ran on:      {provenance['uname']}")
+    print(f"Duration:    {runtime // 3600}hrs {(runtime // 60) % 60}min {runtime % 60}sec")
+    if failed:
+        print(f"Failed:      {' '.join(failed)}")
+    print("~~~")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Segmentation worker of batch_segment.py. It is run with the Python interpreter of SCT, and segments a list of images
+# in a single process by calling the entry points of `sct_deepseg spinalcord` and `sct_deepseg_gm` one after the
+# other: the interpreter, PyTorch and the SCT modules are only loaded once for all the images. The models themselves are
+# still loaded by SCT for every image, as its entry points and inference functions (e.g.,
+# `spinalcordtoolbox.deepseg.inference.segment_and_average_volumes`) load the model inside each call and do not accept
+# an already loaded model.
+#
+# The jobs are read from a JSON file (list of {"tool": "sct_deepseg"|"sct_deepseg_gm", "input": ..., "output": ...}),
+# and the names of the outputs which were written are printed as JSON on the last line of the output.
+#
+# How to use:
+#   <SCT_PYTHON> segment_worker.py <path_jobs> [-fake-tools]
+
+import sys
+import json
+import argparse
+import traceback
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Segment a list of images in a single SCT process.")
+    parser.add_argument("path_jobs", help="JSON file with the list of images to segment.")
+    parser.add_argument("-fake-tools", action="store_true",
+                        help="Use the stand-in segmenter of fake_tools.py instead of SCT (offline testing only).")
+    return parser
+
+
+# Define functions
+def get_segmenters(fake=False):
+    """Return the functions segmenting an image for each tool, called with the arguments of the command line tool."""
+    if fake:
+        import fake_tools
+        return {tool: (lambda argv, tool=tool: fake_tools.segment(tool, argv)) for tool in fake_tools.half_width}
+    from spinalcordtoolbox.scripts import sct_deepseg, sct_deepseg_gm
+    return {
+        "sct_deepseg": lambda argv: sct_deepseg.main(["spinalcord"] + argv),
+        "sct_deepseg_gm": sct_deepseg_gm.main,
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    with open(args.path_jobs, 'r') as f:
+        jobs = json.load(f)
+    segmenters = get_segmenters(args.fake_tools)
+    done = []
+    for job in jobs:
+        print(f"\n{job['tool']} -i {job['input']} -o {job['output']}", flush=True)
+        try:
+            segmenters[job['tool']](["-i", job['input'], "-o", job['output']])
+        except SystemExit as e:
+            # The SCT scripts exit with status 0 on success
+            if e.code not in (None, 0):
+                print(f"Failed: {job['input']} (exit status {e.code})")
+                continue
+        except Exception:
+            traceback.print_exc()
+            print(f"Failed: {job['input']}")
+            continue
+        done.append(job['output'])
+    print(json.dumps(done))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
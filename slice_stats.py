@@ -0,0 +1,66 @@
+# Slice-wise statistics of a volume inside a mask, shared by the metric scripts.
+#
+# The voxels inside the mask are gathered once (ordered by axial slice) and the statistics of every axial slice are
+# obtained with bincount/reduceat over the slice indices, so that no masked array or per-slice temporary is created.
+# Slices without any voxel inside the mask get NaN, as np.ma.mean/np.ma.std do for fully masked slices.
+#
+# Several volumes sharing the same mask (e.g., the rec-standard and rec-navigated images of an acquisition) can be
+# stacked along a 4th axis: the mask is then only gathered once, and each statistic has one column per volume.
+#
+# How to use:
+#   from slice_stats import compute_slice_stats
+#   stats = compute_slice_stats(anat_data, mask_data)
+#   stats['mean'], stats['std'], ...
+
+import numpy as np
+
+
+def compute_slice_stats(data, mask, ddof=0):
+    """
+    Compute the slice-wise (along z) statistics of `data` inside `mask`.
+
+    :param data: 3D array, or 4D array of volumes stacked along the last axis
+    :param mask: 3D array with the same shape as the volumes of `data`. Boolean masks are used as is, other masks are
+                 binarized with `mask != 0`.
+    :param ddof: Delta degrees of freedom used to compute the STD (0 to match np.ma.std, 1 to match fslstats -S).
+    :return: dict with the following arrays: 'count' (length nslices), and 'sum', 'sum_sq', 'mean', 'std', 'min', 'max'
+             (length nslices for 3D data, shape (nslices, nvolumes) for 4D data)
+    """
+    data = np.asanyarray(data)
+    mask = np.asanyarray(mask)
+    if data.shape[:3] != mask.shape or data.ndim not in (3, 4):
+        raise ValueError(f"The data and the mask must have the same shape: {data.shape} != {mask.shape}")
+    if mask.dtype != bool:
+        mask = mask != 0
+    nslices = data.shape[2]
+
+    # Gather the voxels inside the mask, sorted by slice (one column per volume)
+    z, x, y = np.nonzero(np.moveaxis(mask, 2, 0))
+    nvolumes = data.shape[3] if data.ndim == 4 else 1
+    values = np.asarray(data[x, y, z], dtype=np.float64).reshape(len(z), nvolumes)
+
+    count = np.bincount(z, minlength=nslices)
+    total = np.column_stack([np.bincount(z, weights=column, minlength=nslices) for column in values.T])
+    total_sq = np.column_stack([np.bincount(z, weights=column * column, minlength=nslices) for column in values.T])
+
+    mean = np.full((nslices, nvolumes), np.nan)
+    std = np.full((nslices, nvolumes), np.nan)
+    minimum = np.full((nslices, nvolumes), np.nan)
+    maximum = np.full((nslices, nvolumes), np.nan)
+    nonempty = count > 0
+    mean[nonempty] = total[nonempty] / count[nonempty, np.newaxis]
+    if values.size:
+        # The STD is computed from the deviations to the mean rather than from `sum_sq` to avoid cancellation errors
+        dev = values - mean[z]
+        sq_dev = np.column_stack([np.bincount(z, weights=column * column, minlength=nslices) for column in dev.T])
+        valid = count > ddof
+        std[valid] = np.sqrt(sq_dev[valid] / (count[valid, np.newaxis] - ddof))
+        # `z` is sorted, so each non-empty slice is a contiguous segment of `values`
+        starts = (np.cumsum(count) - count)[nonempty]
+        minimum[nonempty] = np.minimum.reduceat(values, starts, axis=0)
+        maximum[nonempty] = np.maximum.reduceat(values, starts, axis=0)
+
+    stats = {'sum': total, 'sum_sq': total_sq, 'mean': mean, 'std': std, 'min': minimum, 'max': maximum}
+    if data.ndim == 3:
+        stats = {key: value[:, 0] for key, value in stats.items()}
+    return {'count': count, **stats}
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Stage the input files of the batch in the processed data folder without copying them when possible. Only the files
+# needed by the pipeline are staged (the T2starw images of each acquisition region and reconstruction), and each file
+# is staged with the cheapest method supported by the filesystem:
+#   1. reflink (copy-on-write clone, e.g., on Btrfs/XFS)
+#   2. hard link (same filesystem; the staged images are only read by the pipeline)
+#   3. copy
+# A file which is already staged (same size and modification time) is left untouched, so that staging the scripts and
+# participants.tsv for every subject only costs a few stat calls after the first one. The scripts and participants.tsv
+# are never hard linked, so that the staged copies are not modified when the originals are edited.
+#
+# With -path-output, the images of the session are taken from the dataset index of the batch (see dataset_index.py)
+# instead of being probed in the dataset, and with -index, from the extract of the subject/session written by
+# `dataset_index.py -session SUB-ID/SES-ID -extract <path_extract>`.
+#
+# How to use:
+#   ./staging.py session <path_data> <path_data_processed> <subject/session> [-path-output <path_output>] [-index <path_extract>]
+#   ./staging.py scripts <path_scripts> <path_output>
+#   ./staging.py file <path_src> <path_dst>
+#
+# Example:
+#   ./staging.py session ~/data/ds006347 ~/temp/ds006347_20250612_144520/data_processed sub-01/ses-01
+
+import os
+import glob
+import fcntl
+import shutil
+import argparse
+
+import dataset_index
+
+# Define variables
+ext = ".nii.gz"
+contrast = "T2starw"
+acqs = ["acq-upperT", "acq-lowerT", "acq-LSE"]
+recs = ["rec-navigated", "rec-standard"]
+# ioctl of Linux cloning a file (reflink)
+FICLONE = 0x40049409
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Stage the input files of the batch with reflinks or hard links when possible, instead of copies."
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_session = subparsers.add_parser("session",
+                                           help="Stage the images of a subject/session and participants.tsv.")
+    parser_session.add_argument("path_data", help="Path to the BIDS dataset.")
+    parser_session.add_argument("path_data_processed", help="Path to the processed data folder.")
+    parser_session.add_argument("subject_session", help="Subject/session to stage (e.g., sub-01/ses-01).")
+    parser_session.add_argument("-path-output",
+                                help="Path to the output folder of the batch, to use its dataset index.")
+    parser_session.add_argument("-index", help="Path to the extract of the dataset index of the subject/session.")
+    parser_scripts = subparsers.add_parser("scripts", help="Stage the scripts of the pipeline.")
+    parser_scripts.add_argument("path_scripts", help="Path to the folder of the scripts.")
+    parser_scripts.add_argument("path_output", help="Path to the output folder of the batch.")
+    parser_file = subparsers.add_parser("file", help="Stage a single file (e.g., a manual segmentation).")
+    parser_file.add_argument("path_src", help="Path to the file.")
+    parser_file.add_argument("path_dst", help="Path to the staged file.")
+    return parser
+
+
+# Define functions
+def is_staged(path_src, path_dst):
+    """Return True if the destination has the same size and modification time as the source."""
+    if not os.path.isfile(path_dst):
+        return False
+    stat_src, stat_dst = os.stat(path_src), os.stat(path_dst)
+    return stat_src.st_size == stat_dst.st_size and stat_src.st_mtime_ns == stat_dst.st_mtime_ns
+
+
+def reflink(path_src, path_dst):
+    """Clone a file with a reflink. Raises OSError if the filesystem does not support it."""
+    with open(path_src, 'rb') as src, open(path_dst, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(path_src, path_dst)
+
+
+def stage_file(path_src, path_dst, allow_hardlink=True):
+    """
+    Stage a file with a reflink, a hard link (if `allow_hardlink`) or a copy, unless it is already staged.
+
+    :return: Method used ("reflink", "hardlink", "copy"), or None if the file was already staged
+    """
+    if is_staged(path_src, path_dst):
+        return None
+    os.makedirs(os.path.dirname(path_dst) or ".", exist_ok=True)
+    path_tmp = f"{path_dst}.tmp{os.getpid()}"
+    try:
+        reflink(path_src, path_tmp)
+        method = "reflink"
+    except OSError:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        method = "copy"
+        if allow_hardlink:
+            try:
+                os.link(path_src, path_tmp)
+                method = "hardlink"
+            except OSError:
+                pass
+        if method == "copy":
+            shutil.copy2(path_src, path_tmp)
+    os.replace(path_tmp, path_dst)
+    return method
+
+
+def get_session_files(path_data, subject, session, images=None):
+    """
+    Return the paths (relative to the dataset) of the images of a subject/session needed by the pipeline. If `images`
+    (the images of the session in the dataset index, see dataset_index.get_images) is given, the dataset is not probed.
+    """
+    if images is not None:
+        return [entry['file'] for images_acq in images.values() for entry in images_acq.values()]
+    files = [os.path.join(subject, session, "anat", f"{subject}_{session}_{acq}_{rec}_{contrast}{ext}")
+             for acq in acqs for rec in recs]
+    return [file for file in files if os.path.isfile(os.path.join(path_data, file))]
+
+
+def stage_session(path_data, path_data_processed, subject, session, images=None):
+    """
+    Stage the images of a subject/session and the list of participants in the processed data folder (see
+    get_session_files for `images`).
+    """
+    methods = {}
+    path_participants = os.path.join(path_data, "participants.tsv")
+    if os.path.isfile(path_participants):
+        stage_file(path_participants, os.path.join(path_data_processed, "participants.tsv"), allow_hardlink=False)
+    os.makedirs(os.path.join(path_data_processed, subject, session, "anat"), exist_ok=True)
+    for file in get_session_files(path_data, subject, session, images):
+        method = stage_file(os.path.join(path_data, file), os.path.join(path_data_processed, file))
+        methods[method] = methods.get(method, 0) + 1
+    return methods
+
+
+def stage_scripts(path_scripts, path_output, exception_file="process_data.sh"):
+    """Stage the Python and shell scripts of the pipeline in the output folder (copies, never hard links)."""
+    for path_script in glob.glob(os.path.join(path_scripts, "*.py")) + glob.glob(os.path.join(path_scripts, "*.sh")):
+        if os.path.basename(path_script) != exception_file:
+            stage_file(path_script, os.path.join(path_output, os.path.basename(path_script)), allow_hardlink=False)
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.action == "session":
+        subject, session = args.subject_session.split("/")
+        images = None
+        if args.index:
+            images = dataset_index.get_images(dataset_index.read_extract(args.index), args.subject_session)
+        elif args.path_output:
+            index = dataset_index.get_index(args.path_data, args.path_output, sessions=[args.subject_session])
+            images = dataset_index.get_images(index, args.subject_session)
+        methods = stage_session(args.path_data, args.path_data_processed, subject, session, images)
+        print(f"Staged {args.subject_session}: " + ", ".join(f"{n} {method or 'already staged'}"
+                                                              for method, n in methods.items()))
+    elif args.action == "scripts":
+        stage_scripts(args.path_scripts, args.path_output)
+    else:
+        stage_file(args.path_src, args.path_dst)
+
+
+if __name__ == "__main__":
+    main()
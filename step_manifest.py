@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+#
+# Make-style incremental execution. After a step of the pipeline is run, a manifest records the state of its inputs
+# (size, modification time and SHA-1 of each file), its parameters (e.g., `width_mm`, SCT version) and the version of
+# the scripts implementing it (SHA-1 of their content). When the pipeline is run again on the same output folder, a
+# step is skipped if its outputs exist and are unchanged, and if its inputs, parameters and scripts are the same as
+# when it was run. The manifests are stored under:
+#   /PATH/TO/OUTPUT/manifests/SUB-ID/SES-ID/<name>.json
+#
+# The files are only hashed again when their size or modification time changed, so checking an up-to-date step is
+# cheap. All the steps are run again if the environment variable GRE1DNAV_FORCE is set to 1.
+#
+# The steps of a subject/session (name, inputs, outputs and parameters) are defined once in this file (see
+# get_session_steps), and used by both run_batch.py and process_data.sh, so that a folder processed by one of them is up
+# to date for the other one. process_data.sh gets the steps to run with `plan`, which saves the steps of the
+# subject/session, and records the ones which were run with `record`.
+#
+# How to use:
+#   ./step_manifest.py plan <path_data> <path_data_processed> <SUB-ID/SES-ID> [-index <path_extract>]
+#   ./step_manifest.py record <path_data_processed> <SUB-ID/SES-ID> <name> [<name> ...]
+# `plan` prints the names of the steps which need to be run, one per line: the steps which are not up to date, and the
+# ones which depend on their outputs.
+#
+# Example:
+#   ./step_manifest.py plan ~/data/ds006347 ~/temp/ds006347_20250612_144520/data_processed sub-01/ses-01
+
+import os
+import json
+import argparse
+
+import compute_metrics
+import create_ghosting_mask
+import dataset_index
+from provenance import get_provenance
+from file_utils import hash_file, write_atomic
+
+# Define variables
+env_force = "GRE1DNAV_FORCE"
+path_scripts = os.path.dirname(os.path.abspath(__file__))
+# Scripts implementing each step: a change in one of them invalidates the outputs of the step
+step_scripts = {
+    "segmentation": [],
+    "ghosting_mask": ["create_ghosting_mask.py"],
+    "metrics": ["compute_metrics.py", "compute_snr_cnr.py", "compute_ghosting.py", "compute_wm_std.py",
+                "slice_stats.py", "nifti_cache.py", "results_store.py"],
+}
+# Tools of the automatic segmentations, recorded in the parameters of their step and in the keys of the derivative cache
+segmentation_tools = {"SC": "sct_deepseg_spinalcord", "GM": "sct_deepseg_gm"}
+# Name of the manifest listing the steps of a subject/session, saved by `plan` and read by `record`
+name_plan = "plan"
+ext = ".nii.gz"
+contrast = "T2starw"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Print the steps of a subject/session which need to be run, or record their state after they were\
+        run."
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    parser_plan = subparsers.add_parser(
+        "plan", help="Save the steps of the subject/session, and print the names of the ones which need to be run.")
+    parser_plan.add_argument("path_data", help="Path to the BIDS dataset.")
+    parser_plan.add_argument("path_data_processed", help="Path to the processed data folder.")
+    parser_plan.add_argument("subject_session", help="Subject/session (e.g., sub-01/ses-01).")
+    parser_plan.add_argument("-index", help="Path to the extract of the dataset index of the subject/session (default:\
+                             the dataset index of the output folder).")
+    parser_record = subparsers.add_parser("record", help="Record the state of steps of the plan after they were run.")
+    parser_record.add_argument("path_data_processed", help="Path to the processed data folder.")
+    parser_record.add_argument("subject_session", help="Subject/session (e.g., sub-01/ses-01).")
+    parser_record.add_argument("names", nargs="+", help="Names of the steps.")
+    return parser
+
+
+# Define functions
+def get_manifest_path(path_output, subject, session, name):
+    """Return the path of the manifest of a step (e.g., name="acq-LSE_ghosting_mask")."""
+    return os.path.join(path_output, "manifests", subject, session, f"{name}.json")
+
+
+def get_file_state(path, previous=None):
+    """
+    Return the size, modification time and SHA-1 of a file (None if it does not exist). The file is only hashed again if
+    its size or modification time differ from the `previous` state.
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': hash_file(path)}
+
+
+def get_scripts_version(step):
+    """Return the SHA-1 of the scripts implementing a step."""
+    return {script: hash_file(os.path.join(path_scripts, script)) for script in step_scripts[step]}
+
+
+def normalize_params(params):
+    """Convert the parameters to strings, so that they compare equal to the ones read from the manifest."""
+    return {key: str(value) for key, value in (params or {}).items()}
+
+
+def read_manifest(path_manifest):
+    """Read a manifest, or return None if it does not exist or cannot be read."""
+    try:
+        with open(path_manifest, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_same_state(states, paths):
+    """Return True if the files still have the recorded states (hashing only the ones whose size or mtime changed)."""
+    if sorted(states) != sorted(os.path.abspath(path) for path in paths):
+        return False
+    for path, state in states.items():
+        current = get_file_state(path, previous=state)
+        if current is None or current['sha1'] != state['sha1']:
+            return False
+    return True
+
+
+def is_up_to_date(path_manifest, step, inputs, outputs, params=None):
+    """Return True if the step was already run with the same inputs, parameters and scripts, and its outputs exist."""
+    if os.environ.get(env_force) == "1":
+        return False
+    manifest = read_manifest(path_manifest)
+    if manifest is None or manifest.get('step') != step:
+        return False
+    return (manifest['params'] == normalize_params(params)
+            and manifest['scripts'] == get_scripts_version(step)
+            and is_same_state(manifest['inputs'], inputs)
+            and is_same_state(manifest['outputs'], outputs))
+
+
+def record(path_manifest, step, inputs, outputs, params=None):
+    """Save the state of a step after it was run."""
+    missing = [path for path in list(inputs) + list(outputs) if not os.path.isfile(path)]
+    if missing:
+        raise RuntimeError(f"Cannot record the step {step}, the following files do not exist: {', '.join(missing)}")
+    manifest = {
+        'step': step,
+        'params': normalize_params(params),
+        'scripts': get_scripts_version(step),
+        'inputs': {os.path.abspath(path): get_file_state(path) for path in inputs},
+        'outputs': {os.path.abspath(path): get_file_state(path) for path in outputs},
+    }
+    os.makedirs(os.path.dirname(path_manifest), exist_ok=True)
+    write_atomic(path_manifest, json.dumps(manifest, indent=4))
+
+
+def get_segmentation_step(path_processed_data, subject, session, file, label, path_seg_manual, sct_version):
+    """
+    Return the step segmenting an image (label: "SC" or "GM"), or staging its manual segmentation `path_seg_manual` if
+    it exists. A step is a dict with its name, the type of the step, its inputs, outputs and parameters.
+    """
+    path_anat = os.path.join(path_processed_data, subject, session, "anat")
+    file_seg = f"{file}_label-{label}_seg"
+    return {
+        'name': file_seg,
+        'step': "segmentation",
+        'inputs': [path_seg_manual or os.path.join(path_anat, file + ext)],
+        'outputs': [os.path.join(path_anat, file_seg + ext)],
+        'params': {'tool': "manual" if path_seg_manual else segmentation_tools[label], 'sct_version': sct_version},
+    }
+
+
+def get_ghosting_mask_step(path_data, path_processed_data, subject, session, acq):
+    """
+    Return the step creating the ghosting mask of an acquisition (see create_ghosting_mask.py). The manual label of the
+    body posterior tip is one of its inputs, and the label detected automatically (when the manual one is missing) one
+    of its outputs.
+    """
+    paths = create_ghosting_mask.get_paths(path_data, path_processed_data, subject, session, acq)
+    tip_method = create_ghosting_mask.get_tip_method()
+    inputs, outputs = [paths['anat']], [paths['ghosting_mask']]
+    if os.path.exists(paths['body_post_tip']) or tip_method == "viewer":
+        inputs.append(paths['body_post_tip'])
+    else:
+        outputs.append(paths['body_post_tip_auto'])
+    return {
+        'name': f"{subject}_{session}_{acq}_rec-navigated_{contrast}_ghostingMask",
+        'step': "ghosting_mask",
+        'inputs': inputs,
+        'outputs': outputs,
+        'params': {'width_mm': create_ghosting_mask.width_mm, 'tip_method': tip_method},
+    }
+
+
+def get_metrics_step(path_processed_data, subject, session, acq, recs_paired):
+    """Return the step computing the metrics of the reconstructions of an acquisition in one paired pass."""
+    return {
+        'name': f"{subject}_{session}_{acq}_{contrast}_metrics",
+        'step': "metrics",
+        'inputs': compute_metrics.get_paired_input_paths(path_processed_data, subject, session, acq, recs_paired),
+        'outputs': compute_metrics.get_paired_output_paths(path_processed_data, subject, session, acq, recs_paired,
+                                                           save_wm=compute_metrics.is_wm_mask_saved(),
+                                                           diff=compute_metrics.is_paired_diff_written()),
+        'params': {},
+    }
+
+
+def get_session_steps(path_data, path_processed_data, subject_session, images, sct_version):
+    """
+    Return the steps of a subject/session in the order they are run: for each acquisition region, the SC and GM
+    segmentations and the ghosting mask of the navigated image, then the metrics of its reconstructions.
+
+    :param images: Images of the subject/session in the dataset index (see dataset_index.get_images)
+    """
+    subject, session = subject_session.split("/")
+    steps = []
+    for acq, images_acq in images.items():
+        file = f"{subject}_{session}_{acq}_rec-navigated_{contrast}"
+        entry = images_acq.get("rec-navigated", {'labels': {}})
+        for label in segmentation_tools:
+            path_seg_manual = dataset_index.get_label_path(path_data, entry, f"label-{label}_seg")
+            steps.append(get_segmentation_step(path_processed_data, subject, session, file, label, path_seg_manual,
+                                               sct_version))
+        steps.append(get_ghosting_mask_step(path_data, path_processed_data, subject, session, acq))
+        steps.append(get_metrics_step(path_processed_data, subject, session, acq, list(images_acq)))
+    return steps
+
+
+def is_step_up_to_date(path_output, subject, session, step):
+    """Return True if a step (see get_session_steps) is up to date (see is_up_to_date)."""
+    return is_up_to_date(get_manifest_path(path_output, subject, session, step['name']), step['step'], step['inputs'],
+                         step['outputs'], step['params'])
+
+
+def record_step(path_output, subject, session, step):
+    """Save the state of a step (see get_session_steps) after it was run."""
+    record(get_manifest_path(path_output, subject, session, step['name']), step['step'], step['inputs'],
+           step['outputs'], step['params'])
+
+
+def plan(path_output, subject_session, steps):
+    """
+    Save the steps of a subject/session (see record_plan), and return the names of the ones which need to be run: the
+    steps which are not up to date, and the ones using an output of such a step.
+    """
+    subject, session = subject_session.split("/")
+    outputs_to_run = set()
+    names = []
+    for step in steps:
+        inputs = {os.path.abspath(path) for path in step['inputs']}
+        if inputs & outputs_to_run or not is_step_up_to_date(path_output, subject, session, step):
+            names.append(step['name'])
+            outputs_to_run.update(os.path.abspath(path) for path in step['outputs'])
+    path_plan = get_manifest_path(path_output, subject, session, name_plan)
+    os.makedirs(os.path.dirname(path_plan), exist_ok=True)
+    write_atomic(path_plan, json.dumps(steps, indent=4))
+    return names
+
+
+def record_plan(path_output, subject_session, names):
+    """Record the state of the steps of the saved plan of a subject/session (see plan) which were run."""
+    subject, session = subject_session.split("/")
+    with open(get_manifest_path(path_output, subject, session, name_plan), 'r') as f:
+        steps = {step['name']: step for step in json.load(f)}
+    for name in names:
+        record_step(path_output, subject, session, steps[name])
+
+
+def main():
+    args = get_parser().parse_args()
+    path_output = os.path.join(args.path_data_processed, "..")
+    if args.action == "plan":
+        if args.index:
+            index = dataset_index.read_extract(args.index)
+        else:
+            index = dataset_index.get_index(args.path_data, path_output, sessions=[args.subject_session])
+        steps = get_session_steps(args.path_data, args.path_data_processed, args.subject_session,
+                                  dataset_index.get_images(index, args.subject_session),
+                                  get_provenance(path_output)['sct_version'])
+        for name in plan(path_output, args.subject_session, steps):
+            print(name)
+    else:
+        record_plan(path_output, args.subject_session, args.names)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+import nibabel as nib
+
+import create_ghosting_mask
+
+
+def create_body(nx=21, ny=30, nslices=3, x_range=(4, 17), y_posterior=10):
+    """Return an image with a box of tissue, whose posterior boundary is flat."""
+    data = np.zeros((nx, ny, nslices), dtype=np.float32)
+    data[x_range[0]:x_range[1], y_posterior:] = 100
+    return data
+
+
+def test_tip_on_flat_boundary_is_at_the_center():
+    labels, undetected_slices = create_ghosting_mask.detect_body_posterior_tip(create_body(), 5, 3)
+    assert undetected_slices.tolist() == []
+    assert np.argwhere(labels).tolist() == [[10, 10, z] for z in range(3)]
+
+
+def test_provenance_is_not_written_next_to_the_dataset(tmp_path):
+    path_data = str(tmp_path / "data")
+    assert create_ghosting_mask.get_output_path(path_data, path_data) == str(tmp_path / "data" / "derivatives")
+    path_processed_data = str(tmp_path / "output" / "data_processed")
+    assert create_ghosting_mask.get_output_path(path_data, path_processed_data) == str(
+        tmp_path / "output" / "data_processed" / "..")
+
+
+def test_slice_without_tissue_takes_the_nearest_tip():
+    data = create_body(nslices=4)
+    data[..., 0] = 0
+    data[..., 2:] = create_body(nslices=2, x_range=(6, 19), y_posterior=12)
+    data[..., 3] = 0
+    labels, undetected_slices = create_ghosting_mask.detect_body_posterior_tip(data, 5, 3)
+    assert undetected_slices.tolist() == [0, 3]
+    assert np.argwhere(labels).tolist() == [[10, 10, 0], [10, 10, 1], [12, 12, 2], [12, 12, 3]]
+
+
+def test_interpolation_of_missing_slices():
+    labels = np.zeros((20, 30, 7), dtype=np.uint8)
+    labels[5, 10, 1] = 1
+    labels[9, 14, 5] = 1
+    empty_slices = create_ghosting_mask.get_empty_slices(labels)
+    assert empty_slices.tolist() == [0, 2, 3, 4, 6]
+    assert create_ghosting_mask.get_longest_gap(empty_slices) == 3
+    filled = create_ghosting_mask.interpolate_body_posterior_tip(labels, empty_slices)
+    # Interpolated between the labeled slices, and extended at the ends
+    assert np.argwhere(filled).tolist() == [[5, 10, 0], [5, 10, 1], [6, 11, 2], [7, 12, 3], [8, 13, 4], [9, 14, 5],
+                                            [9, 14, 6]]
+
+
+def test_fill_records_interpolated_slices(tmp_path):
+    path_label, path_json = str(tmp_path / "label.nii.gz"), str(tmp_path / "label.json")
+    labels = np.zeros((20, 30, 3), dtype=np.uint8)
+    labels[5, 10, 0] = labels[9, 14, 2] = 1
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), path_label)
+    create_ghosting_mask.write_label_json(path_json, "auto", undetected_slices=[])
+    create_ghosting_mask.fill_body_posterior_tip(path_label, path_json, np.array([1]))
+    assert np.argwhere(np.asanyarray(nib.load(path_label).dataobj))[1].tolist() == [7, 12, 1]
+    with open(path_json, 'r') as f:
+        sidecar = json.load(f)
+    assert sidecar["InterpolatedSlices"] == [1]
+    assert sidecar["GeneratedBy"][-1]["Name"] == create_ghosting_mask.tip_interpolation
+
+
+def test_ghosting_mask_matches_slice_by_slice_rectangles():
+    shape, half_width_pix = (20, 30, 4), 3
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[1, 10, 0] = labels[10, 14, 1] = labels[18, 5, 3] = 1
+    mask = create_ghosting_mask.compute_ghosting_mask(labels, shape, half_width_pix)
+    expected = np.zeros(shape, dtype=np.uint8)
+    for z in [0, 1, 3]:
+        x_tip, y_tip = np.argwhere(labels[:, :, z] > 0)[0]
+        expected[max(x_tip - half_width_pix, 0):x_tip + half_width_pix, :y_tip, z] = 1
+    np.testing.assert_array_equal(mask, expected)
+    # No tip: empty mask
+    assert not mask[..., 2].any()
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+import dataset_index
+
+
+def create_dataset(path_data, sessions):
+    for subject_session in sessions:
+        subject, session = subject_session.split("/")
+        path_anat = os.path.join(path_data, subject_session, "anat")
+        os.makedirs(path_anat)
+        for rec in dataset_index.recs:
+            nib.save(nib.Nifti1Image(np.zeros((4, 4, 3), dtype=np.uint8), np.eye(4)),
+                     os.path.join(path_anat, f"{subject}_{session}_acq-LSE_{rec}_T2starw.nii.gz"))
+
+
+def add_label(path_data, subject_session, suffix):
+    subject, session = subject_session.split("/")
+    path_labels = os.path.join(path_data, "derivatives", "labels", subject_session, "anat")
+    os.makedirs(path_labels, exist_ok=True)
+    path_label = os.path.join(path_labels, f"{subject}_{session}_acq-LSE_rec-navigated_T2starw_{suffix}.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 3), dtype=np.uint8), np.eye(4)), path_label)
+    return path_label
+
+
+def get_labels(index, subject_session):
+    return dataset_index.get_images(index, subject_session)["acq-LSE"]["rec-navigated"]['labels']
+
+
+def test_index_is_updated_incrementally(tmp_path, monkeypatch):
+    path_data, path_output = str(tmp_path / "data"), str(tmp_path / "output")
+    create_dataset(path_data, ["sub-01/ses-01", "sub-02/ses-01"])
+    index = dataset_index.get_index(path_data, path_output)
+    assert dataset_index.get_sessions(index) == ["sub-01/ses-01", "sub-02/ses-01"]
+    assert list(dataset_index.get_images(index, "sub-01/ses-01")["acq-LSE"]) == dataset_index.recs
+
+    add_label(path_data, "sub-01/ses-01", "label-SC_seg")
+    headers_read = []
+    read_image_info = dataset_index.read_image_info
+    monkeypatch.setattr(dataset_index, "read_image_info", lambda path: headers_read.append(path) or read_image_info(path))
+    index = dataset_index.get_index(path_data, path_output)
+    assert "label-SC_seg" in get_labels(index, "sub-01/ses-01")
+    # The images did not change, so their headers are not read again
+    assert headers_read == []
+    assert index['sessions'] == dataset_index.build_index(path_data)['sessions']
+
+
+def test_session_query_only_checks_its_session(tmp_path, monkeypatch):
+    path_data, path_output = str(tmp_path / "data"), str(tmp_path / "output")
+    create_dataset(path_data, ["sub-01/ses-01", "sub-02/ses-01"])
+    dataset_index.get_index(path_data, path_output)
+    add_label(path_data, "sub-01/ses-01", "label-SC_seg")
+    add_label(path_data, "sub-02/ses-01", "label-SC_seg")
+
+    dirs_checked = []
+    get_dir_mtime = dataset_index.get_dir_mtime
+    monkeypatch.setattr(dataset_index, "get_dir_mtime", lambda path: dirs_checked.append(path) or get_dir_mtime(path))
+    index = dataset_index.get_index(path_data, path_output, sessions=["sub-02/ses-01"])
+    assert "label-SC_seg" in get_labels(index, "sub-02/ses-01")
+    assert "label-SC_seg" not in get_labels(index, "sub-01/ses-01")
+    assert not any("sub-01" in path for path in dirs_checked)
+
+    path_extract = str(tmp_path / "extract.json")
+    dataset_index.write_extract(index, "sub-02/ses-01", path_extract)
+    extract = dataset_index.read_extract(path_extract)
+    assert dataset_index.get_images(extract, "sub-02/ses-01") == dataset_index.get_images(index, "sub-02/ses-01")
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+
+import derivative_cache
+
+path_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def test_fetch_unlinks_output_when_cache_is_disabled(tmp_path, monkeypatch):
+    path_input, path_output = str(tmp_path / "image.nii.gz"), str(tmp_path / "seg.nii.gz")
+    write(path_input, "image")
+    write(path_output, "seg")
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setenv(derivative_cache.env_cache_dir, cache_dir)
+    key = derivative_cache.get_key([path_input], {'tool': "sct_deepseg_spinalcord"})
+    derivative_cache.store(key, path_output)
+    path_cached = os.path.join(derivative_cache.get_entry_path(cache_dir, key), derivative_cache.file_entry)
+    assert os.path.samefile(path_cached, path_output)
+
+    # Run again without the cache: the output is removed, so the tool writes a new file instead of the cache entry
+    monkeypatch.delenv(derivative_cache.env_cache_dir)
+    cmd = [sys.executable, os.path.join(path_repo, "derivative_cache.py"), "fetch", path_output,
+           "-inputs", path_input, "-params", "tool=sct_deepseg_spinalcord"]
+    assert subprocess.run(cmd).returncode == 1
+    assert not os.path.exists(path_output)
+    write(path_output, "new seg")
+    assert read(path_cached) == "seg"
+
+
+def test_store_fetch_evict(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setenv(derivative_cache.env_cache_dir, cache_dir)
+    paths_input = [str(tmp_path / f"image{i}.nii.gz") for i in range(3)]
+    keys = []
+    for i, path_input in enumerate(paths_input):
+        write(path_input, f"image {i}")
+        path_output = str(tmp_path / f"seg{i}.nii.gz")
+        write(path_output, f"seg {i}" * 100)
+        keys.append(derivative_cache.get_key([path_input], {'tool': "sct_deepseg_gm", 'sct_version': "7.0"}))
+        derivative_cache.store(keys[-1], path_output)
+    # The key depends on the content of the inputs and on the parameters
+    assert len(set(keys)) == 3
+    assert keys[0] != derivative_cache.get_key([paths_input[0]], {'tool': "sct_deepseg_gm", 'sct_version': "7.1"})
+    assert all(derivative_cache.contains(key) for key in keys)
+
+    path_fetched = str(tmp_path / "fetched.nii.gz")
+    assert derivative_cache.fetch(keys[1], path_fetched)
+    assert read(path_fetched) == "seg 1" * 100
+    assert not derivative_cache.fetch(derivative_cache.get_key([paths_input[1]], {}), path_fetched)
+
+    # Evict the least recently used entries: keys[0] is the oldest, keys[1] was just fetched
+    for key, mtime in zip(keys, [1, 3, 2]):
+        os.utime(derivative_cache.get_entry_path(cache_dir, key), (mtime, mtime))
+    derivative_cache.evict(cache_dir, max_size=len("seg 1" * 100))
+    assert [derivative_cache.contains(key) for key in keys] == [False, True, False]
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from slice_stats import compute_slice_stats
+
+
+def get_masked_stats(data, mask, ddof=0):
+    """Reference: statistics of every axial slice with np.ma (NaN for the fully masked slices)."""
+    masked = np.ma.masked_array(data, mask=~mask)
+    slices = [masked[..., z] for z in range(data.shape[2])]
+    stats = {'count': np.array([masked_slice.count() for masked_slice in slices])}
+    for key, kwargs in [('mean', {}), ('std', {'ddof': ddof}), ('min', {}), ('max', {})]:
+        values = [getattr(masked_slice, key)(**kwargs) for masked_slice in slices]
+        stats[key] = np.array([np.nan if value is np.ma.masked else float(value) for value in values])
+    return stats
+
+
+def create_data(shape=(8, 7, 5), seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100, 20, shape).astype(np.float32)
+    mask = rng.random(shape[:3]) > 0.6
+    mask[..., 2] = False  # Fully masked slice
+    mask[0, 0, 3], mask[1:, :, 3] = True, False  # Slice with a single voxel
+    return data, mask
+
+
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_matches_masked_arrays(ddof):
+    data, mask = create_data()
+    stats = compute_slice_stats(data, mask.astype(np.uint8), ddof=ddof)
+    expected = get_masked_stats(data, mask, ddof=ddof)
+    np.testing.assert_array_equal(stats['count'], expected['count'])
+    for key in ['mean', 'std', 'min', 'max']:
+        np.testing.assert_allclose(stats[key], expected[key], rtol=1e-5, equal_nan=True)
+    assert np.isnan(stats['mean'][2])
+
+
+def test_stacked_volumes_match_each_volume():
+    data, mask = create_data(shape=(8, 7, 5, 2))
+    stats = compute_slice_stats(data, mask)
+    for i in range(2):
+        stats_volume = compute_slice_stats(data[..., i], mask)
+        for key in ['sum', 'mean', 'std', 'min', 'max']:
+            np.testing.assert_allclose(stats[key][:, i], stats_volume[key], equal_nan=True)
+
+
+def test_shape_mismatch():
+    with pytest.raises(ValueError):
+        compute_slice_stats(np.zeros((4, 4, 3)), np.zeros((4, 4, 2)))
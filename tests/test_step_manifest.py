@@ -0,0 +1,69 @@
+import os
+
+import step_manifest
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def create_step(tmp_path, name, inputs, outputs, params=None):
+    for path in inputs + outputs:
+        if not os.path.exists(path):
+            write(path, os.path.basename(path))
+    return {'name': name, 'step': "segmentation", 'inputs': inputs, 'outputs': outputs, 'params': params or {}}
+
+
+def test_recorded_step_is_up_to_date(tmp_path):
+    path_output = str(tmp_path)
+    step = create_step(tmp_path, "seg", [str(tmp_path / "image")], [str(tmp_path / "seg")], {'tool': "sct_deepseg"})
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+    step_manifest.record_step(path_output, "sub-01", "ses-01", step)
+    assert step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+
+
+def test_step_is_invalidated(tmp_path, monkeypatch):
+    path_output = str(tmp_path)
+    path_image, path_seg = str(tmp_path / "image"), str(tmp_path / "seg")
+    step = create_step(tmp_path, "seg", [path_image], [path_seg], {'tool': "sct_deepseg"})
+    step_manifest.record_step(path_output, "sub-01", "ses-01", step)
+
+    # Changed parameters or input list
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", dict(step, params={'tool': "manual"}))
+    path_label = str(tmp_path / "label")
+    write(path_label, "label")
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01",
+                                                dict(step, inputs=[path_image, path_label]))
+    # Forced
+    monkeypatch.setenv(step_manifest.env_force, "1")
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+    monkeypatch.delenv(step_manifest.env_force)
+    assert step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+
+    # Touched input with the same content: still up to date
+    os.utime(path_image, ns=(0, 0))
+    assert step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+    # Changed input content
+    write(path_image, "edited")
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+    step_manifest.record_step(path_output, "sub-01", "ses-01", step)
+    # Removed output
+    os.remove(path_seg)
+    assert not step_manifest.is_step_up_to_date(path_output, "sub-01", "ses-01", step)
+
+
+def test_plan_runs_steps_depending_on_a_stale_step(tmp_path):
+    path_output = str(tmp_path)
+    path_image, path_seg, path_metrics = str(tmp_path / "image"), str(tmp_path / "seg"), str(tmp_path / "metrics")
+    path_other = str(tmp_path / "other")
+    steps = [create_step(tmp_path, "seg", [path_image], [path_seg]),
+             create_step(tmp_path, "metrics", [path_image, path_seg], [path_metrics]),
+             create_step(tmp_path, "other", [path_image], [path_other])]
+    assert step_manifest.plan(path_output, "sub-01/ses-01", steps) == ["seg", "metrics", "other"]
+    step_manifest.record_plan(path_output, "sub-01/ses-01", ["seg", "metrics", "other"])
+    assert step_manifest.plan(path_output, "sub-01/ses-01", steps) == []
+
+    # Only the segmentation is stale, but the metrics use its output
+    steps[0]['params'] = {'tool': "manual"}
+    assert step_manifest.plan(path_output, "sub-01/ses-01", steps) == ["seg", "metrics"]
@@ -0,0 +1,113 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+import step_manifest
+
+path_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_tools = ["sct_deepseg", "sct_deepseg_gm", "sct_maths", "sct_qc", "sct_version", "sct_check_dependencies",
+              "fslstats"]
+sessions = ["sub-01/ses-01", "sub-02/ses-01"]
+# Lines printed by the drivers when they run a step
+steps_run = ["Proceeding with automatic segmentation", "Creating ghosting mask", "Computing metrics"]
+
+
+def create_dataset(path_data):
+    rng = np.random.default_rng(0)
+    for subject_session in sessions:
+        subject, session = subject_session.split("/")
+        path_anat = os.path.join(path_data, subject_session, "anat")
+        os.makedirs(path_anat)
+        for acq in ["acq-upperT", "acq-LSE"]:
+            for rec in ["rec-navigated", "rec-standard"]:
+                data = rng.uniform(0, 100, (40, 40, 5)).astype(np.float32)
+                nib.save(nib.Nifti1Image(data, np.eye(4)),
+                         os.path.join(path_anat, f"{subject}_{session}_{acq}_{rec}_T2starw.nii.gz"))
+
+
+def get_env(tmp_path):
+    """Return the environment running the stand-ins of fake_tools.py instead of the SCT/FSL tools."""
+    path_bin = tmp_path / "bin"
+    path_bin.mkdir()
+    for tool in fake_tools:
+        path_tool = path_bin / tool
+        path_tool.write_text(f'#!/bin/bash\nexec "{sys.executable}" "{path_repo}/fake_tools.py" {tool} "$@"\n')
+        path_tool.chmod(0o755)
+    return dict(os.environ, PATH=f"{path_bin}{os.pathsep}{os.environ['PATH']}")
+
+
+def run_batch(path_data, path_output, env):
+    subprocess.run([sys.executable, os.path.join(path_repo, "run_batch.py"), "-path-data", path_data,
+                    "-path-output", path_output, "-fake-tools"], env=env, check=True, capture_output=True)
+    return {subject_session: (path_output / "log" / f"{subject_session.replace('/', '_')}.log").read_text()
+            for subject_session in sessions}
+
+
+def run_process_data(path_data, path_output, subject_session, env):
+    env = dict(env, PATH_DATA=path_data, PATH_DATA_PROCESSED=str(path_output / "data_processed"),
+               PATH_RESULTS=str(path_output / "results"), PATH_LOG=str(path_output / "log"),
+               PATH_QC=str(path_output / "qc"))
+    process = subprocess.run(["bash", "process_data.sh", subject_session], cwd=path_repo, env=env,
+                             capture_output=True, text=True)
+    assert process.returncode == 0, process.stdout + process.stderr
+    return process.stdout
+
+
+def plan(path_data, path_output, subject_session, env):
+    process = subprocess.run([sys.executable, os.path.join(path_repo, "step_manifest.py"), "plan", path_data,
+                              str(path_output / "data_processed"), subject_session],
+                             env=env, check=True, capture_output=True, text=True)
+    return process.stdout.split()
+
+
+def get_manifests(path_output):
+    path_manifests = path_output / "manifests"
+    return {str(path): path.read_text() for path in path_manifests.rglob("*.json")
+            if path.name not in [f"{step_manifest.name_plan}.json", "dataset_index.json"]}
+
+
+def test_process_data_skips_steps_run_by_run_batch(tmp_path):
+    path_data, path_output, env = str(tmp_path / "data"), tmp_path / "output", get_env(tmp_path)
+    create_dataset(path_data)
+    run_batch(path_data, path_output, env)
+    manifests = get_manifests(path_output)
+    assert manifests
+    for subject_session in sessions:
+        assert plan(path_data, path_output, subject_session, env) == []
+        log = run_process_data(path_data, path_output, subject_session, env)
+        assert not any(line in log for line in steps_run)
+        assert "up to date, skipping" in log
+    assert get_manifests(path_output) == manifests
+
+
+def test_run_batch_skips_steps_run_by_process_data(tmp_path):
+    path_data, path_output, env = str(tmp_path / "data"), tmp_path / "output", get_env(tmp_path)
+    create_dataset(path_data)
+    for subject_session in sessions:
+        run_process_data(path_data, path_output, subject_session, env)
+        assert plan(path_data, path_output, subject_session, env) == []
+    manifests = get_manifests(path_output)
+    logs = run_batch(path_data, path_output, env)
+    for log in logs.values():
+        assert not any(line in log for line in steps_run)
+        assert "up to date, skipping" in log
+    assert get_manifests(path_output) == manifests
+
+
+def test_changed_input_invalidates_dependent_steps(tmp_path):
+    path_data, path_output, env = str(tmp_path / "data"), tmp_path / "output", get_env(tmp_path)
+    create_dataset(path_data)
+    run_batch(path_data, path_output, env)
+    # A new manual SC segmentation of the navigated image of acq-LSE is an input of its SC segmentation step, and the
+    # segmentation is an input of the metrics of acq-LSE
+    prefix = "sub-01_ses-01_acq-LSE_rec-navigated_T2starw"
+    path_labels = os.path.join(path_data, "derivatives", "labels", "sub-01", "ses-01", "anat")
+    os.makedirs(path_labels)
+    nib.save(nib.Nifti1Image(np.ones((40, 40, 5), dtype=np.uint8), np.eye(4)),
+             os.path.join(path_labels, f"{prefix}_label-SC_seg.nii.gz"))
+    assert sorted(plan(path_data, path_output, "sub-01/ses-01", env)) == ["sub-01_ses-01_acq-LSE_T2starw_metrics",
+                                                                          f"{prefix}_label-SC_seg"]
+    assert plan(path_data, path_output, "sub-02/ses-01", env) == []
@@ -0,0 +1,51 @@
+import os
+import time
+import asyncio
+import multiprocessing
+
+import pytest
+
+import tool_runner
+from tool_runner import ToolRunner, create_shared_semaphores
+
+
+def test_parse_limits():
+    assert tool_runner.parse_limits(["sct_deepseg=2", "sct_qc=4"]) == {"sct_deepseg": 2, "sct_qc": 4}
+    with pytest.raises(ValueError):
+        tool_runner.parse_limits(["sct_deepseg=0"])
+
+
+def test_shared_slot_released_after_failed_session(tmp_path, monkeypatch):
+    # The tool holding the slot and the one waiting for it are cancelled when another task of the session fails
+    monkeypatch.setenv("GRE1DNAV_FAKE_TOOLS_DELAY", "3")
+    path_log = str(tmp_path / "log.txt")
+    paths_output = [str(tmp_path / f"out{i}.nii.gz") for i in range(2)]
+
+    async def fail():
+        await asyncio.sleep(0.5)
+        raise RuntimeError("failed session")
+
+    async def session(runner):
+        await asyncio.gather(fail(), *[runner.run(["sct_maths", "-i", "a.nii.gz", "-add", "a.nii.gz", "-o", path],
+                                                  path_log) for path in paths_output])
+
+    with multiprocessing.Manager() as manager:
+        shared = create_shared_semaphores(manager, {"sct_maths": 1})
+        start = time.monotonic()
+        with pytest.raises(RuntimeError):
+            asyncio.run(session(ToolRunner(fake=True, shared=shared)))
+        # The running tool was killed instead of being waited for
+        assert time.monotonic() - start < 3
+        assert shared["sct_maths"].acquire(timeout=2)
+        shared["sct_maths"].release()
+    time.sleep(3)
+    assert not any(os.path.exists(path) for path in paths_output)
+
+
+def test_local_limits(tmp_path):
+    async def session(runner):
+        await asyncio.gather(*[runner.run(["sct_version"], str(tmp_path / "log.txt")) for _ in range(3)])
+        return runner.get_semaphore("sct_version")
+
+    semaphore = asyncio.run(session(ToolRunner(limits={"sct_version": 1}, fake=True)))
+    assert not semaphore.locked()
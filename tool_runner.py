@@ -0,0 +1,154 @@
+# Asynchronous runner of the external tools (SCT/FSL).
+#
+# The tools are started with asyncio subprocesses, so that several of them run at the same time and overlap with the
+# metrics computed in Python. The number of concurrent processes of each tool is capped (e.g., a single deep learning
+# segmentation at a time), and their output is captured without blocking and written to the log file in one chunk once
+# they are done.
+#
+# The limits of a runner only apply to the tools it runs. To share them between the runners of several processes (e.g.,
+# the workers of `run_batch.py -jobs N`), create the semaphores once with create_shared_semaphores and pass them to
+# every runner (`shared=`): a limit of 1 then means one process of the tool at a time for the whole batch.
+#
+# When a session fails, its pending tasks are cancelled: a shared slot which is still awaited is released as soon as it
+# is acquired (see acquire_shared), and a running tool is killed, so that the other processes are not blocked.
+#
+# With `fake=True`, the tools are replaced by the stand-ins of fake_tools.py, so that the pipeline can be run offline.
+#
+# How to use:
+#   runner = ToolRunner(limits={"sct_deepseg": 2})
+#   await runner.run(["sct_deepseg_gm", "-i", "a.nii.gz", "-o", "a_label-GM_seg.nii.gz"], path_log, cwd=path_anat)
+#   # Limits shared between processes
+#   with multiprocessing.Manager() as manager:
+#       semaphores = create_shared_semaphores(manager, limits={"sct_deepseg": 2})
+#       runner = ToolRunner(limits={"sct_deepseg": 2}, shared=semaphores)  # in each process
+
+import os
+import sys
+import asyncio
+import threading
+import contextlib
+import subprocess
+
+# Define variables
+# Default maximum number of concurrent processes of each tool. The other tools are capped to the number of CPU cores.
+default_limits = {
+    "sct_deepseg": 1,
+    "sct_deepseg_gm": 1,
+    "sct_qc": 2,
+    "sct_maths": 4,
+    "fslstats": 8,
+}
+path_fake_tools = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_tools.py")
+# Interval (in seconds) at which a thread waiting for a shared slot checks if its task was cancelled
+poll_interval = 0.5
+
+
+def parse_limits(limits):
+    """Parse tool limits given as ["sct_deepseg=2", "sct_qc=4"]."""
+    parsed = {}
+    for limit in limits or []:
+        tool, _, value = limit.partition("=")
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError(f"Invalid tool limit: {limit}. Expected <tool>=<number of processes>, e.g. sct_deepseg=2")
+        parsed[tool] = int(value)
+    return parsed
+
+
+def create_shared_semaphores(manager, limits=None):
+    """
+    Create the semaphores of the tools with a limit (default_limits, updated with `limits`) in a
+    multiprocessing.Manager, so that the limits are shared by the runners of all the processes they are passed to.
+    """
+    return {tool: manager.BoundedSemaphore(limit) for tool, limit in {**default_limits, **(limits or {})}.items()}
+
+
+async def acquire_shared(semaphore):
+    """
+    Acquire a semaphore shared between processes without blocking the event loop. The semaphore is acquired in a
+    thread, which gives up when the awaiting task is cancelled; a slot acquired by the thread after the cancellation is
+    released, so that it is never lost.
+    """
+    lock = threading.Lock()
+    state = {'cancelled': False, 'acquired': False}
+
+    def wait():
+        while True:
+            with lock:
+                if state['cancelled']:
+                    return
+            if semaphore.acquire(timeout=poll_interval):
+                with lock:
+                    if state['cancelled']:
+                        semaphore.release()
+                    else:
+                        state['acquired'] = True
+                return
+
+    try:
+        await asyncio.to_thread(wait)
+    except asyncio.CancelledError:
+        with lock:
+            state['cancelled'] = True
+            if state['acquired']:
+                semaphore.release()
+        raise
+
+
+class ToolRunner:
+    """
+    Run external tools as asyncio subprocesses, with a maximum number of concurrent processes per tool. The limits are
+    shared with other processes for the tools of `shared` (see create_shared_semaphores).
+    """
+
+    def __init__(self, limits=None, fake=False, shared=None):
+        self.limits = {**default_limits, **(limits or {})}
+        self.fake = fake
+        self.shared = shared or {}
+        self.semaphores = {}
+
+    def get_semaphore(self, tool):
+        if tool not in self.semaphores:
+            self.semaphores[tool] = asyncio.Semaphore(self.limits.get(tool, os.cpu_count() or 1))
+        return self.semaphores[tool]
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, tool):
+        """Wait for a slot of the tool: in the semaphore shared between processes if any, otherwise in this runner."""
+        if tool not in self.shared:
+            async with self.get_semaphore(tool):
+                yield
+            return
+        # The shared semaphore blocks, so it is acquired in a thread to keep the other tasks of the session running
+        await acquire_shared(self.shared[tool])
+        try:
+            yield
+        finally:
+            self.shared[tool].release()
+
+    async def run(self, cmd, path_log, cwd=None):
+        """
+        Run a tool and append its output to the log file. Raises subprocess.CalledProcessError if the tool fails.
+
+        :return: Output of the tool (stdout and stderr)
+        """
+        tool = os.path.basename(cmd[0])
+        cmd_run = [sys.executable, path_fake_tools] + list(cmd) if self.fake else list(cmd)
+        async with self.acquire(tool):
+            process = await asyncio.create_subprocess_exec(*cmd_run, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT)
+            try:
+                output, _ = await process.communicate()
+            except asyncio.CancelledError:
+                # E.g., another task of the session failed: do not leave the tool running (and holding its slot)
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+                raise
+        output = output.decode(errors="replace")
+        # Keep the order of the messages when the output of the session is redirected to the same log file
+        sys.stdout.flush()
+        with open(path_log, 'a') as log:
+            log.write(f"\n$ {' '.join(cmd)}\n{output}")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
+        return output